@@ -5,11 +5,22 @@ import gi
 gi.require_version("Gimp", "3.0")
 gi.require_version("GimpUi", "3.0")
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gimp, GimpUi, GObject, GLib, Gio, Gtk
+gi.require_version("Gegl", "0.4")
+from gi.repository import Gimp, GimpUi, GObject, GLib, Gio, Gtk, Gegl
 import gettext
+import os
+import socket
+import subprocess
+import sys
+import time
+sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "tools")])
+from socket_utils import send_message, recv_message
 
 _ = gettext.gettext
 
+INFERENCE_SERVER_HOST = "127.0.0.1"
+INFERENCE_SERVER_PORT = 65435  # inference_ov_server.py, for super-resolution and semantic segmentation
+
 
 def show_dialog(message, title, icon="logo", image_paths=None):
     use_header_bar = Gtk.Settings.get_default().get_property("gtk-dialogs-use-header")
@@ -71,5 +82,72 @@ def save_image(image, drawable, file_path):
     )
 
 
+def new_layer_from_pixels(image, name, width, height, pixels, mode=Gimp.LayerMode.NORMAL_LEGACY):
+    """
+    Create a layer from raw 8 bit RGB pixels and add it on top of the image.
+
+    Parameters:
+        image (Gimp.Image): image to insert the layer into
+        name (str): layer name
+        width, height (int): size of the pixel buffer
+        pixels (bytes): width * height * 3 bytes, row major RGB
+    Returns:
+        the new Gimp.Layer
+    """
+    layer = Gimp.Layer.new(image, name, width, height, Gimp.ImageType.RGB_IMAGE, 100, mode)
+    image.insert_layer(layer, None, -1)
+    buffer = layer.get_buffer()
+    buffer.set(Gegl.Rectangle.new(0, 0, width, height), "R'G'B' u8", bytes(pixels))
+    buffer.flush()
+    layer.update(0, 0, width, height)
+    return layer
+
+
+def ping_inference_server(timeout=0.1):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect((INFERENCE_SERVER_HOST, INFERENCE_SERVER_PORT))
+            send_message(s, {"type": "ping"})
+            message, _ = recv_message(s)
+            return message is not None and message["type"] == "ping"
+    except:
+        return False
+
+
+def run_on_inference_server(python_path, server_path, task, start_timeout=60):
+    """
+    Run a saved request (gimp_openvino_run.json / cache.png) on the inference server, starting it
+    if it isn't running yet. The server keeps the compiled models, so the next runs only pay the inference.
+
+    Parameters:
+        python_path (str): python of the plugins environment
+        server_path (str): path of inference_ov_server.py
+        task (str): "superresolution" or "semseg"
+        start_timeout (float): seconds to wait for a server that was just started
+    Returns:
+        True if the server ran the request, False if it could not be reached
+        (the caller then runs the one-off script instead)
+    """
+    if not ping_inference_server():
+        subprocess.Popen([python_path, server_path], close_fds=True)
+        deadline = time.time() + start_timeout
+        while not ping_inference_server(timeout=1.0):
+            if time.time() > deadline:
+                print("Inference server did not start")
+                return False
+            time.sleep(0.25)
+
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.connect((INFERENCE_SERVER_HOST, INFERENCE_SERVER_PORT))
+            send_message(s, {"type": "run", "task": task})
+            message, _ = recv_message(s)
+    except OSError as error:
+        print("Inference server connection failed:", error)
+        return False
+    return message is not None and message["type"] == "result"
+
+
 def N_(message):
     return message
\ No newline at end of file
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Copyright(C) 2022-2023 Intel Corporation
+# SPDX - License - Identifier: Apache - 2.0
+"""
+Long-lived worker for the super-resolution and semantic segmentation plugins.
+
+Running superresolution_ov.py / semseg_ov.py as a new process on every invocation pays the interpreter
+start, the imports, the Core creation and the model read / reshape / compile each time. This server
+keeps one Core and a bounded cache of compiled models, keyed by model, input shape and device, so
+repeated invocations on similar-sized layers only pay the inference.
+
+The plugins save their request (gimp_openvino_run.json) and layer (cache.png) as for the one-off
+scripts, then send {"type": "run", "task": "superresolution" | "semseg"} and wait for
+{"type": "result", "inference_status": ...}. The result is written to cache.png.
+"""
+
+import os
+import sys
+import socket
+import threading
+import logging as log
+import psutil
+
+sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "openvino_common")])
+sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "..","tools")])
+
+import openvino as ov
+from tools_utils import get_weight_path, get_config_value
+from socket_utils import send_message, recv_message, ProtocolError
+from models_ov.inference_cache import CompiledModelCache
+
+import superresolution_ov
+import semseg_ov
+
+HOST = "127.0.0.1"  # Standard loopback interface address (localhost)
+PORT = 65435  # Port to listen on (65432 - 65434 are used by the stable-diffusion and model management servers)
+
+log.basicConfig(format='[ %(levelname)s ] %(message)s', level=log.INFO, stream=sys.stdout)
+
+TASKS = {
+    "superresolution": superresolution_ov.run_saved_request,
+    "semseg": semseg_ov.run_saved_request,
+}
+
+
+class InferenceServer:
+    """
+    Runs the plugin requests one at a time, with the shared core and compiled model cache.
+
+    Parameters:
+        weight_path (str): weight folder, the request files are saved next to it
+        max_entries (int): number of compiled variants of each model kept loaded
+    """
+    def __init__(self, weight_path, max_entries=4):
+        self.weight_path = weight_path
+        self.core = ov.Core()
+        self.compiled_models = CompiledModelCache(max_entries=max_entries)
+        # the request files are shared, and so are the infer requests of the cached models
+        self.lock = threading.Lock()
+
+    def run(self, task):
+        with self.lock:
+            return TASKS[task](self.weight_path, self.core, self.compiled_models)
+
+
+def run_connection_routine(server, conn):
+    with conn:
+        try:
+            while True:
+                message, _ = recv_message(conn)
+                if message is None:
+                    break
+
+                msg_type = message.get("type")
+                if msg_type == "kill":
+                    os._exit(0)
+                elif msg_type == "ping":
+                    send_message(conn, {"type": "ping"})
+                elif msg_type == "run":
+                    task = message.get("task")
+                    if task not in TASKS:
+                        send_message(conn, {"type": "error", "error": "Unknown task: %s" % task})
+                        continue
+                    try:
+                        status = server.run(task)
+                    except Exception as error:
+                        log.error("Task %s failed: %s", task, error)
+                        status = "failed"
+                    send_message(conn, {"type": "result", "task": task, "inference_status": status})
+                else:
+                    send_message(conn, {"type": "error", "error": "Unknown message type: %s" % msg_type})
+        except (OSError, ProtocolError) as error:
+            log.warning("Client connection closed: %s", error)
+
+
+def run():
+    max_entries = int(get_config_value("inference_server_cache_entries", 4))
+    server = InferenceServer(get_weight_path(), max_entries)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOST, PORT))
+        s.listen()
+        print("Ready")
+        while True:
+            conn, addr = s.accept()
+
+            # Each client gets its own thread, pings are answered while a request runs
+            conn_thread = threading.Thread(target=run_connection_routine, args=(server, conn), daemon=True)
+            conn_thread.start()
+
+
+def start():
+    run_thread = threading.Thread(target=run, args=())
+    run_thread.start()
+
+    gimp_proc = None
+    for proc in psutil.process_iter():
+        if "gimp-2.99" in proc.name():
+            gimp_proc = proc
+            break
+
+    if gimp_proc:
+        psutil.wait_procs([proc])
+        print("exiting..!")
+        os._exit(0)
+
+    run_thread.join()
+
+if __name__ == "__main__":
+   start()
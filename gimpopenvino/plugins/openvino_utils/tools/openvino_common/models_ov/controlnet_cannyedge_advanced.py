@@ -12,7 +12,6 @@ import numpy as np
 
 # tokenizer
 from transformers import CLIPTokenizer
-import torch
 
 from diffusers import DiffusionPipeline
 from diffusers import UniPCMultistepScheduler,DDIMScheduler, LMSDiscreteScheduler, PNDMScheduler, EulerDiscreteScheduler
@@ -28,6 +27,13 @@ import glob
 import json
 import time
 
+from .controlnet_guidance import ControlNetGuidance, cond_only_controlnet
+from .inference_cache import encode_prompt_cached, time_projection_table
+from .stage_graph import StageGraph
+from .schedulers_np import scheduler_step, LMSDiscreteSchedulerNP, EulerDiscreteSchedulerNP
+from .guidance import guidance_active
+from .tiled_vae import vae_decode
+
 from diffusers import StableDiffusionControlNetPipeline, ControlNetModel
 
 from openvino.runtime import Model, Core
@@ -139,6 +145,7 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
         self.swap = swap
    
         
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')}) #adding caching to reduce init time
         print("Setting caching")
@@ -201,6 +208,7 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
         start = time.time()
         
         self.controlnet = core.compile_model(controlnet, "GPU")
+        self.controlnet_path = controlnet
         print("controlnet loaded in:", time.time() - start)
         start = time.time()
         
@@ -252,6 +260,7 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
 
         start = time.time()
         self.vae_decoder = core.compile_model(vae_decoder, device[3])
+        self.tiled_vae = None
         self.vae_decoder_out = self.vae_decoder.output(0)
         print("vae decoder loaded in:", time.time() - start)
         
@@ -272,19 +281,34 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
             create_gif = False,
             model = None,
             callback = None,
-            callback_userdata = None#,
+            callback_userdata = None, #,
             #scheduler=None,
+            controlnet_cond_only = False,
+            control_guidance_start = 0.0,
+            control_guidance_end = 1.0,
+            guidance_cutoff = 1.0
     ):
+        """
+        controlnet_cond_only runs the ControlNet on the conditional half of the CFG batch only, the unconditional
+        branch gets zero residuals. The ControlNet only runs for the steps between control_guidance_start and
+        control_guidance_end (fractions of the steps), the UNet gets zero residuals for the others.
+        guidance_cutoff (fraction of the steps) stops classifier free guidance: the later steps only run
+        the conditional branch of the ControlNet and the UNet.
+        """
         
         
         do_classifier_free_guidance = guidance_scale > 1.0
-        # 2. Encode input prompt
-        text_embeddings = self._encode_prompt(prompt, negative_prompt=negative_prompt)
+        # 2. Encode input prompt, while the control image is annotated
+        image = image.convert("RGB")
+        stages = StageGraph()
+        stages.add("prompt", lambda: self._encode_prompt(prompt, negative_prompt=negative_prompt))
+        stages.add("control_image", lambda: canny(image))
+        preprocessed = stages.run()
+        text_embeddings = preprocessed["prompt"]
 
         
         # 3. Preprocess image
-        image = image.convert("RGB")
-        control_image =canny(image)
+        control_image = preprocessed["control_image"]
        
         orig_width, orig_height = control_image.size
         
@@ -331,6 +355,14 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
 
         # 7. Denoising loop
 
+        time_proj_table = time_projection_table(self.unet_time_proj, self.model_key, timesteps, lambda t: {"timestep" : t})
+        controlnet_guidance = ControlNetGuidance(
+            self.controlnet, len(timesteps),
+            cond_controlnet=cond_only_controlnet(self.core, self.controlnet, self.controlnet_path)
+            if (controlnet_cond_only or guidance_cutoff < 1.0) and do_classifier_free_guidance else None,
+            guidance_start=control_guidance_start, guidance_end=control_guidance_end,
+            cond_only=controlnet_cond_only,
+            infer_request=self.infer_request_controlnet)
         num_warmup_steps = len(timesteps) - num_inference_steps * scheduler.order
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
@@ -352,13 +384,13 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
        
                 #result = self.controlnet([latent_model_input_2, t, text_embeddings, pose])  
                 controlnet_dict = {"sample":latent_model_input_2, "timestep":t, "encoder_hidden_states":text_embeddings, "controlnet_cond":control_image}
-                result = self.infer_request_controlnet.infer(controlnet_dict, share_outputs = True)
+                guided = do_classifier_free_guidance and guidance_active(i, len(timesteps), guidance_cutoff)
+                result = controlnet_guidance(i, controlnet_dict, cond_only=controlnet_cond_only or not guided)
 
                 tensor_dict_neg = {}
                 tensor_dict = {}
 
-                for k,v in result.items():
-                    tensor_name = next(iter(k.names))
+                for tensor_name, v in result:
                     #print("tensor_name--", tensor_name)
                     vneg = np.expand_dims(v[0], axis=0)
                     tensor_dict_neg[tensor_name] = vneg #controlnet_conditioning_scale * vneg #.astype(np.float32)
@@ -369,21 +401,20 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
                 
             
                     
-                time_proj_dict = {"timestep" : t}
-                self.infer_request_time_proj.start_async(time_proj_dict,share_inputs = True)
-                self.infer_request_time_proj.wait()
-                time_proj = self.infer_request_time_proj.get_output_tensor(0).data.astype(np.float32) 
+                time_proj = time_proj_table[i]
                 
-                ##### NEGATIVE PIPELINE #####
-                input_dict_neg = {"sample":latent_model_input, "time_proj": time_proj, "encoder_hidden_states":np.expand_dims(text_embeddings[0], axis=0)}
-                input_dict_neg.update(tensor_dict_neg)
+                # past the guidance cutoff the negative request stays idle
+                if guided:
+                    ##### NEGATIVE PIPELINE #####
+                    input_dict_neg = {"sample":latent_model_input, "time_proj": time_proj, "encoder_hidden_states":np.expand_dims(text_embeddings[0], axis=0)}
+                    input_dict_neg.update(tensor_dict_neg)
                 
-                if self.npu_flag_neg:
-                    input_dict_neg_final = {k: v for k, v in sorted(input_dict_neg.items(), key=lambda x: x[0])}
-                else:
-                    input_dict_neg_final = input_dict_neg
+                    if self.npu_flag_neg:
+                        input_dict_neg_final = {k: v for k, v in sorted(input_dict_neg.items(), key=lambda x: x[0])}
+                    else:
+                        input_dict_neg_final = input_dict_neg
                 
-                self.infer_request_neg.start_async(input_dict_neg_final, share_inputs = True)
+                    self.infer_request_neg.start_async(input_dict_neg_final, share_inputs = True)
                 
                 
                 ##### POSITIVE PIPELINE #####
@@ -395,23 +426,24 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
                     input_dict_final = input_dict
 
                 self.infer_request.start_async(input_dict_final,share_inputs = True)
-                self.infer_request_neg.wait()
-                self.infer_request.wait()                    
-                
-                noise_pred_neg = self.infer_request_neg.get_output_tensor(0)
-                noise_pred_pos = self.infer_request.get_output_tensor(0) 
-
-                noise_pred.append(noise_pred_neg.data.astype(np.float32))
-                noise_pred.append(noise_pred_pos.data.astype(np.float32))  
+                if guided:
+                    self.infer_request_neg.wait()
+                    noise_pred_neg = self.infer_request_neg.get_output_tensor(0)
+                    noise_pred.append(noise_pred_neg.data.astype(np.float32))
+                self.infer_request.wait()
+                noise_pred_pos = self.infer_request.get_output_tensor(0)
+                noise_pred.append(noise_pred_pos.data.astype(np.float32))
 
                 # perform guidance
-                if do_classifier_free_guidance:
+                if guided:
                     noise_pred_uncond, noise_pred_text = noise_pred[0], noise_pred[1]
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)   
+                else:
+                    noise_pred = noise_pred[0]
                     
                     
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = scheduler.step(torch.from_numpy(noise_pred), t, torch.from_numpy(latents)).prev_sample.numpy()
+                latents = scheduler_step(scheduler, noise_pred, t, latents)
                 #print("latents", latents)
 
                 if create_gif:
@@ -420,6 +452,7 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
                 if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % scheduler.order == 0):
                     progress_bar.update()                    
 
+        controlnet_guidance.report()
         if callback:
               callback(num_inference_steps, callback_userdata)
 
@@ -486,8 +519,7 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
         )
         text_input_ids = text_inputs.input_ids
 
-        text_embeddings = self.text_encoder(
-            text_input_ids)[self.text_encoder_out]
+        text_embeddings = encode_prompt_cached(self.text_encoder, self.text_encoder_out, self.model_key, text_input_ids, prompt)
 
         # duplicate text embeddings for each generation per prompt
         if num_images_per_prompt != 1:
@@ -515,7 +547,7 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
                 return_tensors="np",
             )
             
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids)[self.text_encoder_out]
+            uncond_embeddings = encode_prompt_cached(self.text_encoder, self.text_encoder_out, self.model_key, uncond_input.input_ids, uncond_tokens)
 
             # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
             seq_len = uncond_embeddings.shape[1]
@@ -540,7 +572,7 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
            image: decoded by VAE decoder image
         """
         latents = 1 / 0.18215 * latents
-        image = self.vae_decoder(latents)[self.vae_decoder_out]
+        image = vae_decode(self.tiled_vae, self.vae_decoder, latents)
         #print("Decode_image shape", image.shape)
         (_, end_h), (_, end_w) = pad[1:3]
         h, w = image.shape[2:]
@@ -569,12 +601,12 @@ class ControlNetCannyEdgeAdvanced(DiffusionPipeline):
         latents = randn_tensor(shape, np.float32)
  
         # scale the initial noise by the standard deviation required by the scheduler
-        if isinstance(scheduler, LMSDiscreteScheduler):
+        if isinstance(scheduler, (LMSDiscreteScheduler, LMSDiscreteSchedulerNP)):
             
-            latents = latents * scheduler.sigmas[0].numpy()
-        elif isinstance(scheduler, EulerDiscreteScheduler):
+            latents = latents * np.asarray(scheduler.sigmas[0])
+        elif isinstance(scheduler, (EulerDiscreteScheduler, EulerDiscreteSchedulerNP)):
             
-            latents = latents * scheduler.sigmas.max().numpy()
+            latents = latents * np.asarray(scheduler.sigmas.max())
         else:
             latents = latents * scheduler.init_noise_sigma
 
@@ -0,0 +1,134 @@
+"""
+Copyright(C) 2022-2023 Intel Corporation
+SPDX - License - Identifier: Apache - 2.0
+
+ControlNet scheduling for the denoising loops: the ControlNet can run on the conditional half of the
+CFG batch only (the unconditional branch of the UNet gets zero residuals), and only inside a
+[control_guidance_start, control_guidance_end] window of the steps.
+"""
+import time
+
+import numpy as np
+
+from .inference_cache import compile_batch_one
+
+
+def cond_only_controlnet(core, controlnet, xml_path):
+    """
+    The ControlNet compiled for batch 1, for the conditional-only runs
+    """
+    return compile_batch_one(core, controlnet, xml_path)
+
+
+def port_name(port):
+    # same naming as the UNet inputs the residuals are fed to
+    return next(iter(port.names))
+
+
+class ControlNetGuidance:
+    """
+    Runs the ControlNet of one denoising run, and keeps the time it took to report what was saved.
+
+    Parameters:
+        controlnet: compiled ControlNet, taking the CFG batch
+        num_steps (int): number of denoising steps
+        cond_controlnet (*optional*): batch 1 ControlNet (see cond_only_controlnet), runs the batch 1
+            inputs of the steps without CFG, and the conditional half of the CFG batch with cond_only
+        guidance_start (float), guidance_end (float): fraction of the steps the ControlNet runs in,
+            outside of it the UNet gets zero residuals
+        infer_request (*optional*): infer request of controlnet to use
+        cond_only (bool): run the ControlNet on the conditional half of the CFG batch only
+    """
+    def __init__(self, controlnet, num_steps, cond_controlnet=None, guidance_start=0.0, guidance_end=1.0,
+                 infer_request=None, cond_only=True):
+        self.controlnet = controlnet
+        self.cond_only = cond_only
+        self.num_steps = num_steps
+        self.guidance_start = guidance_start
+        self.guidance_end = guidance_end
+        self.request = infer_request or controlnet.create_infer_request()
+        self.cond_request = cond_controlnet.create_infer_request() if cond_controlnet is not None else None
+        self.buffers = {}
+        # full: CFG batch, cond: its conditional half alone, single: batch 1 inputs of a step without CFG
+        self.runs = {"full": 0, "cond": 0, "single": 0, "skipped": 0}
+        self.seconds = {"full": 0.0, "cond": 0.0, "single": 0.0}
+
+    def active(self, i):
+        return not (i / self.num_steps < self.guidance_start or (i + 1) / self.num_steps > self.guidance_end)
+
+    def buffer(self, key, shape):
+        # zero filled, only the rows of the conditional branch of the "cond" buffers are ever written
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.zeros(shape, dtype=np.float32)
+            self.buffers[key] = buffer
+        return buffer
+
+    def __call__(self, i, inputs, cond_only=None):
+        """
+        Parameters:
+            i (int): step index
+            inputs (list or dict): ControlNet inputs for the CFG batch, or for the conditional branch alone
+            cond_only (bool, *optional*): overrides cond_only for this step
+        Returns:
+            residuals (List[Tuple[str, np.ndarray]]): ControlNet outputs by name, for the CFG batch, valid until the next call
+        """
+        values = inputs.values() if isinstance(inputs, dict) else inputs
+        batch = next(np.shape(v)[0] for v in values if np.ndim(v) > 0)
+
+        if not self.active(i):
+            self.runs["skipped"] += 1
+            return [(port_name(port), self.buffer(("zero", port_name(port)), (batch,) + tuple(port.shape)[1:]))
+                    for port in self.controlnet.outputs]
+
+        cond_only = self.cond_only if cond_only is None else cond_only
+        start = time.time()
+        if self.cond_request is not None and batch == 1:
+            # the conditional branch alone, on a step without CFG
+            result = self.cond_request.infer(inputs, share_outputs=True)
+            residuals = [(port_name(port), value) for port, value in result.items()]
+            kind = "single"
+        elif self.cond_request is None or not cond_only or batch == 1:
+            result = self.request.infer(inputs, share_outputs=True)
+            residuals = [(port_name(port), value) for port, value in result.items()]
+            kind = "single" if batch == 1 else "full"
+        else:
+            def cond_half(v):
+                return v[1:] if np.ndim(v) > 0 and np.shape(v)[0] == batch else v
+            if isinstance(inputs, dict):
+                cond_inputs = {k: cond_half(v) for k, v in inputs.items()}
+            else:
+                cond_inputs = [cond_half(v) for v in inputs]
+
+            result = self.cond_request.infer(cond_inputs, share_outputs=True)
+            residuals = []
+            for port, value in result.items():
+                residual = self.buffer(("cond", port_name(port)), (batch,) + value.shape[1:])
+                residual[1:] = value
+                residuals.append((port_name(port), residual))
+            kind = "cond"
+
+        self.seconds[kind] += time.time() - start
+        self.runs[kind] += 1
+        return residuals
+
+    def report(self):
+        """
+        Print (and return) the ControlNet time saved by the conditional-only runs and the guidance window.
+        Savings are only reported against measured runs: the batch 1 runs save time over a measured CFG
+        batch, the skipped steps over a measured CFG batch or, without CFG, a measured batch 1 run.
+        """
+        mean = {kind: self.seconds[kind] / self.runs[kind] if self.runs[kind] else None for kind in self.seconds}
+        full = mean["full"]
+        skipped_cost = full if full is not None else mean["single"]
+        if full is None and not (skipped_cost is not None and self.runs["skipped"]):
+            saved = "no measured baseline"
+        else:
+            seconds = self.runs["skipped"] * (skipped_cost or 0.0)
+            if full is not None:
+                seconds += sum(self.runs[kind] * (full - mean[kind]) for kind in ("cond", "single") if self.runs[kind])
+            saved = "~%.2fs saved" % seconds
+        message = "ControlNet: %d full, %d conditional-only, %d without CFG, %d skipped steps, %s" % (
+            self.runs["full"], self.runs["cond"], self.runs["single"], self.runs["skipped"], saved)
+        print(message)
+        return message
@@ -29,6 +29,13 @@ import glob
 import json
 import time
 
+from .controlnet_guidance import ControlNetGuidance, cond_only_controlnet
+from .inference_cache import encode_prompt_cached, annotate_cached, BatchOneModel
+from .stage_graph import StageGraph
+from .schedulers_np import scheduler_step, LMSDiscreteSchedulerNP, EulerDiscreteSchedulerNP
+from .guidance import guidance_active
+from .tiled_vae import vae_decode
+
 from diffusers import StableDiffusionControlNetPipeline, ControlNetModel
 
 from openvino.runtime import Model, Core
@@ -174,6 +181,7 @@ class ControlNetOpenPose(DiffusionPipeline):
 
         
      
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')}) #adding caching to reduce init time
         print("Setting caching")
@@ -226,14 +234,19 @@ class ControlNetOpenPose(DiffusionPipeline):
         print("text encoder loaded in:", time.time() - start)
         start = time.time()
         self.controlnet = core.compile_model(controlnet, device[2])
+        self.controlnet_path = controlnet
         print("controlnet loaded in:", time.time() - start)
         start = time.time()
         self.unet = core.compile_model(unet, device[1])
+        self.unet_path = unet
         self.unet_out = self.unet.output(0)
 
         print("unet loaded in:", time.time() - start)
         start = time.time()
         self.vae_decoder = core.compile_model(vae_decoder, device[2])
+        self.tiled_vae = None
+        # batch 1 UNet, for the steps past the guidance cutoff
+        self.unet_batch_one = BatchOneModel(self.core, self.unet_path)
         self.vae_decoder_out = self.vae_decoder.output(0)
         print("vae decoder loaded in:", time.time() - start)
         
@@ -254,16 +267,31 @@ class ControlNetOpenPose(DiffusionPipeline):
             model = None,
             callback = None,
             callback_userdata = None,
-            scheduler=None
+            scheduler=None,
+            controlnet_cond_only = False,
+            control_guidance_start = 0.0,
+            control_guidance_end = 1.0,
+            guidance_cutoff = 1.0
     ):
+        """
+        controlnet_cond_only runs the ControlNet on the conditional half of the CFG batch only, the unconditional
+        branch gets zero residuals. The ControlNet only runs for the steps between control_guidance_start and
+        control_guidance_end (fractions of the steps), the UNet gets zero residuals for the others.
+        guidance_cutoff (fraction of the steps) stops classifier free guidance: the later steps only run
+        the conditional branch of the ControlNet and the UNet.
+        """
         do_classifier_free_guidance = guidance_scale > 1.0
-        # 2. Encode input prompt
-        text_embeddings = self._encode_prompt(prompt, negative_prompt=negative_prompt)
+        # 2. Encode input prompt, while the control image is annotated
+        image = image.convert("RGB")
+        stages = StageGraph()
+        stages.add("prompt", lambda: self._encode_prompt(prompt, negative_prompt=negative_prompt))
+        stages.add("control_image", lambda: Image.fromarray(annotate_cached(self.pose_estimator, self.model_key, "openpose", image)))
+        preprocessed = stages.run()
+        text_embeddings = preprocessed["prompt"]
 
         
         # 3. Preprocess image
-        image = image.convert("RGB")
-        pose = self.pose_estimator(image)
+        pose = preprocessed["control_image"]
         
         orig_width, orig_height = pose.size
         
@@ -309,6 +337,14 @@ class ControlNetOpenPose(DiffusionPipeline):
         # num_warmup_steps = len(timesteps) - num_inference_steps * scheduler.order
         # with self.progress_bar(total=num_inference_steps) as progress_bar:
         #    for i, t in enumerate(timesteps):
+        controlnet_guidance = ControlNetGuidance(
+            self.controlnet, len(timesteps),
+            cond_controlnet=cond_only_controlnet(self.core, self.controlnet, self.controlnet_path)
+            if (controlnet_cond_only or guidance_cutoff < 1.0) and do_classifier_free_guidance else None,
+            guidance_start=control_guidance_start, guidance_end=control_guidance_end,
+            cond_only=controlnet_cond_only)
+        # compiled before the first step
+        unet_cond = self.unet_batch_one.get(self.unet) if do_classifier_free_guidance and guidance_cutoff < 1.0 else None
         num_warmup_steps = len(timesteps) - num_inference_steps * scheduler.order
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
@@ -319,26 +355,32 @@ class ControlNetOpenPose(DiffusionPipeline):
 
             # expand the latents if we are doing classifier free guidance
             #noise_pred = []
+                # past the guidance cutoff, the conditional branch alone on the batch 1 ControlNet and UNet
+                guided = do_classifier_free_guidance and guidance_active(i, len(timesteps), guidance_cutoff)
+                if do_classifier_free_guidance and not guided:
+                    unet, step_embeddings, step_control = unet_cond, text_embeddings[-1:], pose[-1:]
+                else:
+                    unet, step_embeddings, step_control = self.unet, text_embeddings, pose
                 latent_model_input = np.concatenate(
-                    [latents] * 2) if do_classifier_free_guidance else latents
+                    [latents] * 2) if guided else latents
                 latent_model_input = scheduler.scale_model_input(latent_model_input, t)
                               
-                result = self.controlnet([latent_model_input, t, text_embeddings, pose])
+                result = controlnet_guidance(i, [latent_model_input, t, step_embeddings, step_control])
                 #print("result", result)
-                down_and_mid_blok_samples = [sample * controlnet_conditioning_scale for _, sample in result.items()]
+                down_and_mid_blok_samples = [sample * controlnet_conditioning_scale for _, sample in result]
                 
                 # predict the noise residual
-                noise_pred = self.unet([latent_model_input, t, text_embeddings, *down_and_mid_blok_samples])[self.unet_out]
+                noise_pred = unet([latent_model_input, t, step_embeddings, *down_and_mid_blok_samples])[unet.output(0)]
                 #print("noise_pred:", noise_pred)
 
 
                 # perform guidance
-                if do_classifier_free_guidance:
+                if guided:
                     noise_pred_uncond, noise_pred_text = noise_pred[0], noise_pred[1]
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
                     
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = scheduler.step(torch.from_numpy(noise_pred), t, torch.from_numpy(latents)).prev_sample.numpy()
+                latents = scheduler_step(scheduler, noise_pred, t, latents)
                 #print("latents", latents)
 
                 if create_gif:
@@ -349,6 +391,7 @@ class ControlNetOpenPose(DiffusionPipeline):
                     progress_bar.update()                  
 
 
+        controlnet_guidance.report()
         if callback:
               callback(num_inference_steps, callback_userdata)
 
@@ -378,6 +421,13 @@ class ControlNetOpenPose(DiffusionPipeline):
 
         return image[0]
         
+    def prepare_guidance_cutoff(self):
+        """
+        Compile the batch 1 UNet and ControlNet the steps past a guidance cutoff run on, ahead of the first run using them
+        """
+        self.unet_batch_one.get(self.unet)
+        cond_only_controlnet(self.core, self.controlnet, self.controlnet_path)
+
     def _encode_prompt(self, prompt:Union[str, List[str]], num_images_per_prompt:int = 1, do_classifier_free_guidance:bool = True, negative_prompt:Union[str, List[str]] = None):
         """
         Encodes the prompt into text encoder hidden states.
@@ -402,8 +452,7 @@ class ControlNetOpenPose(DiffusionPipeline):
         )
         text_input_ids = text_inputs.input_ids
 
-        text_embeddings = self.text_encoder(
-            text_input_ids)[self.text_encoder_out]
+        text_embeddings = encode_prompt_cached(self.text_encoder, self.text_encoder_out, self.model_key, text_input_ids, prompt)
 
         # duplicate text embeddings for each generation per prompt
         if num_images_per_prompt != 1:
@@ -431,7 +480,7 @@ class ControlNetOpenPose(DiffusionPipeline):
                 return_tensors="np",
             )
             
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids)[self.text_encoder_out]
+            uncond_embeddings = encode_prompt_cached(self.text_encoder, self.text_encoder_out, self.model_key, uncond_input.input_ids, uncond_tokens)
 
             # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
             seq_len = uncond_embeddings.shape[1]
@@ -456,7 +505,7 @@ class ControlNetOpenPose(DiffusionPipeline):
            image: decoded by VAE decoder image
         """
         latents = 1 / 0.18215 * latents
-        image = self.vae_decoder(latents)[self.vae_decoder_out]
+        image = vae_decode(self.tiled_vae, self.vae_decoder, latents)
         #print("Decode_image shape", image.shape)
         (_, end_h), (_, end_w) = pad[1:3]
         h, w = image.shape[2:]
@@ -487,12 +536,12 @@ class ControlNetOpenPose(DiffusionPipeline):
 
  
         # scale the initial noise by the standard deviation required by the scheduler
-        if isinstance(scheduler, LMSDiscreteScheduler):
+        if isinstance(scheduler, (LMSDiscreteScheduler, LMSDiscreteSchedulerNP)):
             
-            latents = latents * scheduler.sigmas[0].numpy()
-        elif isinstance(scheduler, EulerDiscreteScheduler):
+            latents = latents * np.asarray(scheduler.sigmas[0])
+        elif isinstance(scheduler, (EulerDiscreteScheduler, EulerDiscreteSchedulerNP)):
             
-            latents = latents * scheduler.sigmas.max().numpy()
+            latents = latents * np.asarray(scheduler.sigmas.max())
         else:
             latents = latents * scheduler.init_noise_sigma
 
@@ -28,6 +28,13 @@ import glob
 import json
 import time
 
+from .controlnet_guidance import ControlNetGuidance, cond_only_controlnet
+from .inference_cache import encode_prompt_cached, time_projection_table, annotate_cached, BatchOneModel
+from .stage_graph import StageGraph
+from .schedulers_np import scheduler_step, LMSDiscreteSchedulerNP, EulerDiscreteSchedulerNP
+from .guidance import guidance_active
+from .tiled_vae import vae_decode
+
 from diffusers import StableDiffusionControlNetPipeline, ControlNetModel
 
 from openvino.runtime import Model, Core
@@ -173,6 +180,7 @@ class ControlNetScribble(DiffusionPipeline):
         
     
         
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')}) #adding caching to reduce init time
         print("Setting caching")
@@ -226,15 +234,20 @@ class ControlNetScribble(DiffusionPipeline):
         print("text encoder loaded in:", time.time() - start)
         start = time.time()
         self.controlnet = core.compile_model(controlnet, device[2])
+        self.controlnet_path = controlnet
         print("controlnet loaded in:", time.time() - start)
         start = time.time()
         self.unet = core.compile_model(unet, device[1])
+        self.unet_path = unet
         self.unet_out = self.unet.output(0)
         #self.unet_neg = core.compile_model(unet_neg, device[2])
         #self.unet_neg_out = self.unet_neg.output(0)
         print("unet loaded in:", time.time() - start)
         start = time.time()
         self.vae_decoder = core.compile_model(vae_decoder, device[2])
+        self.tiled_vae = None
+        # batch 1 UNet, for the steps past the guidance cutoff
+        self.unet_batch_one = BatchOneModel(self.core, self.unet_path)
         self.vae_decoder_out = self.vae_decoder.output(0)
         print("vae decoder loaded in:", time.time() - start)
         
@@ -256,19 +269,32 @@ class ControlNetScribble(DiffusionPipeline):
             callback = None,
             callback_userdata = None,
             do_hed = True,
-            scheduler=None
+            scheduler=None,
+            controlnet_cond_only = False,
+            control_guidance_start = 0.0,
+            control_guidance_end = 1.0,
+            guidance_cutoff = 1.0
     ):
+        """
+        controlnet_cond_only runs the ControlNet on the conditional half of the CFG batch only, the unconditional
+        branch gets zero residuals. The ControlNet only runs for the steps between control_guidance_start and
+        control_guidance_end (fractions of the steps), the UNet gets zero residuals for the others.
+        guidance_cutoff (fraction of the steps) stops classifier free guidance: the later steps only run
+        the conditional branch of the ControlNet and the UNet.
+        """
         do_classifier_free_guidance = guidance_scale > 1.0
-        # 2. Encode input prompt
-        text_embeddings = self._encode_prompt(prompt, negative_prompt=negative_prompt)
+        # 2. Encode input prompt, while the control image is annotated
+        image = image.convert("RGB")
+        stages = StageGraph()
+        stages.add("prompt", lambda: self._encode_prompt(prompt, negative_prompt=negative_prompt))
+        stages.add("control_image", lambda: Image.fromarray(annotate_cached(self.hed_estimator, self.model_key, "hed", image))
+                   if do_hed else image)
+        preprocessed = stages.run()
+        text_embeddings = preprocessed["prompt"]
 
         
         # 3. Preprocess image
-        image = image.convert("RGB")
-        if do_hed :
-            hed = self.hed_estimator(image)
-        else:
-            hed = image
+        hed = preprocessed["control_image"]
     
         orig_width, orig_height = hed.size
         
@@ -312,6 +338,14 @@ class ControlNetScribble(DiffusionPipeline):
         # num_warmup_steps = len(timesteps) - num_inference_steps * scheduler.order
         # with self.progress_bar(total=num_inference_steps) as progress_bar:
         #    for i, t in enumerate(timesteps):
+        controlnet_guidance = ControlNetGuidance(
+            self.controlnet, len(timesteps),
+            cond_controlnet=cond_only_controlnet(self.core, self.controlnet, self.controlnet_path)
+            if (controlnet_cond_only or guidance_cutoff < 1.0) and do_classifier_free_guidance else None,
+            guidance_start=control_guidance_start, guidance_end=control_guidance_end,
+            cond_only=controlnet_cond_only)
+        # compiled before the first step
+        unet_cond = self.unet_batch_one.get(self.unet) if do_classifier_free_guidance and guidance_cutoff < 1.0 else None
         num_warmup_steps = len(timesteps) - num_inference_steps * scheduler.order
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
@@ -322,29 +356,35 @@ class ControlNetScribble(DiffusionPipeline):
 
             # expand the latents if we are doing classifier free guidance
             #noise_pred = []
+                # past the guidance cutoff, the conditional branch alone on the batch 1 ControlNet and UNet
+                guided = do_classifier_free_guidance and guidance_active(i, len(timesteps), guidance_cutoff)
+                if do_classifier_free_guidance and not guided:
+                    unet, step_embeddings, step_control = unet_cond, text_embeddings[-1:], hed[-1:]
+                else:
+                    unet, step_embeddings, step_control = self.unet, text_embeddings, hed
                 latent_model_input = np.concatenate(
-                    [latents] * 2) if do_classifier_free_guidance else latents
+                    [latents] * 2) if guided else latents
                 latent_model_input = scheduler.scale_model_input(latent_model_input, t)
                 #print("latent_model_input", latent_model_input)
                 
              
                 
-                result = self.controlnet([latent_model_input, t, text_embeddings, hed])
+                result = controlnet_guidance(i, [latent_model_input, t, step_embeddings, step_control])
                 #print("result", result)
-                down_and_mid_blok_samples = [sample * controlnet_conditioning_scale for _, sample in result.items()]
+                down_and_mid_blok_samples = [sample * controlnet_conditioning_scale for _, sample in result]
                 
                 # predict the noise residual
-                noise_pred = self.unet([latent_model_input, t, text_embeddings, *down_and_mid_blok_samples])[self.unet_out]
+                noise_pred = unet([latent_model_input, t, step_embeddings, *down_and_mid_blok_samples])[unet.output(0)]
                 #print("noise_pred:", noise_pred)
 
 
                 # perform guidance
-                if do_classifier_free_guidance:
+                if guided:
                     noise_pred_uncond, noise_pred_text = noise_pred[0], noise_pred[1]
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
                     
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = scheduler.step(torch.from_numpy(noise_pred), t, torch.from_numpy(latents)).prev_sample.numpy()
+                latents = scheduler_step(scheduler, noise_pred, t, latents)
                 #print("latents", latents)
 
                 if create_gif:
@@ -354,6 +394,7 @@ class ControlNetScribble(DiffusionPipeline):
                 if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % scheduler.order == 0):
                     progress_bar.update()                    
 
+        controlnet_guidance.report()
         if callback:
               callback(num_inference_steps, callback_userdata)
 
@@ -383,6 +424,13 @@ class ControlNetScribble(DiffusionPipeline):
 
         return image[0]
         
+    def prepare_guidance_cutoff(self):
+        """
+        Compile the batch 1 UNet and ControlNet the steps past a guidance cutoff run on, ahead of the first run using them
+        """
+        self.unet_batch_one.get(self.unet)
+        cond_only_controlnet(self.core, self.controlnet, self.controlnet_path)
+
     def _encode_prompt(self, prompt:Union[str, List[str]], num_images_per_prompt:int = 1, do_classifier_free_guidance:bool = True, negative_prompt:Union[str, List[str]] = None):
         """
         Encodes the prompt into text encoder hidden states.
@@ -407,8 +455,7 @@ class ControlNetScribble(DiffusionPipeline):
         )
         text_input_ids = text_inputs.input_ids
 
-        text_embeddings = self.text_encoder(
-            text_input_ids)[self.text_encoder_out]
+        text_embeddings = encode_prompt_cached(self.text_encoder, self.text_encoder_out, self.model_key, text_input_ids, prompt)
 
         # duplicate text embeddings for each generation per prompt
         if num_images_per_prompt != 1:
@@ -436,7 +483,7 @@ class ControlNetScribble(DiffusionPipeline):
                 return_tensors="np",
             )
             
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids)[self.text_encoder_out]
+            uncond_embeddings = encode_prompt_cached(self.text_encoder, self.text_encoder_out, self.model_key, uncond_input.input_ids, uncond_tokens)
 
             # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
             seq_len = uncond_embeddings.shape[1]
@@ -461,7 +508,7 @@ class ControlNetScribble(DiffusionPipeline):
            image: decoded by VAE decoder image
         """
         latents = 1 / 0.18215 * latents
-        image = self.vae_decoder(latents)[self.vae_decoder_out]
+        image = vae_decode(self.tiled_vae, self.vae_decoder, latents)
         #print("Decode_image shape", image.shape)
         (_, end_h), (_, end_w) = pad[1:3]
         h, w = image.shape[2:]
@@ -491,12 +538,12 @@ class ControlNetScribble(DiffusionPipeline):
        
 
         # scale the initial noise by the standard deviation required by the scheduler
-        if isinstance(scheduler, LMSDiscreteScheduler):
+        if isinstance(scheduler, (LMSDiscreteScheduler, LMSDiscreteSchedulerNP)):
             
-            latents = latents * scheduler.sigmas[0].numpy()
-        elif isinstance(scheduler, EulerDiscreteScheduler):
+            latents = latents * np.asarray(scheduler.sigmas[0])
+        elif isinstance(scheduler, (EulerDiscreteScheduler, EulerDiscreteSchedulerNP)):
             
-            latents = latents * scheduler.sigmas.max().numpy()
+            latents = latents * np.asarray(scheduler.sigmas.max())
         else:
             latents = latents * scheduler.init_noise_sigma
 
@@ -527,6 +574,7 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
         self.swap = swap
    
         
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')}) #adding caching to reduce init time
         print("Setting caching")
@@ -598,6 +646,7 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
         start = time.time()
         
         self.controlnet = core.compile_model(controlnet, "GPU")
+        self.controlnet_path = controlnet
         print("controlnet loaded in:", time.time() - start)
         start = time.time()
         
@@ -649,6 +698,7 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
 
         start = time.time()
         self.vae_decoder = core.compile_model(vae_decoder, device[3])
+        self.tiled_vae = None
         self.vae_decoder_out = self.vae_decoder.output(0)
         print("vae decoder loaded in:", time.time() - start)
         
@@ -670,22 +720,35 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
             model = None,
             callback = None,
             callback_userdata = None,
-            do_hed = True
+            do_hed = True,
             #scheduler=None,
+            controlnet_cond_only = False,
+            control_guidance_start = 0.0,
+            control_guidance_end = 1.0,
+            guidance_cutoff = 1.0
     ):
+        """
+        controlnet_cond_only runs the ControlNet on the conditional half of the CFG batch only, the unconditional
+        branch gets zero residuals. The ControlNet only runs for the steps between control_guidance_start and
+        control_guidance_end (fractions of the steps), the UNet gets zero residuals for the others.
+        guidance_cutoff (fraction of the steps) stops classifier free guidance: the later steps only run
+        the conditional branch of the ControlNet and the UNet.
+        """
         
         
         do_classifier_free_guidance = guidance_scale > 1.0
-        # 2. Encode input prompt
-        text_embeddings = self._encode_prompt(prompt, negative_prompt=negative_prompt)
+        # 2. Encode input prompt, while the control image is annotated
+        image = image.convert("RGB")
+        stages = StageGraph()
+        stages.add("prompt", lambda: self._encode_prompt(prompt, negative_prompt=negative_prompt))
+        stages.add("control_image", lambda: Image.fromarray(annotate_cached(self.hed_estimator, self.model_key, "hed", image))
+                   if do_hed else image)
+        preprocessed = stages.run()
+        text_embeddings = preprocessed["prompt"]
 
         
         # 3. Preprocess image
-        image = image.convert("RGB")
-        if do_hed :
-            hed = self.hed_estimator(image)
-        else:
-            hed = image
+        hed = preprocessed["control_image"]
     
         orig_width, orig_height = hed.size
         
@@ -732,6 +795,14 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
 
         # 7. Denoising loop
 
+        time_proj_table = time_projection_table(self.unet_time_proj, self.model_key, timesteps, lambda t: {"timestep" : t})
+        controlnet_guidance = ControlNetGuidance(
+            self.controlnet, len(timesteps),
+            cond_controlnet=cond_only_controlnet(self.core, self.controlnet, self.controlnet_path)
+            if (controlnet_cond_only or guidance_cutoff < 1.0) and do_classifier_free_guidance else None,
+            guidance_start=control_guidance_start, guidance_end=control_guidance_end,
+            cond_only=controlnet_cond_only,
+            infer_request=self.infer_request_controlnet)
         num_warmup_steps = len(timesteps) - num_inference_steps * scheduler.order
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
@@ -753,13 +824,13 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
        
                 #result = self.controlnet([latent_model_input_2, t, text_embeddings, pose])  
                 controlnet_dict = {"sample":latent_model_input_2, "timestep":t, "encoder_hidden_states":text_embeddings, "controlnet_cond":hed}
-                result = self.infer_request_controlnet.infer(controlnet_dict, share_outputs = True)
+                guided = do_classifier_free_guidance and guidance_active(i, len(timesteps), guidance_cutoff)
+                result = controlnet_guidance(i, controlnet_dict, cond_only=controlnet_cond_only or not guided)
 
                 tensor_dict_neg = {}
                 tensor_dict = {}
 
-                for k,v in result.items():
-                    tensor_name = next(iter(k.names))
+                for tensor_name, v in result:
                     #print("tensor_name--", tensor_name)
                     vneg = np.expand_dims(v[0], axis=0)
                     tensor_dict_neg[tensor_name] = vneg #controlnet_conditioning_scale * vneg #.astype(np.float32)
@@ -770,21 +841,20 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
                 
             
                     
-                time_proj_dict = {"timestep" : t}
-                self.infer_request_time_proj.start_async(time_proj_dict,share_inputs = True)
-                self.infer_request_time_proj.wait()
-                time_proj = self.infer_request_time_proj.get_output_tensor(0).data.astype(np.float32) 
+                time_proj = time_proj_table[i]
                 
-                ##### NEGATIVE PIPELINE #####
-                input_dict_neg = {"sample":latent_model_input, "time_proj": time_proj, "encoder_hidden_states":np.expand_dims(text_embeddings[0], axis=0)}
-                input_dict_neg.update(tensor_dict_neg)
+                # past the guidance cutoff the negative request stays idle
+                if guided:
+                    ##### NEGATIVE PIPELINE #####
+                    input_dict_neg = {"sample":latent_model_input, "time_proj": time_proj, "encoder_hidden_states":np.expand_dims(text_embeddings[0], axis=0)}
+                    input_dict_neg.update(tensor_dict_neg)
                 
-                if self.npu_flag_neg:
-                    input_dict_neg_final = {k: v for k, v in sorted(input_dict_neg.items(), key=lambda x: x[0])}
-                else:
-                    input_dict_neg_final = input_dict_neg
+                    if self.npu_flag_neg:
+                        input_dict_neg_final = {k: v for k, v in sorted(input_dict_neg.items(), key=lambda x: x[0])}
+                    else:
+                        input_dict_neg_final = input_dict_neg
                 
-                self.infer_request_neg.start_async(input_dict_neg_final, share_inputs = True)
+                    self.infer_request_neg.start_async(input_dict_neg_final, share_inputs = True)
                 
                 
                 ##### POSITIVE PIPELINE #####
@@ -796,23 +866,24 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
                     input_dict_final = input_dict
 
                 self.infer_request.start_async(input_dict_final,share_inputs = True)
-                self.infer_request_neg.wait()
-                self.infer_request.wait()                    
-                
-                noise_pred_neg = self.infer_request_neg.get_output_tensor(0)
-                noise_pred_pos = self.infer_request.get_output_tensor(0) 
-
-                noise_pred.append(noise_pred_neg.data.astype(np.float32))
-                noise_pred.append(noise_pred_pos.data.astype(np.float32))  
+                if guided:
+                    self.infer_request_neg.wait()
+                    noise_pred_neg = self.infer_request_neg.get_output_tensor(0)
+                    noise_pred.append(noise_pred_neg.data.astype(np.float32))
+                self.infer_request.wait()
+                noise_pred_pos = self.infer_request.get_output_tensor(0)
+                noise_pred.append(noise_pred_pos.data.astype(np.float32))
 
                 # perform guidance
-                if do_classifier_free_guidance:
+                if guided:
                     noise_pred_uncond, noise_pred_text = noise_pred[0], noise_pred[1]
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)   
+                else:
+                    noise_pred = noise_pred[0]
                     
                     
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = scheduler.step(torch.from_numpy(noise_pred), t, torch.from_numpy(latents)).prev_sample.numpy()
+                latents = scheduler_step(scheduler, noise_pred, t, latents)
                 #print("latents", latents)
 
                 if create_gif:
@@ -821,6 +892,7 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
                 if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % scheduler.order == 0):
                     progress_bar.update()                    
 
+        controlnet_guidance.report()
         if callback:
               callback(num_inference_steps, callback_userdata)
 
@@ -887,8 +959,7 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
         )
         text_input_ids = text_inputs.input_ids
 
-        text_embeddings = self.text_encoder(
-            text_input_ids)[self.text_encoder_out]
+        text_embeddings = encode_prompt_cached(self.text_encoder, self.text_encoder_out, self.model_key, text_input_ids, prompt)
 
         # duplicate text embeddings for each generation per prompt
         if num_images_per_prompt != 1:
@@ -916,7 +987,7 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
                 return_tensors="np",
             )
             
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids)[self.text_encoder_out]
+            uncond_embeddings = encode_prompt_cached(self.text_encoder, self.text_encoder_out, self.model_key, uncond_input.input_ids, uncond_tokens)
 
             # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
             seq_len = uncond_embeddings.shape[1]
@@ -941,7 +1012,7 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
            image: decoded by VAE decoder image
         """
         latents = 1 / 0.18215 * latents
-        image = self.vae_decoder(latents)[self.vae_decoder_out]
+        image = vae_decode(self.tiled_vae, self.vae_decoder, latents)
         #print("Decode_image shape", image.shape)
         (_, end_h), (_, end_w) = pad[1:3]
         h, w = image.shape[2:]
@@ -970,12 +1041,12 @@ class ControlNetScribbleAdvanced(DiffusionPipeline):
         latents = randn_tensor(shape, np.float32)
  
         # scale the initial noise by the standard deviation required by the scheduler
-        if isinstance(scheduler, LMSDiscreteScheduler):
+        if isinstance(scheduler, (LMSDiscreteScheduler, LMSDiscreteSchedulerNP)):
             
-            latents = latents * scheduler.sigmas[0].numpy()
-        elif isinstance(scheduler, EulerDiscreteScheduler):
+            latents = latents * np.asarray(scheduler.sigmas[0])
+        elif isinstance(scheduler, (EulerDiscreteScheduler, EulerDiscreteSchedulerNP)):
             
-            latents = latents * scheduler.sigmas.max().numpy()
+            latents = latents * np.asarray(scheduler.sigmas.max())
         else:
             latents = latents * scheduler.init_noise_sigma
 
@@ -0,0 +1,15 @@
+"""
+Copyright(C) 2022-2023 Intel Corporation
+SPDX - License - Identifier: Apache - 2.0
+
+Classifier free guidance policy of the denoising loops: guidance is truncated to the first steps of
+a run, where it shapes the image, and the late steps only run the conditional UNet.
+"""
+
+
+def guidance_active(step, num_steps, guidance_cutoff=1.0):
+    """
+    Whether classifier free guidance (the unconditional UNet pass) runs at a step: only the
+    first guidance_cutoff fraction of the steps is guided, the late steps only run the conditional UNet.
+    """
+    return step < guidance_cutoff * num_steps
@@ -0,0 +1,426 @@
+"""
+Copyright(C) 2022-2023 Intel Corporation
+SPDX - License - Identifier: Apache - 2.0
+
+"""
+import hashlib
+import os
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+
+class LRUCache:
+    """
+    Size bounded least-recently-used cache of numpy arrays, shared by all the engines in a process.
+
+    Parameters:
+        max_entries (int): number of arrays kept in memory
+        max_bytes (int, *optional*): memory bound for the cached arrays
+        disk_dir (str, *optional*): when set, every entry is also written there as .npy, so entries
+            evicted from memory (or computed by an earlier process) are loaded back instead of recomputed
+    """
+    def __init__(self, max_entries=64, max_bytes=None, disk_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def configure(self, max_entries=None, max_bytes=None, disk_dir=None):
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if disk_dir is not None:
+                os.makedirs(disk_dir, exist_ok=True)
+                self.disk_dir = disk_dir
+            self._evict()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".npy")
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, value = self.entries.popitem(last=False)
+            self.nbytes -= value.nbytes
+
+    def _insert(self, key, value):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        self._evict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+            if self.disk_dir is not None:
+                path = self._disk_path(key)
+                if os.path.isfile(path):
+                    try:
+                        value = np.load(path)
+                    except (OSError, ValueError):
+                        value = None
+                    if value is not None:
+                        self._insert(key, value)
+                        self.hits += 1
+                        return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        # keep our own copy, the value may be a view on an OpenVINO output tensor
+        value = np.array(value, copy=True)
+        value.setflags(write=False)
+        with self.lock:
+            self._insert(key, value)
+            if self.disk_dir is not None:
+                try:
+                    np.save(self._disk_path(key), value)
+                except OSError as error:
+                    print("Could not write cache entry:", error)
+        return value
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+# Text encoder outputs, keyed by model, token ids and prompt text
+prompt_embedding_cache = LRUCache(max_entries=64)
+
+
+def encode_prompt_cached(text_encoder, output, model_key, input_ids, text):
+    """
+    Run the text encoder through the prompt embedding cache.
+
+    Parameters:
+        text_encoder: compiled text encoder
+        output: output port (or index) of the text encoder
+        model_key (str): identifies the model the text encoder belongs to, usually the model folder
+        input_ids (np.ndarray or torch.Tensor): tokenized prompt
+        text (str or List[str]): prompt that was tokenized
+    Returns:
+        text_embeddings (np.ndarray): read-only text encoder hidden states
+    """
+    input_ids = np.asarray(input_ids)
+    key = (str(model_key), input_ids.shape, tuple(int(i) for i in input_ids.ravel()), repr(text))
+    # an infer request of its own, the prompt and the negative prompt may be encoded at the same time
+    return prompt_embedding_cache.get_or_compute(key, lambda: text_encoder.create_infer_request().infer([input_ids])[output])
+
+
+# Time projections of whole timestep schedules, keyed by model and timesteps
+time_proj_cache = LRUCache(max_entries=32)
+
+
+def time_projection_table(time_proj_model, model_key, timesteps, make_inputs, max_requests=4):
+    """
+    Run the time projection model for every timestep of the schedule before the denoising loop,
+    so the UNet can be started right away at each step.
+
+    Parameters:
+        time_proj_model: compiled unet_time_proj model
+        model_key (str): identifies the model the time projection belongs to, usually the model folder
+        timesteps (List[float] or torch.Tensor): scheduler timesteps
+        make_inputs (Callable): returns the time projection input dict for one timestep
+        max_requests (int): number of infer requests kept in flight
+    Returns:
+        table (np.ndarray): read-only float32 time projections, table[i] is used at step i
+    """
+    timesteps = list(timesteps)
+    key = (str(model_key), tuple(float(t) for t in timesteps))
+
+    def compute():
+        requests = [time_proj_model.create_infer_request() for _ in range(max(1, min(max_requests, len(timesteps))))]
+        table = []
+        for start in range(0, len(timesteps), len(requests)):
+            chunk = timesteps[start:start + len(requests)]
+            for request, t in zip(requests, chunk):
+                request.start_async(make_inputs(t))
+            for request, _ in zip(requests, chunk):
+                request.wait()
+                table.append(request.get_output_tensor(0).data.astype(np.float32))
+        return np.stack(table)
+
+    return time_proj_cache.get_or_compute(key, compute)
+
+
+# bytes of the .bin read at its start, middle and end for the model key
+WEIGHTS_SAMPLE_BYTES = 64 * 1024
+
+
+class CompiledModelCache:
+    """
+    Least-recently-used cache of compiled models, keyed by model hash, input shapes and device.
+    Compiling goes through the CACHE_DIR of the core, so a variant evicted here (or compiled by an
+    earlier process) is imported back from the blob instead of compiled from scratch.
+
+    Parameters:
+        max_entries (int): number of compiled variants (shapes, batch sizes, devices) kept alive per
+            model, so the variants of one model don't evict the ones of the other models a run needs
+    """
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.attachments = {}
+        self.models = OrderedDict()
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def configure(self, max_entries=None):
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            self._evict()
+
+    def _evict(self):
+        # the first element of the key is the model
+        counts = Counter(key[0] for key in self.entries)
+        for key in list(self.entries):
+            if counts[key[0]] > self.max_entries:
+                counts[key[0]] -= 1
+                del self.entries[key]
+                self.attachments.pop(key, None)
+        while len(self.models) > self.max_entries:
+            self.models.popitem(last=False)
+
+    def _get(self, table, key):
+        with self.lock:
+            value = table.get(key)
+            if value is not None:
+                table.move_to_end(key)
+            return value
+
+    def _put(self, table, key, value):
+        # compiled or loaded outside the lock: a thread that did it first for the same key wins
+        with self.lock:
+            existing = table.get(key)
+            if existing is not None:
+                table.move_to_end(key)
+                return existing
+            table[key] = value
+            self._evict()
+        return value
+
+    def model_hash(self, xml_path):
+        """
+        Key of the model files: hash of the topology, and of the weights metadata (size, mtime, inode)
+        with a sample of their content. It is a metadata key, hashing the whole .bin would take seconds
+        for a UNet: weights rewritten in place with the same size, mtime and sampled bytes are not told
+        apart. Recomputed only when the metadata of the files changes.
+        """
+        bin_path = os.path.splitext(xml_path)[0] + ".bin"
+        stats = tuple((s.st_size, s.st_mtime_ns, s.st_ino) for s in (os.stat(p) for p in (xml_path, bin_path)
+                                                                      if os.path.isfile(p)))
+        with self.lock:
+            cached = self.hashes.get(xml_path)
+        if cached is not None and cached[0] == stats:
+            return cached[1]
+        digest = hashlib.sha1()
+        with open(xml_path, "rb") as f:
+            digest.update(f.read())
+        digest.update(repr(stats[1:]).encode("utf-8"))
+        if os.path.isfile(bin_path):
+            size = os.path.getsize(bin_path)
+            with open(bin_path, "rb") as f:
+                for offset in sorted({0, max(0, (size - WEIGHTS_SAMPLE_BYTES) // 2), max(0, size - WEIGHTS_SAMPLE_BYTES)}):
+                    f.seek(offset)
+                    digest.update(f.read(WEIGHTS_SAMPLE_BYTES))
+        with self.lock:
+            self.hashes[xml_path] = (stats, digest.hexdigest())
+        return digest.hexdigest()
+
+    def compile(self, core, xml_path, device, shapes, prepare=None, variant=None):
+        """
+        Parameters:
+            core (openvino.runtime.Core): core used to read and compile the model
+            xml_path (str): OpenVINO IR of the model
+            device (str): device the model is compiled for
+            shapes (Dict[str, List[int]]): static shapes of the inputs to reshape, by input name
+            prepare (Callable, *optional*): returns the model to compile from the reshaped one, e.g. with
+                pre/post-processing added
+            variant (*optional*): what prepare does, part of the key
+        Returns:
+            compiled model
+        """
+        key = (self.model_hash(xml_path), tuple(sorted((name, tuple(shape)) for name, shape in shapes.items())), device)
+        if variant is not None:
+            key += (variant,)
+        compiled = self._get(self.entries, key)
+        if compiled is not None:
+            return compiled
+
+        # compiled without the lock, so the other models of the cache are still served meanwhile
+        model = core.read_model(xml_path)
+        model.reshape({name: list(shape) for name, shape in shapes.items()})
+        if prepare is not None:
+            model = prepare(model)
+        print("Compiling %s for %s on %s" % (os.path.basename(xml_path), shapes, device))
+        return self._put(self.entries, key, core.compile_model(model, device))
+
+    def attached(self, compiled):
+        """
+        Dict kept with the cache entry of compiled, e.g. for its infer requests: it is dropped with the
+        entry, so what it holds doesn't keep an evicted model alive. A new, unattached dict when
+        compiled is not in the cache.
+        """
+        with self.lock:
+            for key, entry in self.entries.items():
+                if entry is compiled:
+                    return self.attachments.setdefault(key, {})
+        return {}
+
+    def read(self, core, xml_path):
+        """
+        The model as read from xml_path, to look at its inputs before compile() without reading it
+        again on every run. It must not be reshaped.
+        """
+        key = self.model_hash(xml_path)
+        model = self._get(self.models, key)
+        if model is None:
+            model = self._put(self.models, key, core.read_model(xml_path))
+        return model
+
+    def get_or_load(self, key, load):
+        """
+        Same bounded cache for what compiles its model itself, e.g. a model wrapper owning its
+        compiled model and infer requests.
+
+        Parameters:
+            key (tuple): model, input shape and device the loaded object depends on
+            load (Callable): loads it on a miss
+        """
+        loaded = self._get(self.entries, key)
+        if loaded is None:
+            loaded = self._put(self.entries, key, load())
+        return loaded
+
+
+# UNet / VAE variants reshaped to requested resolutions, batch 1 variants of batch 2 models, per model
+compiled_model_cache = CompiledModelCache(max_entries=4)
+
+
+def compile_batch_one(core, compiled, xml_path):
+    """
+    Batch 1 variant of a model compiled for the CFG batch of 2, to run the conditional branch alone.
+    The static inputs of batch 2 are reshaped, on the device the model runs on.
+
+    Parameters:
+        core (openvino.runtime.Core): core used to read and compile the model
+        compiled: the compiled batch 2 model
+        xml_path (str): OpenVINO IR of the model
+    Returns:
+        compiled model, the same one when its batch is dynamic
+    """
+    shapes = {}
+    for port in compiled.inputs:
+        shape = port.partial_shape
+        if shape.rank.get_length() > 0 and shape.is_static and shape[0].get_length() == 2:
+            shapes[port.any_name] = [1] + [dim.get_length() for dim in shape][1:]
+    if not shapes:
+        return compiled
+
+    try:
+        device = compiled.get_property("EXECUTION_DEVICES")[0]
+    except Exception:
+        device = "CPU"
+    return compiled_model_cache.compile(core, xml_path, device, shapes)
+
+
+class BatchOneModel:
+    """
+    compile_batch_one of the batch 2 model of an engine, kept on the engine: it is compiled when the
+    engine is prepared for a guidance cutoff, or before the first step of the first run past one, not
+    in the middle of the denoising loop. It is compiled again only when the batch 2 model changes
+    (e.g. switched to another resolution).
+
+    Parameters:
+        core (openvino.runtime.Core): core used to read and compile the model
+        xml_path (str): OpenVINO IR of the model
+    """
+    def __init__(self, core, xml_path):
+        self.core = core
+        self.xml_path = xml_path
+        self.source = None
+        self.compiled = None
+
+    def get(self, compiled):
+        """
+        Parameters:
+            compiled: the compiled batch 2 model
+        Returns:
+            its batch 1 variant
+        """
+        if compiled is not self.source:
+            self.compiled = compile_batch_one(self.core, compiled, self.xml_path)
+            self.source = compiled
+        return self.compiled
+
+
+def content_key(array):
+    """
+    Hashable key of an array (or PIL image) content
+    """
+    array = np.ascontiguousarray(np.asarray(array))
+    return array.shape, str(array.dtype), hashlib.sha1(array.data).hexdigest()
+
+
+# VAE encoder outputs (moments, so fresh noise is still sampled per run) of init, masked and
+# reference images, keyed by model, image content and encoding parameters
+vae_moments_cache = LRUCache(max_entries=16, max_bytes=512 * 1024 * 1024)
+
+# Annotator outputs (pose, HED) of control images, keyed by model, annotator and image content
+control_image_cache = LRUCache(max_entries=8)
+
+
+def encode_image_cached(encode, model_key, image, params=()):
+    """
+    Run the VAE encoder through vae_moments_cache.
+
+    Parameters:
+        encode (Callable): runs the VAE encoder on image
+        model_key (str): identifies the model the VAE belongs to, usually the model folder
+        image (np.ndarray or torch.Tensor): NCHW preprocessed image
+        params (tuple): anything else the encoder output depends on
+    Returns:
+        moments (np.ndarray): read-only VAE encoder output
+    """
+    key = (str(model_key), content_key(image), params)
+    return vae_moments_cache.get_or_compute(key, lambda: encode(image))
+
+
+def annotate_cached(annotator, model_key, name, image, params=()):
+    """
+    Run a ControlNet annotator through control_image_cache.
+
+    Parameters:
+        annotator (Callable): takes and returns a PIL image
+        model_key (str): identifies the model the annotator belongs to, usually the model folder
+        name (str): annotator name
+        image (PIL.Image.Image): RGB input image
+        params (tuple): annotator parameters
+    Returns:
+        control_image (np.ndarray): read-only annotator output, as an array
+    """
+    key = (str(model_key), name, content_key(image), params)
+    return control_image_cache.get_or_compute(key, lambda: np.asarray(annotator(image)))
@@ -0,0 +1,109 @@
+"""
+Copyright(C) 2022-2023 Intel Corporation
+SPDX - License - Identifier: Apache - 2.0
+
+Crop-to-mask inpainting: only the bounding box of the mask (plus some context) is inpainted at the
+engine resolution, and the result is composited back into the full resolution image.
+"""
+import numpy as np
+import PIL
+from PIL import Image, ImageFilter
+
+
+def mask_crop_box(mask_image, margin, aspect):
+    """
+    Region to inpaint for a mask
+
+    Parameters:
+        mask_image (PIL.Image.Image): inpainting mask, white where the image is regenerated
+        margin (int): context kept around the mask bounding box, in image pixels
+        aspect (float): width / height of the engine resolution, the box is grown to it
+    Returns:
+        box (tuple): (left, top, right, bottom), or None when the mask is empty, the box covers the whole
+            image, or no box with the engine aspect ratio fits in the image around the mask and margin
+    """
+    mask = np.array(mask_image.convert("L")) >= 128
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+
+    image_height, image_width = mask.shape
+    top, bottom = rows[0] - margin, rows[-1] + 1 + margin
+    left, right = cols[0] - margin, cols[-1] + 1 + margin
+    # what the box must keep, inside the image
+    needed = (max(0, left), max(0, top), min(image_width, right), min(image_height, bottom))
+
+    # grow the short side to the engine aspect ratio, so the crop isn't distorted when resized
+    width, height = right - left, bottom - top
+    if width < height * aspect:
+        grow = int(round(height * aspect)) - width
+        left, right = left - grow // 2, right + grow - grow // 2
+    else:
+        grow = int(round(width / aspect)) - height
+        top, bottom = top - grow // 2, bottom + grow - grow // 2
+
+    def fit(start, end, length):
+        # shift the box inside the image, then clip what still doesn't fit
+        if start < 0:
+            start, end = 0, end - start
+        if end > length:
+            start, end = start - (end - length), length
+        return max(0, start), end
+
+    def shrink(length, needed_start, needed_end, image_length):
+        # a box of the given length around the needed span, inside the image, None when the span is longer
+        if needed_end - needed_start > length:
+            return None
+        start = int(round((needed_start + needed_end - length) / 2))
+        start = min(max(start, needed_end - length, 0), needed_start, image_length - length)
+        return start, start + length
+
+    left, right = fit(left, right, image_width)
+    top, bottom = fit(top, bottom, image_height)
+
+    # a side clipped to the image: shrink the other one back to the aspect ratio
+    width, height = right - left, bottom - top
+    if width + 1 < height * aspect:
+        span = shrink(int(round(width / aspect)), needed[1], needed[3], image_height)
+        if span is None:
+            return None
+        top, bottom = span
+    elif height + 1 < width / aspect:
+        span = shrink(int(round(height * aspect)), needed[0], needed[2], image_width)
+        if span is None:
+            return None
+        left, right = span
+
+    if (left, top, right, bottom) == (0, 0, image_width, image_height):
+        return None
+    return int(left), int(top), int(right), int(bottom)
+
+
+def paste_inpainted(image, mask_image, box, result, feather=8):
+    """
+    Composite an inpainted crop back into the full image. Outside the (feathered) mask the original
+    pixels are kept as is.
+
+    Parameters:
+        image (PIL.Image.Image): full resolution source image
+        mask_image (PIL.Image.Image): full resolution inpainting mask
+        box (tuple): crop box returned by mask_crop_box
+        result (np.ndarray): BGR uint8 inpainted crop, at the engine resolution
+        feather (int): width of the blend at the mask border, in image pixels
+    Returns:
+        image (np.ndarray): BGR uint8 image at the source resolution
+    """
+    left, top, right, bottom = box
+    crop = Image.fromarray(np.ascontiguousarray(result[:, :, ::-1])).resize((right - left, bottom - top),
+                                                                            resample=PIL.Image.LANCZOS)
+    alpha = mask_image.convert("L").crop(box).point(lambda v: 255 if v >= 128 else 0)
+    if feather > 0:
+        # grow the mask before blurring, so the inpainted region itself stays fully opaque
+        alpha = alpha.filter(ImageFilter.MaxFilter(2 * (feather // 2) + 1)).filter(ImageFilter.GaussianBlur(feather / 2))
+
+    output = np.array(image.convert("RGB"), dtype=np.float32)
+    alpha = np.array(alpha, dtype=np.float32)[:, :, None] / 255.0
+    region = output[top:bottom, left:right]
+    region += alpha * (np.array(crop, dtype=np.float32) - region)
+    return np.ascontiguousarray(np.clip(output + 0.5, 0, 255).astype(np.uint8)[:, :, ::-1])
@@ -0,0 +1,806 @@
+"""
+Copyright(C) 2022-2023 Intel Corporation
+SPDX - License - Identifier: Apache - 2.0
+
+NumPy implementations of the diffusers schedulers used by the stable diffusion server
+(Euler discrete, LMS discrete, DDIM, LCM, and the DPM-Solver++ 2M / UniPC multistep solvers).
+
+They follow the diffusers implementations step by step in float32, but take and return
+np.ndarray, so the denoising loops don't have to go through torch at every step.
+The engines call them through scheduler_step() / scheduler_add_noise(), which also accept
+the original diffusers schedulers.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+
+
+class SchedulerOutput(dict):
+    """
+    Output of NumpyScheduler.step, accessible both as output["prev_sample"] and output.prev_sample
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def betas_for_schedule(beta_start, beta_end, beta_schedule, num_train_timesteps):
+    if beta_schedule == "linear":
+        return np.linspace(beta_start, beta_end, num_train_timesteps, dtype=np.float32)
+    if beta_schedule == "scaled_linear":
+        # this schedule is very specific to the latent diffusion model.
+        return np.linspace(beta_start**0.5, beta_end**0.5, num_train_timesteps, dtype=np.float32) ** 2
+    raise NotImplementedError(f"{beta_schedule} is not implemented")
+
+
+def spaced_timesteps(timestep_spacing, num_train_timesteps, num_inference_steps, steps_offset=0):
+    """
+    Timesteps of the inference schedule, from the noisiest to the last one (same as diffusers "timestep_spacing")
+    """
+    if timestep_spacing == "linspace":
+        return np.linspace(0, num_train_timesteps - 1, num_inference_steps, dtype=np.float32)[::-1].copy()
+    if timestep_spacing == "leading":
+        step_ratio = num_train_timesteps // num_inference_steps
+        timesteps = (np.arange(0, num_inference_steps) * step_ratio).round()[::-1].copy().astype(np.float32)
+        return timesteps + steps_offset
+    if timestep_spacing == "trailing":
+        step_ratio = num_train_timesteps / num_inference_steps
+        return np.arange(num_train_timesteps, 0, -step_ratio).round().copy().astype(np.float32) - 1
+    raise ValueError(f"{timestep_spacing} is not supported. Please choose one of 'linspace', 'leading' or 'trailing'.")
+
+
+class NumpyScheduler:
+    """
+    Common parts of the NumPy schedulers: beta schedule, config and scratch buffers.
+    """
+    order = 1
+
+    def __init__(self, num_train_timesteps=1000, beta_start=0.0001, beta_end=0.02, beta_schedule="linear", **config):
+        self.config = SimpleNamespace(num_train_timesteps=num_train_timesteps, beta_start=beta_start,
+                                      beta_end=beta_end, beta_schedule=beta_schedule, **config)
+        self.betas = betas_for_schedule(beta_start, beta_end, beta_schedule, num_train_timesteps)
+        self.alphas = 1.0 - self.betas
+        self.alphas_cumprod = np.cumprod(self.alphas, axis=0)
+        self.num_inference_steps = None
+        self.step_index = None
+        self._buffers = {}
+
+    def buffer(self, name, like):
+        """
+        Scratch float32 array shaped like `like`, allocated once and reused at every step.
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != like.shape:
+            buffer = np.empty(like.shape, dtype=np.float32)
+            self._buffers[name] = buffer
+        return buffer
+
+    def index_for_timestep(self, timestep):
+        indices = np.flatnonzero(self.timesteps == np.asarray(timestep))
+        # The sigma index that is taken for the **very** first `step`
+        # is always the second index (or the last index if there is only 1)
+        # This way we can ensure we don't accidentally skip a sigma in
+        # case we start in the middle of the denoising schedule (e.g. for image-to-image)
+        pos = 1 if len(indices) > 1 else 0
+        return int(indices[pos])
+
+    def _init_step_index(self, timestep):
+        self.step_index = self.index_for_timestep(timestep)
+
+    def scale_model_input(self, sample, timestep=None):
+        return sample
+
+
+class SigmaScheduler(NumpyScheduler):
+    """
+    Schedulers working on the k-diffusion sigmas (Euler and LMS)
+    """
+    def __init__(self, num_train_timesteps=1000, beta_start=0.0001, beta_end=0.02, beta_schedule="linear",
+                 prediction_type="epsilon", timestep_spacing="linspace", steps_offset=0, **config):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule, prediction_type=prediction_type,
+                         timestep_spacing=timestep_spacing, steps_offset=steps_offset, **config)
+        sigmas = (((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)[::-1]
+        self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
+        self.timesteps = np.linspace(0, num_train_timesteps - 1, num_train_timesteps, dtype=np.float32)[::-1].copy()
+
+    @property
+    def init_noise_sigma(self):
+        # standard deviation of the initial noise distribution
+        max_sigma = self.sigmas.max()
+        if self.config.timestep_spacing in ["linspace", "trailing"]:
+            return max_sigma
+        return (max_sigma**2 + 1) ** 0.5
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        self.num_inference_steps = num_inference_steps
+        timesteps = spaced_timesteps(self.config.timestep_spacing, self.config.num_train_timesteps,
+                                     num_inference_steps, self.config.steps_offset)
+
+        sigmas = ((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5
+        sigmas = np.interp(timesteps, np.arange(0, len(sigmas)), sigmas)
+        self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
+        self.timesteps = timesteps.astype(np.float32)
+        self.step_index = None
+
+    def scale_model_input(self, sample, timestep):
+        """
+        Scales the denoising model input by `(sigma**2 + 1) ** 0.5` to match the k-diffusion algorithm.
+        """
+        if self.step_index is None:
+            self._init_step_index(timestep)
+        sigma = self.sigmas[self.step_index]
+        return np.asarray(sample) / ((sigma**2 + 1) ** 0.5)
+
+    def derivative(self, model_output, sample, sigma):
+        """
+        Writes (sample - pred_original_sample) / sigma into a scratch buffer and returns it.
+        """
+        derivative = self.buffer("derivative", sample)
+        if self.config.prediction_type == "epsilon":
+            np.multiply(sigma, model_output, out=derivative)
+            np.subtract(sample, derivative, out=derivative)
+        elif self.config.prediction_type == "v_prediction":
+            # * c_out + input * c_skip
+            scaled_sample = self.buffer("scaled_sample", sample)
+            np.divide(sample, sigma**2 + 1, out=scaled_sample)
+            np.multiply(model_output, -sigma / (sigma**2 + 1) ** 0.5, out=derivative)
+            np.add(derivative, scaled_sample, out=derivative)
+        else:
+            raise ValueError(
+                f"prediction_type given as {self.config.prediction_type} must be one of `epsilon`, or `v_prediction`"
+            )
+        np.subtract(sample, derivative, out=derivative)
+        np.divide(derivative, sigma, out=derivative)
+        return derivative
+
+    def add_noise(self, original_samples, noise, timesteps):
+        original_samples = np.asarray(original_samples)
+        step_indices = [self.index_for_timestep(t) for t in np.atleast_1d(np.asarray(timesteps))]
+        sigma = self.sigmas[step_indices].astype(original_samples.dtype).flatten()
+        sigma = sigma.reshape(sigma.shape + (1,) * (original_samples.ndim - 1))
+        return original_samples + np.asarray(noise) * sigma
+
+
+class EulerDiscreteSchedulerNP(SigmaScheduler):
+    """
+    NumPy version of diffusers EulerDiscreteScheduler (epsilon and v_prediction, linear interpolation, no churn)
+    """
+    def step(self, model_output, timestep, sample, return_dict=True, **kwargs):
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        model_output = np.asarray(model_output)
+        # Upcast to avoid precision issues when computing prev_sample
+        sample = np.asarray(sample, dtype=np.float32)
+        sigma = self.sigmas[self.step_index]
+
+        derivative = self.derivative(model_output, sample, sigma)
+        dt = self.sigmas[self.step_index + 1] - sigma
+        np.multiply(derivative, dt, out=derivative)
+        prev_sample = np.add(sample, derivative).astype(model_output.dtype, copy=False)
+
+        self.step_index += 1
+
+        if not return_dict:
+            return (prev_sample,)
+        return SchedulerOutput(prev_sample=prev_sample)
+
+
+class LMSDiscreteSchedulerNP(SigmaScheduler):
+    """
+    NumPy version of diffusers LMSDiscreteScheduler. The LMS coefficients are integrated exactly with
+    numpy polynomials instead of scipy.integrate.quad.
+    """
+    def set_timesteps(self, num_inference_steps, device=None):
+        super().set_timesteps(num_inference_steps, device)
+        self.derivatives = []
+
+    def get_lms_coefficient(self, order, t, current_order):
+        """
+        Compute the linear multistep coefficient.
+        """
+        sigmas = self.sigmas.astype(np.float64)
+        lms_derivative = np.polynomial.Polynomial([1.0])
+        for k in range(order):
+            if current_order == k:
+                continue
+            lms_derivative *= np.polynomial.Polynomial([-sigmas[t - k], 1.0]) / (sigmas[t - current_order] - sigmas[t - k])
+        integral = lms_derivative.integ()
+        return float(integral(sigmas[t + 1]) - integral(sigmas[t]))
+
+    def step(self, model_output, timestep, sample, order=4, return_dict=True):
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        model_output = np.asarray(model_output)
+        sample = np.asarray(sample)
+        sigma = self.sigmas[self.step_index]
+
+        # 1. compute predicted original sample (x_0) from sigma-scaled predicted noise
+        # 2. Convert to an ODE derivative, the derivatives of the last `order` steps are kept
+        derivative = self.derivative(model_output, sample, sigma)
+        if len(self.derivatives) >= order:
+            self._buffers["derivative"] = self.derivatives.pop(0)
+        else:
+            self._buffers.pop("derivative")
+        self.derivatives.append(derivative)
+        order = min(self.step_index + 1, order)
+
+        # 3. Compute linear multistep coefficients
+        lms_coeffs = [self.get_lms_coefficient(order, self.step_index, curr_order) for curr_order in range(order)]
+
+        # 4. Compute previous sample based on the derivatives path
+        prev_sample = sample + sum(
+            coeff * derivative for coeff, derivative in zip(lms_coeffs, reversed(self.derivatives))
+        )
+
+        self.step_index += 1
+
+        if not return_dict:
+            return (prev_sample,)
+        return SchedulerOutput(prev_sample=prev_sample)
+
+
+class AlphaScheduler(NumpyScheduler):
+    """
+    Schedulers working directly on alphas_cumprod (DDIM and LCM)
+    """
+    init_noise_sigma = 1.0
+
+    def __init__(self, num_train_timesteps=1000, beta_start=0.0001, beta_end=0.02, beta_schedule="linear",
+                 clip_sample=True, set_alpha_to_one=True, steps_offset=0, prediction_type="epsilon",
+                 clip_sample_range=1.0, timestep_spacing="leading", **config):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule, clip_sample=clip_sample,
+                         set_alpha_to_one=set_alpha_to_one, steps_offset=steps_offset, prediction_type=prediction_type,
+                         clip_sample_range=clip_sample_range, timestep_spacing=timestep_spacing, **config)
+        # At every step in ddim, we are looking into the previous alphas_cumprod
+        # For the final step, there is no previous alphas_cumprod because we are already at 0
+        self.final_alpha_cumprod = np.float32(1.0) if set_alpha_to_one else self.alphas_cumprod[0]
+        self.timesteps = np.arange(0, num_train_timesteps)[::-1].copy().astype(np.int64)
+
+    def alpha_prod_prev(self, prev_timestep):
+        return self.alphas_cumprod[prev_timestep] if prev_timestep >= 0 else self.final_alpha_cumprod
+
+    def predict_original(self, model_output, sample, alpha_prod_t):
+        beta_prod_t = 1 - alpha_prod_t
+        if self.config.prediction_type == "epsilon":
+            pred_original_sample = (sample - beta_prod_t ** (0.5) * model_output) / alpha_prod_t ** (0.5)
+            pred_epsilon = model_output
+        elif self.config.prediction_type == "sample":
+            pred_original_sample = model_output
+            pred_epsilon = (sample - alpha_prod_t ** (0.5) * pred_original_sample) / beta_prod_t ** (0.5)
+        elif self.config.prediction_type == "v_prediction":
+            pred_original_sample = (alpha_prod_t**0.5) * sample - (beta_prod_t**0.5) * model_output
+            pred_epsilon = (alpha_prod_t**0.5) * model_output + (beta_prod_t**0.5) * sample
+        else:
+            raise ValueError(
+                f"prediction_type given as {self.config.prediction_type} must be one of `epsilon`, `sample`, or"
+                " `v_prediction`"
+            )
+
+        if self.config.clip_sample:
+            pred_original_sample = np.clip(
+                pred_original_sample, -self.config.clip_sample_range, self.config.clip_sample_range
+            )
+        return pred_original_sample, pred_epsilon
+
+    def add_noise(self, original_samples, noise, timesteps):
+        original_samples = np.asarray(original_samples)
+        alphas_cumprod = self.alphas_cumprod.astype(original_samples.dtype)
+        timesteps = np.atleast_1d(np.asarray(timesteps)).astype(np.int64)
+        shape = (-1,) + (1,) * (original_samples.ndim - 1)
+
+        sqrt_alpha_prod = (alphas_cumprod[timesteps] ** 0.5).flatten().reshape(shape)
+        sqrt_one_minus_alpha_prod = ((1 - alphas_cumprod[timesteps]) ** 0.5).flatten().reshape(shape)
+        return sqrt_alpha_prod * original_samples + sqrt_one_minus_alpha_prod * np.asarray(noise)
+
+
+class DDIMSchedulerNP(AlphaScheduler):
+    """
+    NumPy version of diffusers DDIMScheduler (without dynamic thresholding)
+    """
+    def set_timesteps(self, num_inference_steps, device=None):
+        if num_inference_steps > self.config.num_train_timesteps:
+            raise ValueError(
+                f"`num_inference_steps`: {num_inference_steps} cannot be larger than `self.config.train_timesteps`:"
+                f" {self.config.num_train_timesteps}."
+            )
+        self.num_inference_steps = num_inference_steps
+        if self.config.timestep_spacing == "linspace":
+            timesteps = np.linspace(0, self.config.num_train_timesteps - 1, num_inference_steps).round()[::-1].copy()
+        else:
+            timesteps = spaced_timesteps(self.config.timestep_spacing, self.config.num_train_timesteps,
+                                         num_inference_steps, self.config.steps_offset)
+        self.timesteps = timesteps.astype(np.int64)
+
+    def step(self, model_output, timestep, sample, eta=0.0, use_clipped_model_output=False, generator=None,
+             variance_noise=None, return_dict=True):
+        model_output = np.asarray(model_output)
+        sample = np.asarray(sample)
+        timestep = int(timestep)
+
+        # 1. get previous step value (=t-1)
+        prev_timestep = timestep - self.config.num_train_timesteps // self.num_inference_steps
+
+        # 2. compute alphas, betas
+        alpha_prod_t = self.alphas_cumprod[timestep]
+        alpha_prod_t_prev = self.alpha_prod_prev(prev_timestep)
+        beta_prod_t = 1 - alpha_prod_t
+        beta_prod_t_prev = 1 - alpha_prod_t_prev
+
+        # 3. compute predicted original sample from predicted noise also called
+        # "predicted x_0" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
+        pred_original_sample, pred_epsilon = self.predict_original(model_output, sample, alpha_prod_t)
+
+        # 5. compute variance: "sigma_t(η)" -> see formula (16)
+        # σ_t = sqrt((1 − α_t−1)/(1 − α_t)) * sqrt(1 − α_t/α_t−1)
+        variance = (beta_prod_t_prev / beta_prod_t) * (1 - alpha_prod_t / alpha_prod_t_prev)
+        std_dev_t = eta * variance ** (0.5)
+
+        if use_clipped_model_output:
+            # the pred_epsilon is always re-derived from the clipped x_0 in Glide
+            pred_epsilon = (sample - alpha_prod_t ** (0.5) * pred_original_sample) / beta_prod_t ** (0.5)
+
+        # 6. compute "direction pointing to x_t" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
+        pred_sample_direction = (1 - alpha_prod_t_prev - std_dev_t**2) ** (0.5) * pred_epsilon
+
+        # 7. compute x_t without "random noise" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
+        prev_sample = alpha_prod_t_prev ** (0.5) * pred_original_sample + pred_sample_direction
+
+        if eta > 0:
+            if variance_noise is None:
+                variance_noise = np.random.randn(*model_output.shape).astype(model_output.dtype)
+            prev_sample = prev_sample + std_dev_t * variance_noise
+
+        if not return_dict:
+            return (prev_sample,)
+        return SchedulerOutput(prev_sample=prev_sample, pred_original_sample=pred_original_sample)
+
+
+class LCMSchedulerNP(AlphaScheduler):
+    """
+    NumPy version of diffusers LCMScheduler. The noise injected between steps is drawn from np.random.
+    """
+    def __init__(self, num_train_timesteps=1000, beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                 original_inference_steps=50, clip_sample=False, timestep_scaling=10.0, **config):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule, clip_sample=clip_sample,
+                         original_inference_steps=original_inference_steps, timestep_scaling=timestep_scaling, **config)
+
+    def set_timesteps(self, num_inference_steps, device=None, original_inference_steps=None, strength=1.0):
+        if num_inference_steps > self.config.num_train_timesteps:
+            raise ValueError(
+                f"`num_inference_steps`: {num_inference_steps} cannot be larger than `self.config.train_timesteps`:"
+                f" {self.config.num_train_timesteps}."
+            )
+        original_steps = original_inference_steps or self.config.original_inference_steps
+        if original_steps > self.config.num_train_timesteps or num_inference_steps > original_steps:
+            raise ValueError(
+                f"`num_inference_steps`: {num_inference_steps} and `original_steps`: {original_steps} must be at most"
+                f" {self.config.num_train_timesteps}, and `num_inference_steps` at most `original_steps`."
+            )
+
+        # LCM Timesteps Setting
+        # The skipping step parameter k from the paper.
+        k = self.config.num_train_timesteps // original_steps
+        # LCM Training/Distillation Steps Schedule
+        lcm_origin_timesteps = np.asarray(list(range(1, int(original_steps * strength) + 1))) * k - 1
+        skipping_step = len(lcm_origin_timesteps) // num_inference_steps
+        if skipping_step < 1:
+            raise ValueError(
+                f"The combination of `original_steps x strength`: {original_steps} x {strength} is smaller than"
+                f" `num_inference_steps`: {num_inference_steps}."
+            )
+
+        # LCM Inference Steps Schedule
+        lcm_origin_timesteps = lcm_origin_timesteps[::-1].copy()
+        # Select (approximately) evenly spaced indices from lcm_origin_timesteps.
+        inference_indices = np.linspace(0, len(lcm_origin_timesteps), num=num_inference_steps, endpoint=False)
+        inference_indices = np.floor(inference_indices).astype(np.int64)
+
+        self.num_inference_steps = num_inference_steps
+        self.timesteps = lcm_origin_timesteps[inference_indices].astype(np.int64)
+        self.step_index = None
+
+    def get_scalings_for_boundary_condition_discrete(self, timestep):
+        sigma_data = np.float32(0.5)  # Default: 0.5
+        scaled_timestep = np.float32(timestep) * np.float32(self.config.timestep_scaling)
+
+        c_skip = sigma_data**2 / (scaled_timestep**2 + sigma_data**2)
+        c_out = scaled_timestep / (scaled_timestep**2 + sigma_data**2) ** 0.5
+        return c_skip, c_out
+
+    def step(self, model_output, timestep, sample, generator=None, return_dict=True):
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        model_output = np.asarray(model_output)
+        sample = np.asarray(sample)
+        timestep = int(timestep)
+
+        # 1. get previous step value
+        prev_step_index = self.step_index + 1
+        if prev_step_index < len(self.timesteps):
+            prev_timestep = int(self.timesteps[prev_step_index])
+        else:
+            prev_timestep = timestep
+
+        # 2. compute alphas, betas
+        alpha_prod_t = self.alphas_cumprod[timestep]
+        alpha_prod_t_prev = self.alpha_prod_prev(prev_timestep)
+        beta_prod_t_prev = 1 - alpha_prod_t_prev
+
+        # 3. Get scalings for boundary conditions
+        c_skip, c_out = self.get_scalings_for_boundary_condition_discrete(timestep)
+
+        # 4. Compute the predicted original sample x_0 based on the model parameterization
+        predicted_original_sample, _ = self.predict_original(model_output, sample, alpha_prod_t)
+
+        # 5. Denoise model output using boundary conditions
+        denoised = c_out * predicted_original_sample + c_skip * sample
+
+        # 6. Sample and inject noise z ~ N(0, I) for MultiStep Inference
+        # Noise is not used on the final timestep of the timestep schedule.
+        if self.step_index != self.num_inference_steps - 1:
+            noise = np.random.randn(*model_output.shape).astype(model_output.dtype)
+            prev_sample = np.sqrt(alpha_prod_t_prev) * denoised + np.sqrt(beta_prod_t_prev) * noise
+        else:
+            prev_sample = denoised
+
+        self.step_index += 1
+
+        if not return_dict:
+            return (prev_sample, denoised)
+        return SchedulerOutput(prev_sample=prev_sample, denoised=denoised)
+
+
+class MultistepScheduler(NumpyScheduler):
+    """
+    Common parts of the multistep solvers (DPM-Solver++ and UniPC): they work on the data prediction
+    (x0) of the last solver_order steps, in the log-SNR time lambda = log(alpha_t / sigma_t).
+    The model input isn't scaled (init_noise_sigma is 1), optionally the sigmas follow the Karras schedule.
+    """
+    init_noise_sigma = 1.0
+
+    def __init__(self, num_train_timesteps=1000, beta_start=0.0001, beta_end=0.02, beta_schedule="linear",
+                 solver_order=2, prediction_type="epsilon", use_karras_sigmas=False, lower_order_final=True,
+                 timestep_spacing="linspace", steps_offset=0, **config):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule, solver_order=solver_order,
+                         prediction_type=prediction_type, use_karras_sigmas=use_karras_sigmas,
+                         lower_order_final=lower_order_final, timestep_spacing=timestep_spacing,
+                         steps_offset=steps_offset, **config)
+        self.timesteps = np.linspace(0, num_train_timesteps - 1, num_train_timesteps, dtype=np.float32)[::-1].copy().astype(np.int64)
+        self.sigmas = (((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5).astype(np.float32)
+        self.model_outputs = [None] * solver_order
+        self.lower_order_nums = 0
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        num_train_timesteps = self.config.num_train_timesteps
+        if self.config.timestep_spacing == "linspace":
+            timesteps = np.linspace(0, num_train_timesteps - 1, num_inference_steps + 1).round()[::-1][:-1]
+        elif self.config.timestep_spacing == "leading":
+            step_ratio = num_train_timesteps // (num_inference_steps + 1)
+            timesteps = (np.arange(0, num_inference_steps + 1) * step_ratio).round()[::-1][:-1] + self.config.steps_offset
+        elif self.config.timestep_spacing == "trailing":
+            step_ratio = num_train_timesteps / num_inference_steps
+            timesteps = np.arange(num_train_timesteps, 0, -step_ratio).round() - 1
+        else:
+            raise ValueError(f"{self.config.timestep_spacing} is not supported. Please choose one of 'linspace', 'leading' or 'trailing'.")
+
+        sigmas = ((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5
+        if self.config.use_karras_sigmas:
+            log_sigmas = np.log(sigmas)
+            sigmas = self.karras_sigmas(sigmas[-1], sigmas[0], num_inference_steps)
+            timesteps = np.array([self.sigma_to_t(sigma, log_sigmas) for sigma in sigmas]).round()
+        else:
+            sigmas = np.interp(timesteps, np.arange(0, len(sigmas)), sigmas)
+
+        # the last step goes down to sigma 0, the clean sample
+        self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
+        self.timesteps = timesteps.copy().astype(np.int64)
+        self.num_inference_steps = len(timesteps)
+        self.model_outputs = [None] * self.config.solver_order
+        self.lower_order_nums = 0
+        self.step_index = None
+
+    @staticmethod
+    def karras_sigmas(sigma_max, sigma_min, num_inference_steps, rho=7.0):
+        """
+        Noise levels of "Elucidating the Design Space of Diffusion-Based Generative Models" (Karras et al.)
+        """
+        ramp = np.linspace(0, 1, num_inference_steps)
+        min_inv_rho = sigma_min ** (1 / rho)
+        max_inv_rho = sigma_max ** (1 / rho)
+        return (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+
+    @staticmethod
+    def sigma_to_t(sigma, log_sigmas):
+        """
+        (Fractional) training timestep of a noise level, interpolated in log sigma
+        """
+        log_sigma = np.log(np.maximum(sigma, 1e-10))
+        dists = log_sigma - log_sigmas[:, np.newaxis]
+        low_idx = np.cumsum((dists >= 0), axis=0).argmax(axis=0).clip(max=log_sigmas.shape[0] - 2)
+        high_idx = low_idx + 1
+        low, high = log_sigmas[low_idx], log_sigmas[high_idx]
+        w = np.clip((low - log_sigma) / (low - high), 0, 1)
+        return float(((1 - w) * low_idx + w * high_idx).reshape(()))
+
+    @staticmethod
+    def alpha_sigma(sigma):
+        alpha_t = 1 / (sigma**2 + 1) ** 0.5
+        return alpha_t, sigma * alpha_t
+
+    def lambda_of(self, index):
+        """
+        alpha_t, sigma_t and the log-SNR time lambda_t of sigmas[index] (lambda_t is inf for sigma 0)
+        """
+        # python floats, so the updates of the float32 latents stay in float32
+        alpha_t, sigma_t = self.alpha_sigma(float(self.sigmas[index]))
+        with np.errstate(divide="ignore"):
+            return alpha_t, sigma_t, float(np.log(alpha_t) - np.log(sigma_t))
+
+    def index_for_timestep(self, timestep):
+        indices = np.flatnonzero(self.timesteps == np.asarray(timestep))
+        if len(indices) == 0:
+            return len(self.timesteps) - 1
+        return int(indices[1 if len(indices) > 1 else 0])
+
+    def convert_model_output(self, model_output, sample):
+        """
+        Data prediction x0 of the model output at the current step
+        """
+        alpha_t, sigma_t = self.alpha_sigma(self.sigmas[self.step_index])
+        if self.config.prediction_type == "epsilon":
+            return (sample - sigma_t * model_output) / alpha_t
+        if self.config.prediction_type == "sample":
+            return model_output
+        if self.config.prediction_type == "v_prediction":
+            return alpha_t * sample - sigma_t * model_output
+        raise ValueError(
+            f"prediction_type given as {self.config.prediction_type} must be one of `epsilon`, `sample`, or"
+            " `v_prediction`"
+        )
+
+    def push_model_output(self, model_output):
+        self.model_outputs = self.model_outputs[1:] + [model_output]
+
+    def add_noise(self, original_samples, noise, timesteps):
+        original_samples = np.asarray(original_samples)
+        step_indices = [self.index_for_timestep(t) for t in np.atleast_1d(np.asarray(timesteps))]
+        alpha_t, sigma_t = self.alpha_sigma(self.sigmas[step_indices].astype(original_samples.dtype))
+        shape = (-1,) + (1,) * (original_samples.ndim - 1)
+        return alpha_t.reshape(shape) * original_samples + sigma_t.reshape(shape) * np.asarray(noise)
+
+
+class DPMSolverMultistepSchedulerNP(MultistepScheduler):
+    """
+    NumPy version of diffusers DPMSolverMultistepScheduler, algorithm "dpmsolver++" with the midpoint
+    second order update (DPM-Solver++ 2M; with use_karras_sigmas=True, DPM++ 2M Karras).
+    """
+    def first_order_update(self, x0, sample):
+        alpha_t, sigma_t, lambda_t = self.lambda_of(self.step_index + 1)
+        _, sigma_s, lambda_s = self.lambda_of(self.step_index)
+        h = lambda_t - lambda_s
+        return (sigma_t / sigma_s) * sample - (alpha_t * float(np.expm1(-h))) * x0
+
+    def second_order_update(self, sample):
+        alpha_t, sigma_t, lambda_t = self.lambda_of(self.step_index + 1)
+        _, sigma_s0, lambda_s0 = self.lambda_of(self.step_index)
+        _, _, lambda_s1 = self.lambda_of(self.step_index - 1)
+        m1, m0 = self.model_outputs[-2], self.model_outputs[-1]
+
+        h, h_0 = lambda_t - lambda_s0, lambda_s0 - lambda_s1
+        r0 = h_0 / h
+        # D0 = m0, D1 = (m0 - m1) / r0
+        phi = float(np.expm1(-h))
+        return (sigma_t / sigma_s0) * sample - (alpha_t * phi) * m0 - (0.5 * alpha_t * phi / r0) * (m0 - m1)
+
+    def step(self, model_output, timestep, sample, return_dict=True, **kwargs):
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        model_output = np.asarray(model_output)
+        # Upcast to avoid precision issues when computing prev_sample
+        sample = np.asarray(sample, dtype=np.float32)
+
+        # Improve numerical stability for small number of steps: the last step (to sigma 0) is first order
+        lower_order_final = self.step_index == len(self.timesteps) - 1
+
+        self.push_model_output(self.convert_model_output(model_output, sample))
+        if self.config.solver_order == 1 or self.lower_order_nums < 1 or lower_order_final:
+            prev_sample = self.first_order_update(self.model_outputs[-1], sample)
+        else:
+            prev_sample = self.second_order_update(sample)
+
+        if self.lower_order_nums < self.config.solver_order:
+            self.lower_order_nums += 1
+        self.step_index += 1
+
+        prev_sample = prev_sample.astype(model_output.dtype, copy=False)
+        if not return_dict:
+            return (prev_sample,)
+        return SchedulerOutput(prev_sample=prev_sample)
+
+
+class UniPCMultistepSchedulerNP(MultistepScheduler):
+    """
+    NumPy version of diffusers UniPCMultistepScheduler (data prediction, B(h) = e^h - 1 "bh2"): at every
+    step the UniC corrector refines the previous predictor result with the new model output, for free.
+    """
+    def __init__(self, num_train_timesteps=1000, beta_start=0.0001, beta_end=0.02, beta_schedule="linear",
+                 disable_corrector=(), **config):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule,
+                         disable_corrector=list(disable_corrector), **config)
+        self.last_sample = None
+        self.this_order = None
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        super().set_timesteps(num_inference_steps, device)
+        self.last_sample = None
+        self.this_order = None
+
+    def bh_coefficients(self, index, previous, order):
+        """
+        Step size h, B(h), h * phi_1(h), and the rks / D1s terms of the outputs before the last one
+
+        Parameters:
+            index (int): sigma index the update goes to
+            previous (int): sigma index of the last model output
+            order (int): order of the update
+        """
+        alpha_t, sigma_t, lambda_t = self.lambda_of(index)
+        _, sigma_s0, lambda_s0 = self.lambda_of(previous)
+        h = lambda_t - lambda_s0
+        m0 = self.model_outputs[-1]
+
+        rks, D1s = [], []
+        for i in range(1, order):
+            _, _, lambda_si = self.lambda_of(previous - i)
+            rk = (lambda_si - lambda_s0) / h
+            rks.append(rk)
+            D1s.append((self.model_outputs[-(i + 1)] - m0) / rk)
+        rks.append(1.0)
+        rks = np.array(rks)
+
+        hh = -h
+        h_phi_1 = float(np.expm1(hh))  # h\phi_1(h) = e^h - 1
+        h_phi_k = h_phi_1 / hh - 1
+        B_h = h_phi_1
+        factorial_i = 1
+        R, b = [], []
+        for i in range(1, order + 1):
+            R.append(rks ** (i - 1))
+            b.append(h_phi_k * factorial_i / B_h)
+            factorial_i *= i + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial_i
+
+        return alpha_t, sigma_t / sigma_s0, h_phi_1, B_h, np.stack(R), np.array(b), D1s
+
+    def predictor_update(self, sample, order):
+        """
+        UniP: from the sample at step_index to the next sigma
+        """
+        alpha_t, sigma_ratio, h_phi_1, B_h, R, b, D1s = self.bh_coefficients(self.step_index + 1, self.step_index, order)
+        x_t = sigma_ratio * sample - (alpha_t * h_phi_1) * self.model_outputs[-1]
+        if D1s:
+            # for order 2, a simplified version
+            rhos_p = [0.5] if order == 2 else np.linalg.solve(R[:-1, :-1], b[:-1]).tolist()
+            x_t = x_t - (alpha_t * B_h) * sum(rho * D1 for rho, D1 in zip(rhos_p, D1s))
+        return x_t
+
+    def corrector_update(self, this_model_output, last_sample, order):
+        """
+        UniC: redo the last predictor update (from last_sample) with the model output at its result
+        """
+        alpha_t, sigma_ratio, h_phi_1, B_h, R, b, D1s = self.bh_coefficients(self.step_index, self.step_index - 1, order)
+        m0 = self.model_outputs[-1]
+        # for order 1, a simplified version
+        rhos_c = [0.5] if order == 1 else np.linalg.solve(R, b).tolist()
+        correction = rhos_c[-1] * (this_model_output - m0)
+        for rho, D1 in zip(rhos_c[:-1], D1s):
+            correction = correction + rho * D1
+        return sigma_ratio * last_sample - (alpha_t * h_phi_1) * m0 - (alpha_t * B_h) * correction
+
+    def step(self, model_output, timestep, sample, return_dict=True, **kwargs):
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        model_output = np.asarray(model_output)
+        sample = np.asarray(sample, dtype=np.float32)
+
+        use_corrector = (self.step_index > 0 and self.step_index - 1 not in self.config.disable_corrector
+                         and self.last_sample is not None)
+        model_output_convert = self.convert_model_output(model_output, sample)
+        if use_corrector:
+            sample = self.corrector_update(model_output_convert, self.last_sample, self.this_order)
+
+        self.push_model_output(model_output_convert)
+
+        if self.config.lower_order_final:
+            this_order = min(self.config.solver_order, len(self.timesteps) - self.step_index)
+        else:
+            this_order = self.config.solver_order
+        # warmup for multistep
+        self.this_order = min(this_order, self.lower_order_nums + 1)
+
+        self.last_sample = sample
+        prev_sample = self.predictor_update(sample, self.this_order)
+
+        if self.lower_order_nums < self.config.solver_order:
+            self.lower_order_nums += 1
+        self.step_index += 1
+
+        prev_sample = prev_sample.astype(model_output.dtype, copy=False)
+        if not return_dict:
+            return (prev_sample,)
+        return SchedulerOutput(prev_sample=prev_sample)
+
+
+# scheduler names of the server protocol, with the config they add to the model beta schedule
+SCHEDULERS = {
+    "euler": (EulerDiscreteSchedulerNP, {}),
+    "lms": (LMSDiscreteSchedulerNP, {}),
+    "dpm++_2m": (DPMSolverMultistepSchedulerNP, {}),
+    "dpm++_2m_karras": (DPMSolverMultistepSchedulerNP, {"use_karras_sigmas": True}),
+    "unipc": (UniPCMultistepSchedulerNP, {}),
+}
+
+
+def create_scheduler(name, **config):
+    """
+    Scheduler by protocol name (see SCHEDULERS)
+
+    Parameters:
+        name (str): scheduler name, e.g. "euler", "dpm++_2m_karras" or "unipc"
+        config: scheduler config, e.g. beta_start, beta_end, beta_schedule, prediction_type
+    Returns:
+        scheduler (NumpyScheduler)
+    """
+    if name not in SCHEDULERS:
+        raise ValueError("Unknown scheduler %s, expected one of %s" % (name, ", ".join(SCHEDULERS)))
+    scheduler_class, scheduler_config = SCHEDULERS[name]
+    return scheduler_class(**dict(scheduler_config, **config))
+
+
+def scheduler_step(scheduler, model_output, timestep, sample, **kwargs):
+    """
+    Run one scheduler step on numpy arrays.
+
+    Parameters:
+        scheduler: NumpyScheduler, or a diffusers scheduler
+        model_output (np.ndarray): noise predicted by the unet
+        timestep: current timestep
+        sample (np.ndarray): current latents
+    Returns:
+        prev_sample (np.ndarray): latents for the next step
+    """
+    if isinstance(scheduler, NumpyScheduler):
+        return scheduler.step(model_output, timestep, sample, **kwargs)["prev_sample"]
+    import torch
+    return scheduler.step(torch.from_numpy(np.asarray(model_output)), timestep, torch.as_tensor(sample), **kwargs)["prev_sample"].numpy()
+
+
+def scheduler_step_denoised(scheduler, model_output, timestep, sample):
+    """
+    LCM scheduler step on numpy arrays.
+
+    Returns:
+        prev_sample (np.ndarray), denoised (np.ndarray)
+    """
+    if isinstance(scheduler, NumpyScheduler):
+        return scheduler.step(model_output, timestep, sample, return_dict=False)
+    import torch
+    prev_sample, denoised = scheduler.step(torch.from_numpy(np.asarray(model_output)), timestep, torch.as_tensor(sample), return_dict=False)
+    return prev_sample.numpy(), denoised.numpy()
+
+
+def scheduler_add_noise(scheduler, original_samples, noise, timesteps):
+    """
+    scheduler.add_noise on numpy arrays, for NumpyScheduler and diffusers schedulers.
+    """
+    if isinstance(scheduler, NumpyScheduler):
+        return scheduler.add_noise(original_samples, noise, timesteps)
+    import torch
+    return scheduler.add_noise(torch.as_tensor(original_samples), torch.as_tensor(noise), timesteps).numpy()
@@ -7,7 +7,7 @@ import inspect
 from typing import Union, Optional, Any, List, Dict
 import numpy as np
 # openvino
-from openvino.runtime import Core
+from openvino.runtime import Core, Tensor
 # tokenizer
 from transformers import CLIPTokenizer
 import torch
@@ -39,6 +39,14 @@ import glob
 import json
 import time
 
+from .inference_cache import (encode_prompt_cached, encode_image_cached, time_projection_table, compiled_model_cache,
+                              BatchOneModel)
+from .schedulers_np import (scheduler_step, scheduler_step_denoised, scheduler_add_noise,
+                            LMSDiscreteSchedulerNP, EulerDiscreteSchedulerNP, MultistepScheduler)
+from .guidance import guidance_active
+from .tiled_vae import vae_decode, vae_encode, uses_tiles, canvas_vae, tile_starts, blend_ramp
+from .stage_graph import StageGraph
+
 def scale_fit_to_window(dst_width:int, dst_height:int, image_width:int, image_height:int):
     """
     Preprocessing helper function for calculating image size for resize with peserving original aspect ratio
@@ -121,6 +129,270 @@ def try_enable_npu_turbo(device, core):
 def result(var):
     return next(iter(var.values()))
 
+def start_batch(compiled_model, infer_requests, inputs_per_image):
+    """
+    Start one asynchronous inference per image on a batch 1 model, round-robin over its infer requests.
+
+    Parameters:
+        compiled_model: compiled model used to create extra infer requests when needed
+        infer_requests (List): infer requests of compiled_model, grown to the number of images
+        inputs_per_image (List): inputs for every image
+    Returns:
+        the infer requests that were started
+    """
+    while len(infer_requests) < len(inputs_per_image):
+        infer_requests.append(compiled_model.create_infer_request())
+    started = infer_requests[:len(inputs_per_image)]
+    for request, inputs in zip(started, inputs_per_image):
+        request.start_async(inputs)
+    return started
+
+def wait_batch(infer_requests):
+    """
+    Wait for the infer requests returned by start_batch and stack their first outputs along the batch axis.
+    """
+    outputs = []
+    for request in infer_requests:
+        request.wait()
+        outputs.append(request.get_output_tensor(0).data.astype(np.float32))
+    return np.concatenate(outputs)
+
+class UNetBatch:
+    """
+    UNet infer requests of one denoising run, one request per image.
+
+    The inputs are written in place into the tensors the infer requests already own, and the first output of
+    every request is bound to a slice of a float32 array allocated once per run, so a denoising step
+    doesn't allocate any tensor.
+
+    Parameters:
+        compiled_model: compiled UNet
+        infer_requests (List): infer requests of compiled_model, grown to the number of images
+        num_images (int): number of images denoised together
+        input_keys (List): input names, or input indices for models called with positional inputs
+    """
+    def __init__(self, compiled_model, infer_requests, num_images, input_keys):
+        while len(infer_requests) < num_images:
+            infer_requests.append(compiled_model.create_infer_request())
+        self.requests = infer_requests[:num_images]
+        self.inputs = [{key: (request.get_input_tensor(key) if isinstance(key, int) else request.get_tensor(key)).data
+                        for key in input_keys}
+                       for request in self.requests]
+
+        output_shape = tuple(self.requests[0].get_output_tensor(0).shape)
+        self.images_per_request = output_shape[0]
+        self.output = np.empty((num_images * output_shape[0],) + output_shape[1:], dtype=np.float32)
+        self.bound = []
+        for k, request in enumerate(self.requests):
+            output = self.output_of(k)
+            bound = request.get_output_tensor(0).data.dtype == np.float32
+            if bound:
+                request.set_output_tensor(0, Tensor(output, shared_memory=True))
+            self.bound.append(bound)
+
+    def output_of(self, k):
+        return self.output[k * self.images_per_request:(k + 1) * self.images_per_request]
+
+    def fill(self, key, value):
+        """
+        Write the same value to the input of every request, e.g. the text embeddings or the timestep
+        """
+        for inputs in self.inputs:
+            # converted like infer() did, e.g. a float timestep into an integer input
+            inputs[key][...] = value
+
+    def set_latent(self, k, key, latent):
+        """
+        Write a (1, 4, h, w) latent to the input of request k, transposed when the UNet takes NHWC latents
+        """
+        if self.inputs[k][key].shape[-1] != latent.shape[-1]:
+            latent = latent.transpose(0, 2, 3, 1)
+        self.inputs[k][key][...] = latent
+
+    def set_latents(self, key, latents):
+        """
+        Write row k of latents (NCHW) to the input of request k
+        """
+        for k in range(len(self.requests)):
+            self.set_latent(k, key, latents[k:k + 1])
+
+    def start(self):
+        for request in self.requests:
+            request.start_async()
+
+    def wait_one(self, k):
+        self.requests[k].wait()
+        if not self.bound[k]:
+            np.copyto(self.output_of(k), self.requests[k].get_output_tensor(0).data)
+        return self.output_of(k)
+
+    def wait(self):
+        for k in range(len(self.requests)):
+            self.wait_one(k)
+        return self.output
+
+def canvas_size(height, width, unet_height, unet_width):
+    """
+    Size of the generated image: the requested size rounded down to a multiple of 8, never below the UNet size
+    """
+    height = max(unet_height, int(height or unet_height) // 8 * 8)
+    width = max(unet_width, int(width or unet_width) // 8 * 8)
+    return height, width
+
+# requested sizes up to this scale of the model resolution (in each dimension) get a reshaped UNet,
+# above it SD 1.x duplicates subjects, so larger canvases are generated over windows of the model resolution
+MAX_RESHAPE_SCALE = 1.5
+
+
+def spatial_shape(shape, height, width):
+    """
+    Replace height and width of an NCHW shape (or NHWC, for 4 channel latents)
+    """
+    shape = list(shape)
+    if shape[1] in (3, 4):
+        shape[2:4] = [height, width]
+    else:
+        shape[1:3] = [height, width]
+    return shape
+
+def use_resolution(engine, height, width):
+    """
+    Switch the UNet and the VAE of an engine to compiled models for the requested size. The reshaped
+    models are compiled once per model / shape / device through compiled_model_cache, the text encoder
+    is shared by all the sizes.
+
+    Parameters:
+        engine: StableDiffusionEngine or StableDiffusionEngineAdvanced
+        height (int, *optional*), width (int, *optional*): requested size, the model resolution by default
+    Returns:
+        (height, width) of the image to generate: the UNet size, or a larger canvas when the
+        size is above MAX_RESHAPE_SCALE or the models can't be reshaped (NPU blobs)
+    """
+    native = engine.native_models
+    native_height, native_width = native["height"], native["width"]
+    target = (native_height, native_width)
+    can_reshape = not any("NPU" in d for d in engine.device[1:4])
+    if (height or width) and can_reshape:
+        requested_height = int(height or native_height) // 64 * 64
+        requested_width = int(width or native_width) // 64 * 64
+        if (64 <= requested_height <= native_height * MAX_RESHAPE_SCALE and
+                64 <= requested_width <= native_width * MAX_RESHAPE_SCALE):
+            target = (requested_height, requested_width)
+
+    if target != (engine.height, engine.width):
+        if target == (native_height, native_width):
+            models = native
+        else:
+            def reshaped(compiled, name, input_name, device, scale):
+                shape = spatial_shape(compiled.input(input_name).shape, target[0] // scale, target[1] // scale)
+                return compiled_model_cache.compile(engine.core, os.path.join(engine.model_key, name + ".xml"), device,
+                                                    {input_name: shape})
+
+            latent_name = engine.unet_input_tensor_name
+            models = {"unet": reshaped(native["unet"], engine.unet_name, latent_name, engine.device[1], 8)}
+            if native["unet_neg"] is native["unet"]:
+                models["unet_neg"] = models["unet"]
+            else:
+                models["unet_neg"] = reshaped(native["unet_neg"], engine.unet_name, latent_name, engine.device[2], 8)
+            vae_decoder, vae_encoder = native["vae_decoder"], native["vae_encoder"]
+            models["vae_decoder"] = reshaped(vae_decoder, "vae_decoder", vae_decoder.input(0).any_name, engine.device[3], 8)
+            models["vae_encoder"] = reshaped(vae_encoder, "vae_encoder", vae_encoder.input(0).any_name, engine.device[3], 1)
+
+        engine.unet = models["unet"]
+        engine.unet_neg = models["unet_neg"]
+        engine.vae_decoder = models["vae_decoder"]
+        engine.vae_encoder = models["vae_encoder"]
+        engine._vae_d_output = engine.vae_decoder.output(0)
+        engine._vae_e_output = engine.vae_encoder.output(0)
+        engine.height, engine.width = target
+        # infer requests belong to one compiled model, the ones of the reshaped models are kept with
+        # their cache entries so they don't outlive them
+        if target == (native_height, native_width):
+            requests = engine.native_requests
+        else:
+            requests = (compiled_model_cache.attached(models["unet"]).setdefault("infer_requests", []),
+                        compiled_model_cache.attached(models["unet_neg"]).setdefault("infer_requests_neg", []),
+                        compiled_model_cache.attached(models["vae_decoder"]).setdefault("vae_decoder_requests", []))
+        engine.infer_requests, engine.infer_requests_neg, engine.vae_decoder_requests = requests
+
+    if target != (native_height, native_width):
+        # the requested size, rounded down to the UNet granularity
+        return target
+    return canvas_size(height, width, engine.height, engine.width)
+
+class LatentWindows:
+    """
+    MultiDiffusion: runs a fixed shape UNet over overlapping windows of a larger latent canvas, and fuses
+    the noise predictions of the windows with linear blending weights.
+
+    Parameters:
+        canvas_shape (tuple): (num_images, 4, height, width) of the latent canvas
+        window (tuple): (height, width) of the UNet latent input
+        overlap (int): minimal overlap between windows, in latent pixels
+    """
+    def __init__(self, canvas_shape, window, overlap=16):
+        num_images, _, height, width = canvas_shape
+        self.window = window
+        positions = [(y, x) for y in tile_starts(height, window[0], overlap) for x in tile_starts(width, window[1], overlap)]
+        self.windows = [(k, y, x) for k in range(num_images) for y, x in positions]
+        self.weights = np.outer(blend_ramp(window[0], overlap), blend_ramp(window[1], overlap))
+        self.weight_sum = np.zeros((height, width), dtype=np.float32)
+        for y, x in positions:
+            self.weight_sum[y:y + window[0], x:x + window[1]] += self.weights
+        self.canvas_shape = canvas_shape
+        self.fused = {}
+
+    @staticmethod
+    def num_requests(compiled_model, num_windows):
+        try:
+            optimal = int(compiled_model.get_property("OPTIMAL_NUMBER_OF_INFER_REQUESTS"))
+        except Exception:
+            optimal = 2
+        return max(1, min(optimal, num_windows))
+
+    def run(self, unets, key, latent_model_input):
+        """
+        Run every window through the UNets (e.g. the negative and positive UNet), round-robin over their infer requests
+
+        Parameters:
+            unets (List[UNetBatch]): UNets with the same number of infer requests, inputs other than the latents already written
+            key: latent input name (or index) of the UNets
+            latent_model_input (np.ndarray): scaled latent canvas
+        Returns:
+            fused noise predictions, one canvas per UNet, (num_images * images per request, 4, height, width)
+        """
+        height, width = self.window
+        num_requests = len(unets[0].requests)
+        fused = []
+        for unet in unets:
+            per_request = unet.images_per_request
+            canvas = self.fused.get(id(unet))
+            if canvas is None:
+                canvas = np.empty((self.canvas_shape[0] * per_request,) + self.canvas_shape[1:], dtype=np.float32)
+                self.fused[id(unet)] = canvas
+            canvas.fill(0)
+            fused.append(canvas)
+
+        weighted = None
+        for start in range(0, len(self.windows), num_requests):
+            chunk = self.windows[start:start + num_requests]
+            for unet in unets:
+                for r, (k, y, x) in enumerate(chunk):
+                    unet.set_latent(r, key, latent_model_input[k:k + 1, :, y:y + height, x:x + width])
+                    unet.requests[r].start_async()
+            for unet, canvas in zip(unets, fused):
+                per_request = unet.images_per_request
+                for r, (k, y, x) in enumerate(chunk):
+                    output = unet.wait_one(r)
+                    if weighted is None or weighted.shape != output.shape:
+                        weighted = np.empty(output.shape, dtype=np.float32)
+                    np.multiply(output, self.weights, out=weighted)
+                    canvas[k * per_request:(k + 1) * per_request, :, y:y + height, x:x + width] += weighted
+
+        for canvas in fused:
+            canvas /= self.weight_sum
+        return fused
+
 class StableDiffusionEngineAdvanced(DiffusionPipeline):
     def __init__(self, model="runwayml/stable-diffusion-v1-5", 
                   tokenizer="openai/clip-vit-large-patch14", 
@@ -131,6 +403,7 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
             self.tokenizer = CLIPTokenizer.from_pretrained(tokenizer)
             self.tokenizer.save_pretrained(model)
 
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')})
         try_enable_npu_turbo(device, self.core)
@@ -155,6 +428,7 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
         self.unet_neg = futures["unet_neg"].result() if futures["unet_neg"] else self.unet
         self.vae_decoder = futures["vae_decoder"].result()
         self.vae_encoder = futures["vae_encoder"].result()
+        self.tiled_vae = None
         print("Text Device:", device[0])
         print("unet Device:", device[1])
         print("unet-neg Device:", device[2])
@@ -167,8 +441,23 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
         self.set_dimensions()
         self.infer_request_neg = self.unet_neg.create_infer_request()
         self.infer_request = self.unet.create_infer_request()
+        self.infer_requests_neg = [self.infer_request_neg]
+        self.infer_requests = [self.infer_request]
+        self.vae_decoder_requests = []
+
+        # models compiled for the model resolution, other resolutions are reshaped from the xml models
+        self.device = device
+        self.unet_name = "unet_int8"
+        self.unet_input_tensor_name = "latent_model_input"
+        self.native_models = {"unet": self.unet, "unet_neg": self.unet_neg, "vae_decoder": self.vae_decoder,
+                              "vae_encoder": self.vae_encoder, "height": self.height, "width": self.width}
+        self.native_requests = (self.infer_requests, self.infer_requests_neg, self.vae_decoder_requests)
         self.infer_request_time_proj = self.unet_time_proj.create_infer_request()
         self.time_proj_constants = np.load(os.path.join(model, "time_proj_constants.npy"))
+
+    def time_proj_inputs(self, t):
+        t_scaled = self.time_proj_constants * np.float32(t)
+        return {"sine_t" : np.float32(np.sin(t_scaled)), "cosine_t" : np.float32(np.cos(t_scaled))}
         
     def load_model(self, model, model_name, device):
         if "NPU" in device:
@@ -198,23 +487,37 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
             create_gif = False,
             model = None,
             callback = None,
-            callback_userdata = None
+            callback_userdata = None,
+            num_images = 1,
+            seeds = None,
+            height = None,
+            width = None,
+            guidance_cutoff = 1.0
     ):
+        """
+        num_images images are denoised together: the prompt is encoded once, the latents are stacked
+        and each step runs one UNet infer request per image concurrently. seeds (optional) gives the
+        seed of every image, so each one can be reproduced on its own.
+        height and width (optional) select the resolution: the UNet and the VAE are reshaped to it (see
+        use_resolution). Above MAX_RESHAPE_SCALE of the model resolution, each step runs the UNet over
+        overlapping windows of the canvas latents and blends the predictions.
+        guidance_cutoff (fraction of the steps) stops classifier free guidance: the later steps only run
+        the conditional UNet.
+        Returns a single image if num_images is 1, otherwise a list of images.
+        """
 
         # extract condition
-        text_input = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="np",
-        )
-        text_embeddings = self.text_encoder(text_input.input_ids)[self._text_encoder_output]
-
-        # do classifier free guidance
-        do_classifier_free_guidance = guidance_scale > 1.0
-        if do_classifier_free_guidance:
+        def encode_prompt():
+            text_input = self.tokenizer(
+                prompt,
+                padding="max_length",
+                max_length=self.tokenizer.model_max_length,
+                truncation=True,
+                return_tensors="np",
+            )
+            return encode_prompt_cached(self.text_encoder, self._text_encoder_output, self.model_key, text_input.input_ids, prompt)
 
+        def encode_negative_prompt():
             if negative_prompt is None:
                 uncond_tokens = [""]
             elif isinstance(negative_prompt, str):
@@ -228,8 +531,23 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
                 max_length=self.tokenizer.model_max_length, #truncation=True,
                 return_tensors="np"
             )
-            uncond_embeddings = self.text_encoder(tokens_uncond.input_ids)[self._text_encoder_output]
-            text_embeddings = np.concatenate([uncond_embeddings, text_embeddings])
+            return encode_prompt_cached(self.text_encoder, self._text_encoder_output, self.model_key, tokens_uncond.input_ids, uncond_tokens)
+
+        # the prompts are encoded while the UNet / VAE are switched to the resolution and the init image is encoded
+        do_classifier_free_guidance = guidance_scale > 1.0
+        stages = StageGraph()
+        stages.add("prompt", encode_prompt)
+        if do_classifier_free_guidance:
+            stages.add("negative_prompt", encode_negative_prompt)
+        stages.add("resolution", lambda: use_resolution(self, height, width))
+        if init_image is not None:
+            stages.add("init_image", lambda size: self.encode_init_image(init_image, *size), deps=("resolution",))
+        preprocessed = stages.run()
+
+        text_embeddings = preprocessed["prompt"]
+        # do classifier free guidance
+        if do_classifier_free_guidance:
+            text_embeddings = np.concatenate([preprocessed["negative_prompt"], text_embeddings])
 
         # set timesteps
         accepts_offset = "offset" in set(inspect.signature(scheduler.set_timesteps).parameters.keys())
@@ -244,7 +562,12 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
         latent_timestep = timesteps[:1]
 
         # get the initial random noise unless the user supplied it
-        latents, meta = self.prepare_latents(init_image, latent_timestep, scheduler)
+        height, width = preprocessed["resolution"]
+        latents, meta = self.prepare_latents(init_image, latent_timestep, scheduler, seeds=seeds or [None] * num_images,
+                                             height=height, width=width, encoded=preprocessed.get("init_image"))
+        windows = None
+        if (height, width) != (self.height, self.width):
+            windows = LatentWindows(latents.shape, (self.height // 8, self.width // 8))
 
 
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -258,70 +581,52 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
         if create_gif:
             frames = []
 
+        time_proj_table = time_projection_table(self.unet_time_proj, self.model_key, timesteps, self.time_proj_inputs)
+
+        # one neg / pos infer request pair per image, all running at the same time
+        # (or, on a larger canvas, per window running at the same time)
+        # the text embeddings don't change during the run, only the latents and time_proj are written at each step
+        unet_inputs = ["time_proj", "latent_model_input", "encoder_hidden_states"]
+        num_requests = num_images if windows is None else LatentWindows.num_requests(self.unet, len(windows.windows))
+        unet_neg = UNetBatch(self.unet_neg, self.infer_requests_neg, num_requests, unet_inputs)
+        unet_pos = UNetBatch(self.unet, self.infer_requests, num_requests, unet_inputs)
+        unet_neg.fill("encoder_hidden_states", text_embeddings[0])
+        unet_pos.fill("encoder_hidden_states", text_embeddings[-1])
+
         for i, t in enumerate(self.progress_bar(timesteps)):
             if callback:
                callback(i, callback_userdata)
 
-            # expand the latents if we are doing classifier free guidance
-            noise_pred = []
-            latent_model_input = latents
-            latent_model_input = scheduler.scale_model_input(latent_model_input, t)
-
-            latent_model_input_neg = latent_model_input
-            if self.unet.input("latent_model_input").shape[1] != 4:
-                #print("In transpose")
-                try:
-                    latent_model_input = latent_model_input.permute(0,2,3,1)
-                except:
-                    latent_model_input = latent_model_input.transpose(0,2,3,1)
-
-            if self.unet_neg.input("latent_model_input").shape[1] != 4:
-                #print("In transpose")
-                try:
-                    latent_model_input_neg = latent_model_input_neg.permute(0,2,3,1)
-                except:
-                    latent_model_input_neg = latent_model_input_neg.transpose(0,2,3,1)
-
-
-            time_proj_constants_fp16 = np.float16(self.time_proj_constants)
-            t_scaled_fp16 = time_proj_constants_fp16 * np.float16(t)
-            cosine_t_fp16 = np.cos(t_scaled_fp16)
-            sine_t_fp16 = np.sin(t_scaled_fp16)
-
-            t_scaled = self.time_proj_constants * np.float32(t)
-
-            cosine_t = np.cos(t_scaled)
-            sine_t = np.sin(t_scaled)
+            latent_model_input = scheduler.scale_model_input(latents, t)
 
-            time_proj_dict = {"sine_t" : np.float32(sine_t), "cosine_t" : np.float32(cosine_t)}
-            self.infer_request_time_proj.start_async(time_proj_dict)
-            self.infer_request_time_proj.wait()
-            time_proj = self.infer_request_time_proj.get_output_tensor(0).data.astype(np.float32)
-
-            input_tens_neg_dict = {"time_proj": np.float32(time_proj), "latent_model_input":latent_model_input_neg, "encoder_hidden_states": np.expand_dims(text_embeddings[0], axis=0)}
-            input_tens_dict = {"time_proj": np.float32(time_proj), "latent_model_input":latent_model_input, "encoder_hidden_states": np.expand_dims(text_embeddings[1], axis=0)}
-
-            self.infer_request_neg.start_async(input_tens_neg_dict)
-            self.infer_request.start_async(input_tens_dict)
-            self.infer_request_neg.wait()
-            self.infer_request.wait()
-            
-            noise_pred_neg = self.infer_request_neg.get_output_tensor(0)
-            noise_pred_pos = self.infer_request.get_output_tensor(0)
-
-            noise_pred.append(noise_pred_neg.data.astype(np.float32))
-            noise_pred.append(noise_pred_pos.data.astype(np.float32))
-
-            # perform guidance
-            if do_classifier_free_guidance:
-                noise_pred_uncond, noise_pred_text = noise_pred[0], noise_pred[1]
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+            # past the guidance cutoff the unet_neg requests stay idle
+            guided = do_classifier_free_guidance and guidance_active(i, len(timesteps), guidance_cutoff)
+            unets = (unet_neg, unet_pos) if guided else (unet_pos,)
+            if windows is not None:
+                for unet in unets:
+                    unet.fill("time_proj", time_proj_table[i])
+                noise_preds = windows.run(unets, "latent_model_input", latent_model_input)
+            else:
+                for unet in unets:
+                    unet.set_latents("latent_model_input", latent_model_input)
+                    unet.fill("time_proj", time_proj_table[i])
+                    unet.start()
+                noise_preds = [unet.wait() for unet in unets]
+            noise_pred_uncond, noise_pred_text = noise_preds[0], noise_preds[-1]
+
+            # perform guidance, in place in the output buffer of the positive UNet
+            if guided:
+                noise_pred = np.subtract(noise_pred_text, noise_pred_uncond, out=noise_pred_text)
+                noise_pred *= guidance_scale
+                noise_pred += noise_pred_uncond
+            else:
+                noise_pred = noise_pred_text
 
             # compute the previous noisy sample x_t -> x_t-1
-            latents = scheduler.step(torch.from_numpy(noise_pred), t, torch.from_numpy(latents), **extra_step_kwargs)["prev_sample"].numpy()
+            latents = scheduler_step(scheduler, noise_pred, t, latents, **extra_step_kwargs)
 
             if create_gif:
-                frames.append(latents)
+                frames.append(latents[:1])
 
         if callback:
             callback(num_inference_steps, callback_userdata)
@@ -330,10 +635,16 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
         latents = 1 / 0.18215 * latents
 
         start = time.time()
-        image = self.vae_decoder(latents)[self._vae_d_output]
+        if windows is not None:
+            image = canvas_vae(self, self.model_key, self.height // 8).decode(latents)
+        elif num_images == 1 or uses_tiles(self.tiled_vae, latents):
+            image = vae_decode(self.tiled_vae, self.vae_decoder, latents)
+        else:
+            image = wait_batch(start_batch(self.vae_decoder, self.vae_decoder_requests, [latents[k:k + 1] for k in range(num_images)]))
         print("Decoder ended:",time.time() - start)
 
-        image = self.postprocess_image(image, meta)
+        images = [self.postprocess_image(image[k:k + 1], meta) for k in range(num_images)]
+        image = images[0]
 
         if create_gif:
             gif_folder=os.path.join(model,"../../../gif")
@@ -341,7 +652,7 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
             if not os.path.exists(gif_folder):
                 os.makedirs(gif_folder)
             for i in range(0,len(frames)):
-                image = self.vae_decoder(frames[i]*(1/0.18215))[self._vae_d_output]
+                image = vae_decode(self.tiled_vae, self.vae_decoder, frames[i]*(1/0.18215))
                 image = self.postprocess_image(image, meta)
                 output = gif_folder + "/" + str(i).zfill(3) +".png"
                 cv2.imwrite(output, image)
@@ -352,9 +663,36 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
             gif_file=os.path.join(gif_folder,"stable_diffusion.gif")
             frame_one.save(gif_file, format="GIF", append_images=frames_image, save_all=True, duration=100, loop=0)
 
-        return image
+        return images[0] if num_images == 1 else images
 
-    def prepare_latents(self, image:PIL.Image.Image = None, latent_timestep:torch.Tensor = None, scheduler = LMSDiscreteScheduler):
+    def encode_init_image(self, image:PIL.Image.Image, height = None, width = None):
+        """
+        VAE encoding of the init image, the first stage of prepare_latents
+
+        Parameters:
+            image (PIL.Image.Image):
+                Input image for generation
+            height (int, *optional*), width (int, *optional*):
+                Canvas size, the UNet size by default
+        Returns:
+            moments (np.ndarray):
+                VAE encoder output, read-only
+            meta (Dict):
+                Preprocessing metadata, for postprocess_image
+        """
+        height = height or self.height
+        width = width or self.width
+        input_image, meta = preprocess(image, height, width)
+        # the image is encoded once and sampled per seed
+        if (height, width) != (self.height, self.width):
+            tiled_vae = canvas_vae(self, self.model_key, self.height // 8)
+            moments = encode_image_cached(tiled_vae.encode, self.model_key, input_image, ("tiled", tiled_vae.tile_size))
+        else:
+            moments = vae_encode(self.tiled_vae, self.vae_encoder, input_image, self.model_key)
+        return moments, meta
+
+    def prepare_latents(self, image:PIL.Image.Image = None, latent_timestep:torch.Tensor = None, scheduler = LMSDiscreteScheduler, seeds = None,
+                        height = None, width = None, encoded = None):
         """
         Function for getting initial latents for starting generation
 
@@ -363,38 +701,50 @@ class StableDiffusionEngineAdvanced(DiffusionPipeline):
                 Input image for generation, if not provided randon noise will be used as starting point
             latent_timestep (torch.Tensor, *optional*, None):
                 Predicted by scheduler initial step for image generation, required for latent image mixing with nosie
+            seeds (List, *optional*, None):
+                One seed per image, a None seed keeps the current numpy random state. One image by default
+            height (int, *optional*), width (int, *optional*):
+                Canvas size, the UNet size by default
+            encoded (Tuple, *optional*, None):
+                encode_init_image output for image, when it was already run
         Returns:
             latents (np.ndarray):
-                Image encoded in latent space
+                Image encoded in latent space, one row per seed
         """
-        latents_shape = (1, 4, self.height // 8, self.width // 8)
-   
-        noise = np.random.randn(*latents_shape).astype(np.float32)
-        if image is None:
-            ##print("Image is NONE")
-            # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-            if isinstance(scheduler, LMSDiscreteScheduler):
+        if seeds is None:
+            seeds = [None]
+        height = height or self.height
+        width = width or self.width
+        latents_shape = (1, 4, height // 8, width // 8)
+
+        if encoded is None and image is not None:
+            encoded = self.encode_init_image(image, height, width)
+        moments, meta = encoded if encoded is not None else (None, {})
+
+        batch = []
+        for seed in seeds:
+            if seed is not None:
+                np.random.seed(int(seed))
+            noise = np.random.randn(*latents_shape).astype(np.float32)
+            if moments is None:
+                ##print("Image is NONE")
+                # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
+                if isinstance(scheduler, (LMSDiscreteScheduler, LMSDiscreteSchedulerNP)):
+                    noise = noise * np.asarray(scheduler.sigmas[0])
+                elif isinstance(scheduler, (EulerDiscreteScheduler, EulerDiscreteSchedulerNP)) or isinstance(scheduler,EulerAncestralDiscreteScheduler):
+                    noise = noise * np.asarray(scheduler.sigmas.max())
+                batch.append(noise)
+                continue
 
-                noise = noise * scheduler.sigmas[0].numpy()
-                return noise, {}
-            elif isinstance(scheduler, EulerDiscreteScheduler) or isinstance(scheduler,EulerAncestralDiscreteScheduler):
+            mean, logvar = np.split(moments, 2, axis=1)
 
-                noise = noise * scheduler.sigmas.max().numpy()
-                return noise, {}
-            else:
-                return noise, {}
-        input_image, meta = preprocess(image,self.height,self.width)
-       
-        moments = self.vae_encoder(input_image)[self._vae_e_output]
-      
-        mean, logvar = np.split(moments, 2, axis=1)
-  
-        std = np.exp(logvar * 0.5)
-        latents = (mean + std * np.random.randn(*mean.shape)) * 0.18215
-       
-         
-        latents = scheduler.add_noise(torch.from_numpy(latents), torch.from_numpy(noise), latent_timestep).numpy()
-        return latents, meta
+            std = np.exp(logvar * 0.5)
+            latents = (mean + std * np.random.randn(*mean.shape)) * 0.18215
+
+            latents = scheduler_add_noise(scheduler, latents, noise, latent_timestep)
+            batch.append(latents)
+
+        return np.concatenate(batch), meta
 
     def postprocess_image(self, image:np.ndarray, meta:Dict):
         """
@@ -469,6 +819,7 @@ class StableDiffusionEngine(DiffusionPipeline):
             tokenizer="openai/clip-vit-large-patch14",
             device=["CPU","CPU","CPU","CPU"]):
         
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')})
 
@@ -496,13 +847,11 @@ class StableDiffusionEngine(DiffusionPipeline):
             vae_en_future = executor.submit(self.load_model, model, "vae_encoder", device[3])
 
             if self.batch_size == 1:
-                if "int8" not in model:
-                    unet_future = executor.submit(self.load_model, model, "unet_bs1", device[1])
-                    unet_neg_future = executor.submit(self.load_model, model, "unet_bs1", device[2]) if device[1] != device[2] else None
-                else:
-                    unet_future = executor.submit(self.load_model, model, "unet_int8a16", device[1])
-                    unet_neg_future = executor.submit(self.load_model, model, "unet_int8a16", device[2]) if device[1] != device[2] else None
+                self.unet_name = "unet_bs1" if "int8" not in model else "unet_int8a16"
+                unet_future = executor.submit(self.load_model, model, self.unet_name, device[1])
+                unet_neg_future = executor.submit(self.load_model, model, self.unet_name, device[2]) if device[1] != device[2] else None
             else:
+                self.unet_name = "unet"
                 unet_future = executor.submit(self.load_model, model, "unet", device[1])
                 unet_neg_future = None
 
@@ -511,6 +860,7 @@ class StableDiffusionEngine(DiffusionPipeline):
             self.text_encoder = text_future.result()
             self.vae_decoder = vae_de_future.result()
             self.vae_encoder = vae_en_future.result()
+            self.tiled_vae = None
             print("Text Device:", device[0])
             print("unet Device:", device[1])
             print("unet-neg Device:", device[2])
@@ -527,15 +877,47 @@ class StableDiffusionEngine(DiffusionPipeline):
                 self.infer_request = self.unet.create_infer_request()
                 self.infer_request_neg = self.unet_neg.create_infer_request()
                 self._unet_neg_output = self.unet_neg.output(0)
+                self.infer_requests = [self.infer_request]
+                self.infer_requests_neg = [self.infer_request_neg]
             else:
                 self.infer_request = None
                 self.infer_request_neg = None
                 self._unet_neg_output = None
+                self.infer_requests = []
+                self.infer_requests_neg = []
+            self.vae_decoder_requests = []
          
         self.set_dimensions()
 
+        # models compiled for the model resolution, other resolutions are reshaped from the xml models
+        self.device = device
+        self.native_models = {"unet": self.unet, "unet_neg": self.unet_neg, "vae_decoder": self.vae_decoder,
+                              "vae_encoder": self.vae_encoder, "height": self.height, "width": self.width}
+        self.native_requests = (self.infer_requests, self.infer_requests_neg, self.vae_decoder_requests)
+        # batch 1 UNet of the batch 2 one, for the steps past the guidance cutoff
+        self.unet_batch_one = BatchOneModel(self.core, os.path.join(self.model_key, self.unet_name + ".xml"))
+        self.cond_unet_batch = None
+
         
 
+    def prepare_guidance_cutoff(self):
+        """
+        Compile the batch 1 UNet the steps past a guidance cutoff run on, ahead of the first run using it
+        """
+        if self.batch_size != 1:
+            self.cond_unet(1)
+
+    def cond_unet(self, num_requests):
+        """
+        UNetBatch of the batch 1 UNet of the batch 2 one, kept with its infer requests while the UNet
+        (resolution) and the number of requests stay the same
+        """
+        unet_cond = self.unet_batch_one.get(self.unet)
+        if (self.cond_unet_batch is None or self.cond_unet_batch[0] is not unet_cond or
+                len(self.cond_unet_batch[1].requests) != num_requests):
+            self.cond_unet_batch = (unet_cond, UNetBatch(unet_cond, [], num_requests, [0, 1, 2]))
+        return self.cond_unet_batch[1]
+
     def load_model(self, model, model_name, device):
         if "NPU" in device:
             with open(os.path.join(model, f"{model_name}.blob"), "rb") as f:
@@ -564,22 +946,36 @@ class StableDiffusionEngine(DiffusionPipeline):
             create_gif=False,
             model=None,
             callback=None,
-            callback_userdata=None
+            callback_userdata=None,
+            num_images=1,
+            seeds=None,
+            height=None,
+            width=None,
+            guidance_cutoff=1.0
     ):
+        """
+        num_images images are denoised together: the prompt is encoded once, the latents are stacked
+        and each step runs one UNet infer request per image concurrently. seeds (optional) gives the
+        seed of every image, so each one can be reproduced on its own.
+        height and width (optional) select the resolution: the UNet and the VAE are reshaped to it (see
+        use_resolution). Above MAX_RESHAPE_SCALE of the model resolution, each step runs the UNet over
+        overlapping windows of the canvas latents and blends the predictions.
+        guidance_cutoff (fraction of the steps) stops classifier free guidance: the later steps only run
+        the conditional UNet.
+        Returns a single image if num_images is 1, otherwise a list of images.
+        """
         # extract condition
-        text_input = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="np",
-        )
-        text_embeddings = self.text_encoder(text_input.input_ids)[self._text_encoder_output]
-        
+        def encode_prompt():
+            text_input = self.tokenizer(
+                prompt,
+                padding="max_length",
+                max_length=self.tokenizer.model_max_length,
+                truncation=True,
+                return_tensors="np",
+            )
+            return encode_prompt_cached(self.text_encoder, self._text_encoder_output, self.model_key, text_input.input_ids, prompt)
 
-        # do classifier free guidance
-        do_classifier_free_guidance = guidance_scale > 1.0
-        if do_classifier_free_guidance:
+        def encode_negative_prompt():
             if negative_prompt is None:
                 uncond_tokens = [""]
             elif isinstance(negative_prompt, str):
@@ -590,11 +986,26 @@ class StableDiffusionEngine(DiffusionPipeline):
             tokens_uncond = self.tokenizer(
                 uncond_tokens,
                 padding="max_length",
-                max_length=self.tokenizer.model_max_length,  # truncation=True,
+                max_length=self.tokenizer.model_max_length, #truncation=True,
                 return_tensors="np"
             )
-            uncond_embeddings = self.text_encoder(tokens_uncond.input_ids)[self._text_encoder_output]
-            text_embeddings = np.concatenate([uncond_embeddings, text_embeddings])
+            return encode_prompt_cached(self.text_encoder, self._text_encoder_output, self.model_key, tokens_uncond.input_ids, uncond_tokens)
+
+        # the prompts are encoded while the UNet / VAE are switched to the resolution and the init image is encoded
+        do_classifier_free_guidance = guidance_scale > 1.0
+        stages = StageGraph()
+        stages.add("prompt", encode_prompt)
+        if do_classifier_free_guidance:
+            stages.add("negative_prompt", encode_negative_prompt)
+        stages.add("resolution", lambda: use_resolution(self, height, width))
+        if init_image is not None:
+            stages.add("init_image", lambda size: self.encode_init_image(init_image, *size), deps=("resolution",))
+        preprocessed = stages.run()
+
+        text_embeddings = preprocessed["prompt"]
+        # do classifier free guidance
+        if do_classifier_free_guidance:
+            text_embeddings = np.concatenate([preprocessed["negative_prompt"], text_embeddings])
 
         # set timesteps
         accepts_offset = "offset" in set(inspect.signature(scheduler.set_timesteps).parameters.keys())
@@ -609,7 +1020,12 @@ class StableDiffusionEngine(DiffusionPipeline):
         latent_timestep = timesteps[:1]
 
         # get the initial random noise unless the user supplied it
-        latents, meta = self.prepare_latents(init_image, latent_timestep, scheduler,model)
+        height, width = preprocessed["resolution"]
+        latents, meta = self.prepare_latents(init_image, latent_timestep, scheduler,model, seeds=seeds or [None] * num_images,
+                                             height=height, width=width, encoded=preprocessed.get("init_image"))
+        windows = None
+        if (height, width) != (self.height, self.width):
+            windows = LatentWindows(latents.shape, (self.height // 8, self.width // 8))
 
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
@@ -622,64 +1038,79 @@ class StableDiffusionEngine(DiffusionPipeline):
         if create_gif:
             frames = []
 
+        # the infer requests keep their inputs between steps, only the latents and the timestep are written at each step
+        # on a larger canvas, one request (pair) per window running at the same time
+        num_requests = num_images if windows is None else LatentWindows.num_requests(self.unet, len(windows.windows))
+        if self.batch_size == 1:
+            # one neg / pos infer request pair per image, all running at the same time
+            timestep_name = "timestep" if "sample" in self.unet_input_tensor_name else "t"
+            unet_inputs = [self.unet_input_tensor_name, "encoder_hidden_states", timestep_name]
+            unet_neg = UNetBatch(self.unet_neg, self.infer_requests_neg, num_requests, unet_inputs)
+            unet_pos = UNetBatch(self.unet, self.infer_requests, num_requests, unet_inputs)
+            unet_neg.fill("encoder_hidden_states", text_embeddings[0])
+            unet_pos.fill("encoder_hidden_states", text_embeddings[-1])
+            guided_unets = (unet_neg, unet_pos)
+            cond_unets = (unet_pos,)
+            latent_name = self.unet_input_tensor_name
+        else:
+            # the batch 2 UNet takes uncond + cond of one image, so run one request per image
+            unet = UNetBatch(self.unet, self.infer_requests, num_requests, [0, 1, 2])
+            unet.fill(2, text_embeddings)
+            guided_unets = (unet,)
+            cond_unets = None
+            latent_name = 0
+            timestep_name = 1
+            if do_classifier_free_guidance and guidance_cutoff < 1.0:
+                # past the guidance cutoff, the batch 2 UNet is swapped for a batch 1 one taking the cond half,
+                # compiled before the first step
+                unet_cond = self.cond_unet(num_requests)
+                unet_cond.fill(2, text_embeddings[-1:])
+                cond_unets = (unet_cond,)
+
         for i, t in enumerate(self.progress_bar(timesteps)):
             if callback:
                 callback(i, callback_userdata)
 
-            if self.batch_size == 1:
-                # expand the latents if we are doing classifier free guidance
-                noise_pred = []
-                latent_model_input = latents 
-                   
-                #Scales the denoising model input by `(sigma**2 + 1) ** 0.5` to match the Euler algorithm.
-                latent_model_input = scheduler.scale_model_input(latent_model_input, t)
-                latent_model_input_pos = latent_model_input 
-                latent_model_input_neg = latent_model_input
-
-                if self.unet.input(self.unet_input_tensor_name).shape[1] != 4:
-                    try:
-                        latent_model_input_pos = latent_model_input_pos.permute(0,2,3,1)
-                    except:
-                        latent_model_input_pos = latent_model_input_pos.transpose(0,2,3,1)
-                
-                if self.unet_neg.input(self.unet_input_tensor_name).shape[1] != 4:
-                    try:
-                        latent_model_input_neg = latent_model_input_neg.permute(0,2,3,1)
-                    except:
-                        latent_model_input_neg = latent_model_input_neg.transpose(0,2,3,1)
-                
-                if "sample" in self.unet_input_tensor_name:                                        
-                    input_tens_neg_dict = {"sample" : latent_model_input_neg, "encoder_hidden_states": np.expand_dims(text_embeddings[0], axis=0), "timestep": np.expand_dims(np.float32(t), axis=0)}
-                    input_tens_pos_dict = {"sample" : latent_model_input_pos, "encoder_hidden_states": np.expand_dims(text_embeddings[1], axis=0), "timestep": np.expand_dims(np.float32(t), axis=0)}
-                else:
-                    input_tens_neg_dict = {"latent_model_input" : latent_model_input_neg, "encoder_hidden_states": np.expand_dims(text_embeddings[0], axis=0), "t": np.expand_dims(np.float32(t), axis=0)}
-                    input_tens_pos_dict = {"latent_model_input" : latent_model_input_pos, "encoder_hidden_states": np.expand_dims(text_embeddings[1], axis=0), "t": np.expand_dims(np.float32(t), axis=0)}
-                                                     
-                self.infer_request_neg.start_async(input_tens_neg_dict)
-                self.infer_request.start_async(input_tens_pos_dict)    
-         
-                self.infer_request_neg.wait()
-                self.infer_request.wait()
-
-                noise_pred_neg = self.infer_request_neg.get_output_tensor(0)
-                noise_pred_pos = self.infer_request.get_output_tensor(0)
-                               
-                noise_pred.append(noise_pred_neg.data.astype(np.float32))
-                noise_pred.append(noise_pred_pos.data.astype(np.float32))
+            #Scales the denoising model input by `(sigma**2 + 1) ** 0.5` to match the Euler algorithm.
+            latent_model_input = scheduler.scale_model_input(latents, t)
+
+            guided = do_classifier_free_guidance and guidance_active(i, len(timesteps), guidance_cutoff)
+            if guided or cond_unets is None and not do_classifier_free_guidance:
+                # (the batch 2 UNet without CFG takes the prompt twice)
+                unets = guided_unets
             else:
-                latent_model_input = np.concatenate([latents] * 2) if do_classifier_free_guidance else latents
-                latent_model_input = scheduler.scale_model_input(latent_model_input, t)
-                noise_pred = self.unet([latent_model_input, np.array(t, dtype=np.float32), text_embeddings])[self._unet_output]
-                
-            if do_classifier_free_guidance:
-                noise_pred_uncond, noise_pred_text = noise_pred[0], noise_pred[1]
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+                unets = cond_unets
+
+            if windows is not None:
+                for unet in unets:
+                    unet.fill(timestep_name, t)
+                noise_preds = windows.run(unets, latent_name, latent_model_input)
+            else:
+                for unet in unets:
+                    # the batch 2 UNet gets the same latent twice, the assignment broadcasts it
+                    unet.set_latents(latent_name, latent_model_input)
+                    unet.fill(timestep_name, t)
+                    unet.start()
+                noise_preds = [unet.wait() for unet in unets]
+
+            if unets[0].images_per_request == 2:
+                noise_pred_uncond, noise_pred_text = noise_preds[0][0::2], noise_preds[0][1::2]
+            else:
+                noise_pred_uncond, noise_pred_text = noise_preds[0], noise_preds[-1]
+
+            # perform guidance, in place in the output buffer of the positive UNet
+            if guided:
+                noise_pred = np.subtract(noise_pred_text, noise_pred_uncond, out=noise_pred_text)
+                noise_pred *= guidance_scale
+                noise_pred += noise_pred_uncond
+            else:
+                noise_pred = noise_pred_text
 
             # compute the previous noisy sample x_t -> x_t-1
-            latents = scheduler.step(torch.from_numpy(noise_pred), t, torch.from_numpy(latents), **extra_step_kwargs)["prev_sample"].numpy()
+            latents = scheduler_step(scheduler, noise_pred, t, latents, **extra_step_kwargs)
 
             if create_gif:
-                frames.append(latents)
+                frames.append(latents[:1])
 
         if callback:
             callback(num_inference_steps, callback_userdata)
@@ -687,13 +1118,45 @@ class StableDiffusionEngine(DiffusionPipeline):
         # scale and decode the image latents with vae
         #if self.height == 512 and self.width == 512:
         latents = 1 / 0.18215 * latents
-        image = self.vae_decoder(latents)[self._vae_d_output]
-        image = self.postprocess_image(image, meta)
+        if windows is not None:
+            image = canvas_vae(self, self.model_key, self.height // 8).decode(latents)
+        elif num_images == 1 or uses_tiles(self.tiled_vae, latents):
+            image = vae_decode(self.tiled_vae, self.vae_decoder, latents)
+        else:
+            image = wait_batch(start_batch(self.vae_decoder, self.vae_decoder_requests, [latents[k:k + 1] for k in range(num_images)]))
 
-        return image
+        images = [self.postprocess_image(image[k:k + 1], meta) for k in range(num_images)]
+
+        return images[0] if num_images == 1 else images
+
+    def encode_init_image(self, image: PIL.Image.Image, height=None, width=None):
+        """
+        VAE encoding of the init image, the first stage of prepare_latents
+
+        Parameters:
+            image (PIL.Image.Image):
+                Input image for generation
+            height (int, *optional*), width (int, *optional*):
+                Canvas size, the UNet size by default
+        Returns:
+            moments (np.ndarray):
+                VAE encoder output, read-only
+            meta (Dict):
+                Preprocessing metadata, for postprocess_image
+        """
+        height = height or self.height
+        width = width or self.width
+        input_image, meta = preprocess(image, height, width)
+        # the image is encoded once and sampled per seed
+        if (height, width) != (self.height, self.width):
+            tiled_vae = canvas_vae(self, self.model_key, self.height // 8)
+            moments = encode_image_cached(tiled_vae.encode, self.model_key, input_image, ("tiled", tiled_vae.tile_size))
+        else:
+            moments = vae_encode(self.tiled_vae, self.vae_encoder, input_image, self.model_key)
+        return moments, meta
 
     def prepare_latents(self, image: PIL.Image.Image = None, latent_timestep: torch.Tensor = None,
-                        scheduler=LMSDiscreteScheduler,model=None):
+                        scheduler=LMSDiscreteScheduler,model=None, seeds=None, height=None, width=None, encoded=None):
         """
         Function for getting initial latents for starting generation
 
@@ -702,42 +1165,55 @@ class StableDiffusionEngine(DiffusionPipeline):
                 Input image for generation, if not provided randon noise will be used as starting point
             latent_timestep (torch.Tensor, *optional*, None):
                 Predicted by scheduler initial step for image generation, required for latent image mixing with nosie
+            seeds (List, *optional*, None):
+                One seed per image, a None seed keeps the current numpy random state. One image by default
+            height (int, *optional*), width (int, *optional*):
+                Canvas size, the UNet size by default
+            encoded (Tuple, *optional*, None):
+                encode_init_image output for image, when it was already run
         Returns:
             latents (np.ndarray):
-                Image encoded in latent space
+                Image encoded in latent space, one row per seed
         """
-        latents_shape = (1, 4, self.height // 8, self.width // 8)
-
-        noise = np.random.randn(*latents_shape).astype(np.float32)
-        if image is None:
-            #print("Image is NONE")
-            # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-            if isinstance(scheduler, LMSDiscreteScheduler):
+        if seeds is None:
+            seeds = [None]
+        height = height or self.height
+        width = width or self.width
+        latents_shape = (1, 4, height // 8, width // 8)
+
+        if encoded is None and image is not None:
+            encoded = self.encode_init_image(image, height, width)
+        moments, meta = encoded if encoded is not None else (None, {})
+
+        batch = []
+        for seed in seeds:
+            if seed is not None:
+                np.random.seed(int(seed))
+            noise = np.random.randn(*latents_shape).astype(np.float32)
+            if moments is None:
+                #print("Image is NONE")
+                # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
+                if isinstance(scheduler, (LMSDiscreteScheduler, LMSDiscreteSchedulerNP)):
+                    noise = noise * np.asarray(scheduler.sigmas[0])
+                elif isinstance(scheduler, (EulerDiscreteScheduler, EulerDiscreteSchedulerNP)):
+                    noise = noise * np.asarray(scheduler.sigmas.max())
+                batch.append(noise)
+                continue
+
+            if "sd_2.1" in model:
+                latents = moments * 0.18215
 
-                noise = noise * scheduler.sigmas[0].numpy()
-                return noise, {}
-            elif isinstance(scheduler, EulerDiscreteScheduler):
-
-                noise = noise * scheduler.sigmas.max().numpy()
-                return noise, {}
             else:
-                return noise, {}
-        input_image, meta = preprocess(image, self.height, self.width)
 
-        moments = self.vae_encoder(input_image)[self._vae_e_output]
+                mean, logvar = np.split(moments, 2, axis=1)
 
-        if "sd_2.1" in model:
-            latents = moments * 0.18215
+                std = np.exp(logvar * 0.5)
+                latents = (mean + std * np.random.randn(*mean.shape)) * 0.18215
 
-        else:
-
-            mean, logvar = np.split(moments, 2, axis=1)
-
-            std = np.exp(logvar * 0.5)
-            latents = (mean + std * np.random.randn(*mean.shape)) * 0.18215
+            latents = scheduler_add_noise(scheduler, latents, noise, latent_timestep)
+            batch.append(latents)
 
-        latents = scheduler.add_noise(torch.from_numpy(latents), torch.from_numpy(noise), latent_timestep).numpy()
-        return latents, meta
+        return np.concatenate(batch), meta
         
   
     def postprocess_image(self, image: np.ndarray, meta: Dict):
@@ -818,6 +1294,7 @@ class LatentConsistencyEngine(DiffusionPipeline):
             self.tokenizer = CLIPTokenizer.from_pretrained(tokenizer)
             self.tokenizer.save_pretrained(model)
 
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')})  # adding caching to reduce init time
         try_enable_npu_turbo(device, self.core)
@@ -839,6 +1316,7 @@ class LatentConsistencyEngine(DiffusionPipeline):
 
         print(f"VAE Device: {device[2]}")
         self.vae_decoder = vae_de_future.result()
+        self.tiled_vae = None
         self.infer_request_vae = self.vae_decoder.create_infer_request()
         self.safety_checker = None #pipe.safety_checker
         self.feature_extractor = None #pipe.feature_extractor
@@ -894,8 +1372,8 @@ class LatentConsistencyEngine(DiffusionPipeline):
                     f" {self.tokenizer.model_max_length} tokens: {removed_text}"
                 )
 
-            prompt_embeds = self.text_encoder(text_input_ids, share_inputs=True, share_outputs=True)
-            prompt_embeds = torch.from_numpy(prompt_embeds[0])
+            prompt_embeds = encode_prompt_cached(self.text_encoder, 0, self.model_key, text_input_ids, prompt)
+            prompt_embeds = torch.from_numpy(np.array(prompt_embeds))
 
         bs_embed, seq_len, _ = prompt_embeds.shape
         # duplicate text embeddings for each generation per prompt
@@ -1044,9 +1522,7 @@ class LatentConsistencyEngine(DiffusionPipeline):
                 model_pred = self.unet([latents, ts, prompt_embeds, w_embedding],share_inputs=True, share_outputs=True)[0]
 
                 # compute the previous noisy sample x_t -> x_t-1
-                latents, denoised = scheduler.step(
-                    torch.from_numpy(model_pred), t, latents, return_dict=False
-                )
+                latents, denoised = scheduler_step_denoised(scheduler, model_pred, t, latents)
                 progress_bar.update()
 
         #print("After Step 6: ")
@@ -1054,7 +1530,10 @@ class LatentConsistencyEngine(DiffusionPipeline):
         vae_start = time.time()
 
         if not output_type == "latent":
-            image = torch.from_numpy(self.vae_decoder(denoised / 0.18215, share_inputs=True, share_outputs=True)[0])
+            if uses_tiles(self.tiled_vae, denoised):
+                image = torch.from_numpy(self.tiled_vae.decode(denoised / 0.18215))
+            else:
+                image = torch.from_numpy(self.vae_decoder(denoised / 0.18215, share_inputs=True, share_outputs=True)[0])
         else:
             image = denoised
 
@@ -1074,6 +1553,40 @@ class LatentConsistencyEngine(DiffusionPipeline):
 
         return image[0]
 
+# outputs of the reference-only "write" UNet, in the order the "read" UNet takes them after its first 3 inputs
+REFERENCE_ATTENTION_OUTPUTS = [
+    "/unet/down_blocks.0/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/down_blocks.0/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/down_blocks.1/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/down_blocks.1/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/down_blocks.2/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/down_blocks.2/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/mid_block/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.1/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.1/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.1/attentions.2/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.2/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.2/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.2/attentions.2/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.3/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.3/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0",
+    "/unet/up_blocks.3/attentions.2/transformer_blocks.0/norm1/LayerNormalization_output_0",
+]
+
+def scale_model_input_at(scheduler, sample, timestep):
+    """
+    scheduler.scale_model_input for a timestep ahead of the current step: sigma schedulers scale by the sigma
+    of that timestep instead of their step index, which only moves with scheduler.step
+    """
+    if isinstance(scheduler, MultistepScheduler):
+        # the multistep solvers don't scale the model input
+        return np.asarray(sample)
+    sigmas = getattr(scheduler, "sigmas", None)
+    if sigmas is None or not hasattr(scheduler, "index_for_timestep"):
+        return scheduler.scale_model_input(sample, timestep)
+    sigma = float(np.asarray(sigmas)[scheduler.index_for_timestep(timestep)])
+    return np.asarray(sample) / ((sigma ** 2 + 1) ** 0.5)
+
 class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
     def __init__(
             self,
@@ -1092,6 +1605,7 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
         #self.scheduler = scheduler
         # models
      
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')}) #adding caching to reduce init time
         # text features
@@ -1114,6 +1628,7 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
         print("Vae Device:",device[2])
         
         self.vae_decoder = self.core.compile_model(os.path.join(model, "vae_decoder.xml"), device[2])
+        self.tiled_vae = None
             
         # encoder
             
@@ -1127,6 +1642,10 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
         self.height = self.unet_w.input(0).shape[2] * 8
         self.width = self.unet_w.input(0).shape[3] * 8      
 
+        # the write passes run up to len(self.write_requests) steps ahead of the read passes
+        self.write_requests = [self.unet_w.create_infer_request() for _ in range(2)]
+        self.read_request = self.unet_r.create_infer_request()
+
 
 
     def __call__(
@@ -1208,6 +1727,30 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
         if create_gif:
             frames = []        
 
+        # The write pass of a step only depends on the reference latents, its noise and the timestep, so it
+        # runs ahead on its own infer requests while the read passes run. The noise of every step is drawn
+        # up front, in step order, so the results don't depend on how far ahead the write passes run.
+        ref_noises = [randn_tensor(ref_image_latents.shape) for _ in timesteps]
+        write_requests = self.write_requests
+
+        def start_write(step):
+            t = timesteps[step]
+            ref_xt = scheduler_add_noise(
+                scheduler,
+                ref_image_latents,
+                ref_noises[step],
+                t.reshape(
+                    1,
+                ),
+            )
+            ref_xt = np.concatenate([ref_xt] * 2) if do_classifier_free_guidance else ref_xt
+            ref_xt = scale_model_input_at(scheduler, ref_xt, t)
+            # MODE = "write"
+            write_requests[step % len(write_requests)].start_async([ref_xt, t, text_embeddings])
+
+        for step in range(min(len(write_requests), len(timesteps))):
+            start_write(step)
+
         for i, t in enumerate(self.progress_bar(timesteps)):
             if callback:
                callback(i, callback_userdata)
@@ -1215,59 +1758,27 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
             # expand the latents if we are doing classifier free guidance
             latent_model_input = np.concatenate([latents] * 2) if do_classifier_free_guidance else latents
             latent_model_input = scheduler.scale_model_input(latent_model_input, t)
-            
-            # ref only part
-            noise = randn_tensor(
-                ref_image_latents.shape
-            )
-               
-            ref_xt = scheduler.add_noise(
-                torch.from_numpy(ref_image_latents),
-                noise,
-                t.reshape(
-                    1,
-                ),    
-            ).numpy()
-            ref_xt = np.concatenate([ref_xt] * 2) if do_classifier_free_guidance else ref_xt
-            ref_xt = scheduler.scale_model_input(ref_xt, t)
 
-            # MODE = "write"
-            result_w_dict = self.unet_w([
-                ref_xt,
-                t,
-                text_embeddings
-            ])
-            down_0_attn0 = result_w_dict["/unet/down_blocks.0/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            down_0_attn1 = result_w_dict["/unet/down_blocks.0/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            down_1_attn0 = result_w_dict["/unet/down_blocks.1/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            down_1_attn1 = result_w_dict["/unet/down_blocks.1/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            down_2_attn0 = result_w_dict["/unet/down_blocks.2/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            down_2_attn1 = result_w_dict["/unet/down_blocks.2/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            mid_attn0    = result_w_dict["/unet/mid_block/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_1_attn0   = result_w_dict["/unet/up_blocks.1/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_1_attn1   = result_w_dict["/unet/up_blocks.1/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_1_attn2   = result_w_dict["/unet/up_blocks.1/attentions.2/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_2_attn0   = result_w_dict["/unet/up_blocks.2/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_2_attn1   = result_w_dict["/unet/up_blocks.2/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_2_attn2   = result_w_dict["/unet/up_blocks.2/attentions.2/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_3_attn0   = result_w_dict["/unet/up_blocks.3/attentions.0/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_3_attn1   = result_w_dict["/unet/up_blocks.3/attentions.1/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-            up_3_attn2   = result_w_dict["/unet/up_blocks.3/attentions.2/transformer_blocks.0/norm1/LayerNormalization_output_0"]
-                
-            # MODE = "read"
-            noise_pred = self.unet_r([
-                latent_model_input, t, text_embeddings, down_0_attn0, down_0_attn1, down_1_attn0,
-                down_1_attn1, down_2_attn0, down_2_attn1, mid_attn0, up_1_attn0, up_1_attn1, up_1_attn2, 
-                up_2_attn0, up_2_attn1, up_2_attn2, up_3_attn0, up_3_attn1, up_3_attn2
-            ])[0]
-                
+            write_request = write_requests[i % len(write_requests)]
+            write_request.wait()
+            read_inputs = {0: latent_model_input, 1: t, 2: text_embeddings}
+            for k, name in enumerate(REFERENCE_ATTENTION_OUTPUTS):
+                read_inputs[3 + k] = write_request.get_tensor(name).data
+
+            # MODE = "read", the inputs are copied when the request starts, so the write request is free again
+            self.read_request.start_async(read_inputs)
+            if i + len(write_requests) < len(timesteps):
+                start_write(i + len(write_requests))
+            self.read_request.wait()
+            noise_pred = self.read_request.get_output_tensor(0).data
+
             # perform guidance
             if do_classifier_free_guidance:
                 noise_pred_uncond, noise_pred_text = noise_pred[0], noise_pred[1]
                 noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
 
             # compute the previous noisy sample x_t -> x_t-1
-            latents = scheduler.step(torch.from_numpy(noise_pred), t, torch.from_numpy(latents), **extra_step_kwargs)["prev_sample"].numpy()
+            latents = scheduler_step(scheduler, noise_pred, t, latents, **extra_step_kwargs)
      
             if create_gif:
                 frames.append(latents)
@@ -1277,7 +1788,7 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
 
         # scale and decode the image latents with vae
         
-        image = self.vae_decoder(latents)[self._vae_d_output]
+        image = vae_decode(self.tiled_vae, self.vae_decoder, latents)
       
         image = self.postprocess_image(image, meta)
 
@@ -1286,7 +1797,7 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
             if not os.path.exists(gif_folder):
                 os.makedirs(gif_folder)
             for i in range(0,len(frames)):
-                image = self.vae_decoder(frames[i])[self._vae_d_output]
+                image = vae_decode(self.tiled_vae, self.vae_decoder, frames[i])
                 image = self.postprocess_image(image, meta)
                 output = gif_folder + "/" + str(i).zfill(3) +".png"
                 cv2.imwrite(output, image)
@@ -1303,7 +1814,7 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
         #refimage = refimage.to(device=device, dtype=dtype)
 
         # encode the mask image into latents space so we can concatenate it to the latents
-        moments = self.vae_encoder(refimage)[0]
+        moments = vae_encode(self.tiled_vae, self.vae_encoder, refimage, self.model_key)
         mean, logvar = np.split(moments, 2, axis=1)
         std = np.exp(logvar * 0.5)
         ref_image_latents = (mean + std * np.random.randn(*mean.shape))
@@ -1333,19 +1844,19 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
         if image is None:
             #print("Image is NONE")
             # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-            if isinstance(scheduler, LMSDiscreteScheduler):
+            if isinstance(scheduler, (LMSDiscreteScheduler, LMSDiscreteSchedulerNP)):
              
-                noise = noise * scheduler.sigmas[0].numpy()
+                noise = noise * np.asarray(scheduler.sigmas[0])
                 return noise, {}
-            elif isinstance(scheduler, EulerDiscreteScheduler):
+            elif isinstance(scheduler, (EulerDiscreteScheduler, EulerDiscreteSchedulerNP)):
               
-                noise = noise * scheduler.sigmas.max().numpy()
+                noise = noise * np.asarray(scheduler.sigmas.max())
                 return noise, {}
             else:
                 return noise, {}
         input_image, meta = preprocess(image,self.height,self.width)
        
-        moments = self.vae_encoder(input_image)[self._vae_e_output]
+        moments = vae_encode(self.tiled_vae, self.vae_encoder, input_image, self.model_key)
       
         mean, logvar = np.split(moments, 2, axis=1)
   
@@ -1353,7 +1864,7 @@ class StableDiffusionEngineReferenceOnly(DiffusionPipeline):
         latents = (mean + std * np.random.randn(*mean.shape)) * 0.18215
        
          
-        latents = scheduler.add_noise(torch.from_numpy(latents), torch.from_numpy(noise), latent_timestep).numpy()
+        latents = scheduler_add_noise(scheduler, latents, noise, latent_timestep)
         return latents, meta
 
     def postprocess_image(self, image:np.ndarray, meta:Dict):
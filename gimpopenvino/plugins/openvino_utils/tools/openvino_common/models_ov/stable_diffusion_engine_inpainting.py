@@ -27,6 +27,13 @@ from PIL import Image
 import glob
 import json
 
+from .schedulers_np import scheduler_step, scheduler_add_noise, LMSDiscreteSchedulerNP, EulerDiscreteSchedulerNP
+from .guidance import guidance_active
+from .tiled_vae import vae_decode, vae_encode
+from .inpaint_crop import mask_crop_box, paste_inpainted
+from .stage_graph import StageGraph
+from .inference_cache import BatchOneModel
+
 def prepare_mask_and_masked_image(image, mask, height, width, return_image: bool = False):
     """
     Prepares a pair (image, mask) to be consumed by the Stable Diffusion pipeline. This means that those inputs will be
@@ -169,6 +176,7 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
         #self.scheduler = scheduler
         # models
      
+        self.model_key = model
         self.core = Core()
         self.core.set_property({'CACHE_DIR': os.path.join(model, 'cache')}) #adding caching to reduce init time
         # text features
@@ -188,6 +196,9 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
         
         
         self.vae_decoder = self.core.compile_model(os.path.join(model, "vae_decoder.xml"), device[2])
+        self.tiled_vae = None
+        # batch 1 UNet, for the steps past the guidance cutoff
+        self.unet_batch_one = BatchOneModel(self.core, os.path.join(model, "unet.xml"))
             
         # encoder
             
@@ -217,38 +228,60 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
             create_gif = False,
             model = None,
             callback = None,
-            callback_userdata = None
+            callback_userdata = None,
+            crop_to_mask = False,
+            crop_margin = 64,
+            crop_feather = 8,
+            guidance_cutoff = 1.0
     ):
+        """
+        With crop_to_mask, only the bounding box of the mask grown by crop_margin pixels (and to the aspect
+        ratio of the engine) is inpainted at the engine resolution, then composited back into the source image
+        with a crop_feather pixels blend, so the result keeps the source resolution.
+        guidance_cutoff (fraction of the steps) stops classifier free guidance: the later steps only run
+        the conditional UNet.
+        """
+        crop_box = mask_crop_box(mask_image, crop_margin, self.width / self.height) if crop_to_mask else None
+        if crop_box is not None:
+            source_image, source_mask = image, mask_image
+            image, mask_image = image.crop(crop_box), mask_image.crop(crop_box)
+
         # extract condition
-        text_input = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="np",
-        )
-        text_embeddings = self.text_encoder(text_input.input_ids)[self._text_encoder_output]
-    
+        def encode_text(tokens, **kwargs):
+            text_input = self.tokenizer(
+                tokens,
+                padding="max_length",
+                max_length=self.tokenizer.model_max_length,
+                return_tensors="np",
+                **kwargs
+            )
+            # an infer request per prompt, the prompt and the negative prompt are encoded at the same time
+            return self.text_encoder.create_infer_request().infer([text_input.input_ids])[self._text_encoder_output]
 
-        # do classifier free guidance
+        if negative_prompt is None:
+            uncond_tokens = [""]
+        elif isinstance(negative_prompt, str):
+            uncond_tokens = [negative_prompt]
+        else:
+            uncond_tokens = negative_prompt
+
+        # the prompts, the masked image and the init image are encoded at the same time
         do_classifier_free_guidance = guidance_scale > 1.0
+        stages = StageGraph()
+        stages.add("prompt", lambda: encode_text(prompt, truncation=True))
         if do_classifier_free_guidance:
-        
-            if negative_prompt is None:
-                uncond_tokens = [""]
-            elif isinstance(negative_prompt, str):
-                uncond_tokens = [negative_prompt]
-            else:
-                uncond_tokens = negative_prompt
-                
-            tokens_uncond = self.tokenizer(
-                uncond_tokens,
-                padding="max_length",
-                max_length=self.tokenizer.model_max_length, #truncation=True,  
-                return_tensors="np"
-            )
-            uncond_embeddings = self.text_encoder(tokens_uncond.input_ids)[self._text_encoder_output]
-            text_embeddings = np.concatenate([uncond_embeddings, text_embeddings])
+            stages.add("negative_prompt", lambda: encode_text(uncond_tokens))
+        stages.add("mask", lambda: prepare_mask_and_masked_image(image, mask_image, self.height, self.width, return_image=True))
+        stages.add("masked_image", lambda prepared: vae_encode(self.tiled_vae, self.vae_encoder, prepared[1], self.model_key),
+                   deps=("mask",))
+        stages.add("init_image", lambda prepared: vae_encode(self.tiled_vae, self.vae_encoder, prepared[2], self.model_key),
+                   deps=("mask",))
+        preprocessed = stages.run()
+
+        text_embeddings = preprocessed["prompt"]
+        # do classifier free guidance
+        if do_classifier_free_guidance:
+            text_embeddings = np.concatenate([preprocessed["negative_prompt"], text_embeddings])
 
         # set timesteps
         accepts_offset = "offset" in set(inspect.signature(scheduler.set_timesteps).parameters.keys())
@@ -263,13 +296,13 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
         latent_timestep = timesteps[:1]
 
         #preprocess image and mask
-        mask, masked_image, init_image = prepare_mask_and_masked_image(
-            image, mask_image, self.height, self.width, return_image=True)
+        mask, masked_image, init_image = preprocessed["mask"]
         
-        mask, masked_image_latents = self.prepare_mask_latents(mask, masked_image, do_classifier_free_guidance)
+        mask, masked_image_latents = self.prepare_mask_latents(mask, masked_image, do_classifier_free_guidance,
+                                                               moments=preprocessed["masked_image"])
 
         # get the initial random noise unless the user supplied it
-        latents = self.prepare_latents(init_image, latent_timestep, scheduler)
+        latents = self.prepare_latents(init_image, latent_timestep, scheduler, moments=preprocessed["init_image"])
 
 
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -283,10 +316,23 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
         if create_gif:
             frames = []        
 
+        # compiled before the first step
+        unet_cond = self.unet_batch_one.get(self.unet) if do_classifier_free_guidance and guidance_cutoff < 1.0 else None
         for i, t in enumerate(self.progress_bar(timesteps)):
             if callback:
                callback(i, callback_userdata)
 
+            guided = do_classifier_free_guidance and guidance_active(i, len(timesteps), guidance_cutoff)
+            if do_classifier_free_guidance and not guided:
+                # past the guidance cutoff, the conditional half alone on a batch 1 UNet
+                latent_model_input = scheduler.scale_model_input(latents, t)
+                latent_model_input = np.concatenate([latent_model_input, mask[-1:], masked_image_latents[-1:]], axis=1)
+                noise_pred = unet_cond([latent_model_input, float(t), text_embeddings[-1:]])[unet_cond.output(0)]
+                latents = scheduler_step(scheduler, noise_pred, t, latents, **extra_step_kwargs)
+                if create_gif:
+                    frames.append(latents)
+                continue
+
             # expand the latents if we are doing classifier free guidance
             latent_model_input = np.concatenate([latents] * 2) if do_classifier_free_guidance else latents
             latent_model_input = scheduler.scale_model_input(latent_model_input, t)
@@ -301,7 +347,7 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
                 noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
 
             # compute the previous noisy sample x_t -> x_t-1
-            latents = scheduler.step(torch.from_numpy(noise_pred), t, torch.from_numpy(latents), **extra_step_kwargs)["prev_sample"].numpy()
+            latents = scheduler_step(scheduler, noise_pred, t, latents, **extra_step_kwargs)
      
             if create_gif:
                 frames.append(latents)
@@ -313,16 +359,18 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
         
         latents = 1 / 0.18215 * latents
         
-        image = self.vae_decoder(latents)[self._vae_d_output]
+        image = vae_decode(self.tiled_vae, self.vae_decoder, latents)
       
         image = self.postprocess_image(image)
+        if crop_box is not None:
+            image = paste_inpainted(source_image, source_mask, crop_box, image, crop_feather)
 
         if create_gif:
             gif_folder=os.path.join(model,"../../../gif")
             if not os.path.exists(gif_folder):
                 os.makedirs(gif_folder)
             for i in range(0,len(frames)):
-                image = self.vae_decoder(frames[i])[self._vae_d_output]
+                image = vae_decode(self.tiled_vae, self.vae_decoder, frames[i])
                 image = self.postprocess_image(image)
                 output = gif_folder + "/" + str(i).zfill(3) +".png"
                 cv2.imwrite(output, image)
@@ -335,7 +383,13 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
 
         return image
     
-    def prepare_latents(self, input_image:PIL.Image.Image = None, latent_timestep:torch.Tensor = None, scheduler = LMSDiscreteScheduler):
+    def prepare_guidance_cutoff(self):
+        """
+        Compile the batch 1 UNet the steps past a guidance cutoff run on, ahead of the first run using it
+        """
+        self.unet_batch_one.get(self.unet)
+
+    def prepare_latents(self, input_image:PIL.Image.Image = None, latent_timestep:torch.Tensor = None, scheduler = LMSDiscreteScheduler, moments = None):
         """
         Function for getting initial latents for starting generation
         
@@ -344,6 +398,8 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
                 Input image for generation, if not provided randon noise will be used as starting point
             latent_timestep (torch.Tensor, *optional*, None):
                 Predicted by scheduler initial step for image generation, required for latent image mixing with nosie
+            moments (np.ndarray, *optional*, None):
+                VAE encoder output for image, when it was already encoded
         Returns:
             latents (np.ndarray):
                 Image encoded in latent space
@@ -354,18 +410,19 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
         if input_image is None:
             #print("Image is NONE")
             # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-            if isinstance(scheduler, LMSDiscreteScheduler):
+            if isinstance(scheduler, (LMSDiscreteScheduler, LMSDiscreteSchedulerNP)):
              
-                noise = noise * scheduler.sigmas[0].numpy()
+                noise = noise * np.asarray(scheduler.sigmas[0])
                 return noise, {}
-            elif isinstance(scheduler, EulerDiscreteScheduler):
+            elif isinstance(scheduler, (EulerDiscreteScheduler, EulerDiscreteSchedulerNP)):
               
-                noise = noise * scheduler.sigmas.max().numpy()
+                noise = noise * np.asarray(scheduler.sigmas.max())
                 return noise, {}
             else:
                 return noise, {}
        
-        moments = self.vae_encoder(input_image)[self._vae_e_output]
+        if moments is None:
+            moments = vae_encode(self.tiled_vae, self.vae_encoder, input_image, self.model_key)
       
         mean, logvar = np.split(moments, 2, axis=1)
   
@@ -373,12 +430,13 @@ class StableDiffusionEngineInpainting(DiffusionPipeline):
         latents = (mean + std * np.random.randn(*mean.shape)) * 0.18215
        
          
-        latents = scheduler.add_noise(torch.from_numpy(latents), torch.from_numpy(noise), latent_timestep).numpy()
+        latents = scheduler_add_noise(scheduler, latents, noise, latent_timestep)
         return latents
 
-    def prepare_mask_latents(self, mask = None, masked_image = None, do_classifier_free_guidance = True):
+    def prepare_mask_latents(self, mask = None, masked_image = None, do_classifier_free_guidance = True, moments = None):
          mask = torch.nn.functional.interpolate(mask, size=(self.height // 8, self.width // 8)).numpy()                                        
-         moments = self.vae_encoder(masked_image)[self._vae_e_output] 
+         if moments is None:
+             moments = vae_encode(self.tiled_vae, self.vae_encoder, masked_image, self.model_key)
          mean, logvar = np.split(moments, 2, axis=1) 
          std = np.exp(logvar * 0.5)
          masked_image_latents = (mean + std * np.random.randn(*mean.shape)) * 0.18215
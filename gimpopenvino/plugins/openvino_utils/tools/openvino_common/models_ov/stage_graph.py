@@ -0,0 +1,98 @@
+"""
+Copyright(C) 2022-2023 Intel Corporation
+SPDX - License - Identifier: Apache - 2.0
+
+Per-request preprocessing as a small dependency graph. The stages that run before the first UNet
+step (text encoder for the prompt and for the negative prompt, VAE encoder for the init image or the
+mask, control image annotation) don't depend on each other: each one is started on a shared thread
+pool as soon as the stages it needs are done. OpenVINO releases the GIL while inferring, so the
+infer requests of independent stages overlap.
+"""
+import concurrent.futures
+import threading
+import time
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def stage_executor(max_workers=4):
+    """
+    Thread pool shared by the stage graphs of all the engines in the process
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage")
+    return _executor
+
+
+class StageGraph:
+    """
+    Stages of one request, run on the stage executor in dependency order.
+
+    Parameters:
+        name (str): printed with the stage timings
+        executor (concurrent.futures.Executor, *optional*): pool to run the stages on, stage_executor() by default
+        verbose (bool): print the stage timings after each run, they are kept in seconds either way
+    """
+    def __init__(self, name="preprocessing", executor=None, verbose=False):
+        self.name = name
+        self.executor = executor
+        self.verbose = verbose
+        self.stages = {}
+        self.seconds = {}
+
+    def add(self, name, fn, deps=()):
+        """
+        Parameters:
+            name (str): stage name, its result is returned under it
+            fn (Callable): called with the results of deps, in order
+            deps (Tuple[str]): stages fn needs, they must have been added before
+        Returns:
+            self, so stages can be chained
+        """
+        if name in self.stages:
+            raise ValueError("Stage %s was already added" % name)
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError("Stage %s depends on unknown stage %s" % (name, dep))
+        self.stages[name] = (fn, tuple(deps))
+        return self
+
+    def _timed(self, name, fn, args):
+        start = time.time()
+        result = fn(*args)
+        self.seconds[name] = time.time() - start
+        return result
+
+    def run(self):
+        """
+        Returns:
+            results (Dict[str, Any]): result of every stage by name. The first exception raised by a
+                stage is raised here, once the stages already running are done.
+        """
+        executor = self.executor or stage_executor()
+        start = time.time()
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        try:
+            while pending or running:
+                for name, (fn, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        del pending[name]
+                        args = [results[dep] for dep in deps]
+                        running[executor.submit(self._timed, name, fn, args)] = name
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        finally:
+            concurrent.futures.wait(running)
+
+        if self.verbose:
+            print("%s: %s, %.3fs overall" % (self.name, ", ".join("%s %.3fs" % (name, self.seconds[name])
+                                                                 for name in self.stages if name in self.seconds),
+                                             time.time() - start))
+        return results
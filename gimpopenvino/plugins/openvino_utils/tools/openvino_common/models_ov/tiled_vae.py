@@ -0,0 +1,222 @@
+"""
+Copyright(C) 2022-2023 Intel Corporation
+SPDX - License - Identifier: Apache - 2.0
+
+Tiled VAE decoder / encoder, to bound the peak memory of the VAE on large images.
+
+The VAE is reshaped to a tile and compiled once per tile shape. Overlapping tiles are run one
+after the other, and their outputs are blended with linear ramps over the overlap.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .inference_cache import encode_image_cached
+
+# bytes per output pixel of the widest VAE activations (128 channels, float32), times the number
+# of such activations alive at the same time. Only used to compare a resolution with memory_limit_mb.
+VAE_BYTES_PER_PIXEL = 128 * 4 * 6
+LATENT_SCALE = 8
+
+
+def vae_memory_mb(latent_height, latent_width):
+    """
+    Rough peak memory of a VAE run on a latent of the given size
+    """
+    pixels = latent_height * LATENT_SCALE * latent_width * LATENT_SCALE
+    return pixels * VAE_BYTES_PER_PIXEL / (1024 * 1024)
+
+
+def tile_starts(length, tile, overlap):
+    """
+    Start positions of tiles of size `tile` covering [0, length), overlapping by at least `overlap`
+    """
+    if length <= tile:
+        return [0]
+    stride = max(1, tile - overlap)
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def blend_ramp(size, overlap):
+    """
+    Blending weights along one axis of a tile: linear ramps over the overlap, 1 in the middle
+    """
+    if overlap <= 0:
+        return np.ones(size, dtype=np.float32)
+    position = np.arange(size, dtype=np.float32)
+    ramp = np.minimum(position + 1, size - position) / (overlap + 1)
+    return np.minimum(ramp, 1.0).astype(np.float32)
+
+
+class TiledVAE:
+    """
+    Runs the VAE decoder and encoder of a model folder over overlapping tiles.
+
+    Parameters:
+        core (openvino.runtime.Core): core used to read and compile the tile shaped models
+        model (str): model folder, containing vae_decoder.xml and vae_encoder.xml
+        device (str): device the tiles are compiled for
+        tile_size (int, *optional*): tile size in latent pixels (8 image pixels per latent pixel)
+        overlap (int): overlap between tiles in latent pixels
+        memory_limit_mb (int, *optional*): VAE peak memory ceiling. Images whose estimated VAE memory is
+            below it are not tiled, above it the tile size is reduced until a tile fits.
+    """
+    def __init__(self, core, model, device="CPU", tile_size=None, overlap=8, memory_limit_mb=None):
+        self.core = core
+        self.model = model
+        self.device = device
+        self.overlap = overlap
+        self.memory_limit_mb = memory_limit_mb
+        self.fixed_tile_size = tile_size
+        self.tile_size = tile_size
+        if memory_limit_mb is not None:
+            limit_tile = self.tile_for_memory(memory_limit_mb)
+            self.tile_size = limit_tile if tile_size is None else min(tile_size, limit_tile)
+        self.compiled = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tile_for_memory(memory_limit_mb, minimum=16):
+        tile = minimum
+        while vae_memory_mb(tile + 8, tile + 8) <= memory_limit_mb:
+            tile += 8
+        return tile
+
+    def should_tile(self, latent_height, latent_width):
+        if self.tile_size is None:
+            return False
+        if latent_height <= self.tile_size and latent_width <= self.tile_size:
+            return False
+        if self.fixed_tile_size is None:
+            # only the memory ceiling was given, tile only what doesn't fit under it
+            return vae_memory_mb(latent_height, latent_width) > self.memory_limit_mb
+        return True
+
+    def compiled_tile(self, name, height, width):
+        """
+        Returns `name` (vae_decoder or vae_encoder) compiled for an input of height x width pixels
+        """
+        key = (name, height, width)
+        with self.lock:
+            compiled = self.compiled.get(key)
+            if compiled is None:
+                model = self.core.read_model(os.path.join(self.model, name + ".xml"))
+                channels = model.input(0).partial_shape[1].get_length()
+                model.reshape([1, channels, height, width])
+                print("Compiling tiled %s %dx%d on %s" % (name, width, height, self.device))
+                compiled = self.core.compile_model(model, self.device)
+                self.compiled[key] = compiled
+        return compiled
+
+    def run_tiles(self, name, inputs, in_scale, out_scale):
+        """
+        Parameters:
+            name (str): vae_decoder or vae_encoder
+            inputs (np.ndarray): NCHW input, batch 1
+            in_scale (int), out_scale (int): input and output pixels per latent pixel
+        Returns:
+            output (np.ndarray): blended NCHW output
+        """
+        latent_height = inputs.shape[2] // in_scale
+        latent_width = inputs.shape[3] // in_scale
+        tile_height = min(self.tile_size, latent_height)
+        tile_width = min(self.tile_size, latent_width)
+        compiled = self.compiled_tile(name, tile_height * in_scale, tile_width * in_scale)
+        infer_request = compiled.create_infer_request()
+
+        weights = np.outer(blend_ramp(tile_height * out_scale, self.overlap * out_scale),
+                           blend_ramp(tile_width * out_scale, self.overlap * out_scale))
+        output = None
+        weight_sum = np.zeros((latent_height * out_scale, latent_width * out_scale), dtype=np.float32)
+
+        for y in tile_starts(latent_height, tile_height, self.overlap):
+            for x in tile_starts(latent_width, tile_width, self.overlap):
+                tile = inputs[:, :, y * in_scale:(y + tile_height) * in_scale, x * in_scale:(x + tile_width) * in_scale]
+                result = infer_request.infer([np.ascontiguousarray(tile)])[compiled.output(0)]
+                if output is None:
+                    output = np.zeros((inputs.shape[0], result.shape[1]) + weight_sum.shape, dtype=np.float32)
+
+                rows = slice(y * out_scale, (y + tile_height) * out_scale)
+                cols = slice(x * out_scale, (x + tile_width) * out_scale)
+                output[:, :, rows, cols] += result * weights
+                weight_sum[rows, cols] += weights
+
+        output /= weight_sum
+        return output
+
+    def decode(self, latents):
+        return np.concatenate([self.run_tiles("vae_decoder", latents[k:k + 1], 1, LATENT_SCALE)
+                               for k in range(latents.shape[0])])
+
+    def encode(self, image):
+        return np.concatenate([self.run_tiles("vae_encoder", image[k:k + 1], LATENT_SCALE, 1)
+                               for k in range(image.shape[0])])
+
+
+# tilers of the canvas runs, kept apart from the engines so only the canvas runs use them
+_canvas_vaes = OrderedDict()
+_canvas_vaes_lock = threading.Lock()
+MAX_CANVAS_VAES = 2
+
+
+def canvas_vae(engine, model, tile_size):
+    """
+    Tiled VAE for canvases larger than the compiled VAE: the one configured on the engine,
+    otherwise one with tiles of the compiled size, compiled from the xml models of `model`.
+    The engine is left as it is, its other runs don't start tiling after a canvas run.
+    """
+    if engine.tiled_vae is not None:
+        return engine.tiled_vae
+    try:
+        device = engine.vae_decoder.get_property("EXECUTION_DEVICES")[0]
+    except Exception:
+        device = "CPU"
+    if "NPU" in device:
+        device = "CPU"
+    key = (str(model), device, tile_size)
+    with _canvas_vaes_lock:
+        tiled_vae = _canvas_vaes.get(key)
+        if tiled_vae is None:
+            tiled_vae = TiledVAE(engine.core, model, device, tile_size=tile_size)
+            _canvas_vaes[key] = tiled_vae
+            while len(_canvas_vaes) > MAX_CANVAS_VAES:
+                _canvas_vaes.popitem(last=False)
+        else:
+            _canvas_vaes.move_to_end(key)
+    return tiled_vae
+
+
+def uses_tiles(tiled_vae, latents):
+    return tiled_vae is not None and tiled_vae.should_tile(latents.shape[2], latents.shape[3])
+
+
+def vae_decode(tiled_vae, vae_decoder, latents):
+    """
+    Decode latents with the compiled VAE decoder, or over tiles when tiling is enabled and needed
+    """
+    if uses_tiles(tiled_vae, latents):
+        return tiled_vae.decode(latents)
+    return vae_decoder(latents)[0]
+
+
+def vae_encode(tiled_vae, vae_encoder, image, model_key=None):
+    """
+    Encode an NCHW image with the compiled VAE encoder, or over tiles when tiling is enabled and needed.
+    With model_key, the output is cached by image content, so the same image isn't encoded again.
+    """
+    image = np.asarray(image)
+    tiled = tiled_vae is not None and tiled_vae.should_tile(image.shape[2] // LATENT_SCALE, image.shape[3] // LATENT_SCALE)
+
+    def encode(image):
+        if tiled:
+            return tiled_vae.encode(image)
+        # an infer request of its own, the init image and the masked image may be encoded at the same time
+        return vae_encoder.create_infer_request().infer([image])[0]
+
+    if model_key is None:
+        return encode(image)
+    return encode_image_cached(encode, model_key, image, ("tiled", tiled_vae.tile_size) if tiled else ())
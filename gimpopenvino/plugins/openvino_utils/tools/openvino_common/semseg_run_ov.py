@@ -27,6 +27,7 @@ from adapters import create_core, OpenvinoAdapter
 
 
 from models_ov.segmentation import  SegmentationModel 
+from models_ov.tiled_vae import tile_starts, blend_ramp
 
 from pipelines import get_user_config, AsyncPipeline
 
@@ -111,17 +112,114 @@ def render_segmentation(frame, masks, visualiser, only_masks=False):
     
 
 
-def run(frame, model_path, device):
+def load_model(core, model_path, device, max_num_requests=1):
+    """
+    Read the segmentation model and compile it for device, the model input is fixed, frames are resized to it
+    or run over windows of its size. max_num_requests is the number of windows in flight, 0 for the optimal
+    number of the device.
+    """
+    plugin_config = get_user_config(device, '', None)
+    model_adapter = OpenvinoAdapter(core, model_path, device=device, plugin_config=plugin_config,max_num_requests=max_num_requests, model_parameters={})
+    model = SegmentationModel.create_model('segmentation', model_adapter, None)
+    model.log_layers_info()
+    model.load()
+    return model
+
+
+def run_windows(pipeline, frame, overlap):
+    """
+    Run the model over overlapping windows of its input size instead of resizing the whole frame down
+    to it, with windows in flight on all the infer requests of the pipeline while the finished ones are
+    accumulated. Models with a logits output accumulate them, weighted with linear ramps over the
+    overlap, and take the argmax once. Models whose output is already argmax'ed keep, for each pixel,
+    the label of the window it is the most central in.
+
+    Returns the class map of the frame, at the frame resolution.
+    """
+    model = pipeline.model
+    h, w = frame.shape[:2]
+    window_height, window_width = min(model.h, h), min(model.w, w)
+    weights = np.outer(blend_ramp(window_height, overlap), blend_ramp(window_width, overlap))
+    if model.out_channels < 2:
+        labels = np.zeros((h, w), dtype=np.uint8)
+        best_weight = np.zeros((h, w), dtype=np.float32)
+    else:
+        # the weights are positive, the argmax doesn't need them normalized
+        logits = np.zeros((model.out_channels, h, w), dtype=np.float32)
+
+    def accumulate(result):
+        raw_result, meta, _, _ = result
+        y, x = meta['window']
+        rows = slice(y, y + window_height)
+        cols = slice(x, x + window_width)
+        predictions = raw_result[model.output_blob_name][0]
+        if model.out_channels < 2:
+            window_labels = predictions.reshape(predictions.shape[-2:]).astype(np.uint8)
+            window_labels = cv2.resize(window_labels, (window_width, window_height), interpolation=cv2.INTER_NEAREST)
+            better = weights > best_weight[rows, cols]
+            labels[rows, cols][better] = window_labels[better]
+            best_weight[rows, cols][better] = weights[better]
+        else:
+            predictions = predictions.astype(np.float32, copy=False)
+            if predictions.shape[1:] != (window_height, window_width):
+                predictions = cv2.resize(predictions.transpose(1, 2, 0), (window_width, window_height),
+                                         interpolation=cv2.INTER_LINEAR)
+                predictions = predictions.reshape(window_height, window_width, -1).transpose(2, 0, 1)
+            logits[:, rows, cols] += predictions * weights
+
+    windows = [(y, x) for y in tile_starts(h, window_height, overlap) for x in tile_starts(w, window_width, overlap)]
+    log.info('Running %d windows of %dx%d', len(windows), window_width, window_height)
+    pending = set()
+    for window_id, (y, x) in enumerate(windows):
+        if not pipeline.is_ready():
+            # Wait for empty request
+            pipeline.await_any()
+        if pipeline.callback_exceptions:
+            raise pipeline.callback_exceptions[0]
+        window = np.ascontiguousarray(frame[y:y + window_height, x:x + window_width])
+        pipeline.submit_data(window, window_id, {'window': (y, x)})
+        pending.add(window_id)
+
+        for done_id in list(pending):
+            result = pipeline.get_raw_result(done_id)
+            if result:
+                pending.remove(done_id)
+                accumulate(result)
+
+    pipeline.await_all()
+    if pipeline.callback_exceptions:
+        raise pipeline.callback_exceptions[0]
+    for done_id in pending:
+        accumulate(pipeline.get_raw_result(done_id))
+
+    if model.out_channels < 2:
+        return labels
+    return np.argmax(logits, axis=0).astype(np.uint8)
+
+
+def run(frame, model_path, device, core=None, compiled_models=None, sliding_window=False, window_overlap=64,
+        num_requests=0):
+    """
+    core (optional) is the OpenVINO core the model is compiled with, a new one by default.
+    compiled_models (optional) is a CompiledModelCache keeping the loaded model, for the next runs
+    of the same model on the same device.
+    sliding_window runs frames larger than the model input over windows overlapping by window_overlap
+    pixels (see run_windows), with num_requests windows in flight (0 for the optimal number of the
+    device), for a mask at the frame resolution instead of one upsampled from the model input.
+    """
     
     log.info('Initializing Inference Engine...')
  
     
-
-    plugin_config = get_user_config(device, '', None)
-    model_adapter = OpenvinoAdapter(create_core(), model_path, device=device, plugin_config=plugin_config,max_num_requests=1, model_parameters={})
-    model = SegmentationModel.create_model('segmentation', model_adapter, None)
+    if core is None:
+        core = create_core()
+    max_num_requests = num_requests if sliding_window else 1
+    if compiled_models is not None:
+        model = compiled_models.get_or_load(("segmentation", model_path, device, max_num_requests),
+                                            lambda: load_model(core, model_path, device, max_num_requests))
+    else:
+        model = load_model(core, model_path, device, max_num_requests)
     visualizer = SegmentationVisualizer(None)
-    model.log_layers_info()
 
     #model, visualizer = get_model(ie, model_path)
     log.info('Loading network: %s',model_path )
@@ -129,6 +227,10 @@ def run(frame, model_path, device):
     pipeline = AsyncPipeline(model)
     log.info('Starting inference...')
 
+    if sliding_window and (frame.shape[0] > model.h or frame.shape[1] > model.w):
+        masks = run_windows(pipeline, frame, window_overlap)
+        return render_segmentation(frame, masks, visualizer)
+
     if pipeline.is_ready():
         start_time = perf_counter()
         pipeline.submit_data(frame, 0, {'frame': frame, 'start_time': start_time})
@@ -20,29 +20,169 @@ import numpy as np
 import openvino as ov
 import cv2
 import os
+import threading
+from openvino.preprocess import PrePostProcessor, ResizeAlgorithm
+from openvino.runtime import opset13 as ops
+
+from models_ov.tiled_vae import tile_starts, blend_ramp
 
 logging.basicConfig(format='[ %(levelname)s ] %(message)s', level=logging.DEBUG, stream=sys.stdout)
 log = logging.getLogger()
 
 def convert_result_to_image(result, model_name) -> np.ndarray:
     """
-    Convert network result of floating point numbers to image with integer
-    values from 0-255. Values outside this range are clipped to 0 and 255.
+    The model output as an image. The post-processing compiled into the model (see add_pre_post_processing)
+    already scaled the result to 0-255, clipped it and laid it out as NHWC.
 
-    :param result: a single superresolution network result in N,C,H,W shape
+    :param result: a single superresolution network result in N,H,W,C shape (H,W,N,C for edsr)
     :param model_name: name of the model to determine processing steps
     :return: resulting image as np.ndarray
     """
     if "edsr" in model_name:
-        result = result[0].transpose(1, 2, 0)
+        # the channels were run as a batch of single channel images
+        result = result[..., 0]
+    else:
+        result = result[0]
+
+    if result.dtype != np.uint8:
+        # tiled runs blend the tiles in float, round them rather than truncate
+        result = np.rint(result)
+    return result.astype(np.uint8, copy=False)
+
+def input_layout(model_name):
+    # edsr runs the channels of the H x W x C image as a batch of single channel images
+    return ov.Layout("HWNC") if "edsr" in model_name else ov.Layout("NHWC")
+
+def add_pre_post_processing(model, model_name, output_type=ov.Type.u8):
+    """
+    Fold the pre/post-processing into the reshaped model: u8 image input, conversion to float, scaling
+    to 0-1 for esrgan and the bicubic upsampling of the second input of the 1033 model (both inputs
+    take the same image), and scaling to 0-255, clipping and conversion to output_type of the output.
+
+    :param model: the reshaped model
+    :param model_name: name of the model to determine processing steps
+    :param output_type: element type of the output, u8 or f32 to blend the tiles
+    :return: the model, with the processing steps added
+    """
+    ppp = PrePostProcessor(model)
+    for input_layer in model.inputs:
+        input_info = ppp.input(input_layer.any_name)
+        input_info.tensor().set_element_type(ov.Type.u8).set_layout(input_layout(model_name))
+        input_info.model().set_layout(ov.Layout("NCHW"))
+        steps = input_info.preprocess().convert_element_type(ov.Type.f32)
+        if "esrgan" in model_name:
+            steps.scale(255.0)
+        if "1" in input_layer.get_names():
+            # bicubic branch: the original image, upsampled in the graph
+            original_height, original_width = list(model.inputs[0].shape)[2:]
+            input_info.tensor().set_spatial_static_shape(original_height, original_width)
+            steps.resize(ResizeAlgorithm.RESIZE_CUBIC)
+
+    output_info = ppp.output(0)
+    output_info.model().set_layout(ov.Layout("NCHW"))
+    output_info.tensor().set_element_type(output_type).set_layout(input_layout(model_name))
+    if "edsr" in model_name:
+        output_info.postprocess().custom(lambda node: ops.clamp(node, 0.0, 255.0))
+    else:
+        output_info.postprocess().custom(lambda node: ops.clamp(ops.multiply(node, np.float32(255.0)), 0.0, 255.0))
+    return ppp.build()
+
+def sr_input_shapes(model, model_name, h, w, batch=1):
+    """
+    Static input shapes of the superresolution model for an h x w input image.
+
+    :param model: the model as read from its IR
+    :param model_name: name of the model to determine processing steps
+    :param batch: batch size, the number of channels for edsr which runs them as single channel images
+    :return: input shapes by input name
+    """
+    if not ("esrgan" in model_name or "edsr" in model_name):
+        original_image_key, bicubic_image_key = model.inputs
+        input_height, _ = list(original_image_key.shape)[2:]
+        target_height, _ = list(bicubic_image_key.shape)[2:]
+        upsample_factor = int(target_height / input_height)
+
+    shapes = {}
+    for input_layer in model.inputs:
+        layer_name = input_layer.names.pop()
+        if layer_name in ["0", "input.1", "x.1"]:
+            scale = 1
+        elif layer_name == "1":
+            scale = upsample_factor
+        else:
+            continue
+        shape = [dim.get_length() if dim.is_static else 1 for dim in input_layer.partial_shape]
+        shape[0] = batch
+        shape[2] = scale * h
+        shape[3] = scale * w
+        shapes[input_layer.any_name] = shape
+    return shapes
+
+def sr_inputs(image, compiled_model, model_name):
+    """
+    Model inputs for an image (or tile) of the size the model was compiled for.
+
+    :param image: input u8 image as np.ndarray, H x W x C
+    :param compiled_model: the superresolution model, compiled with add_pre_post_processing
+    :param model_name: name of the model to determine processing steps
+    :return: inputs by input name
+    """
+    if "edsr" in model_name:
+        image = np.expand_dims(image, axis=-1)
     else:
-        result = result.squeeze(0).transpose(1, 2, 0)
-        result *= 255
+        image = np.expand_dims(image, axis=0)
+    # the 1033 model takes the image on both inputs, the bicubic one is upsampled in the graph
+    return {input_layer.any_name: image for input_layer in compiled_model.inputs}
 
-    result = np.clip(result, 0, 255).astype(np.uint8)
-    return result
+def run_tiles(compiled_model, image, model_name, tile_height, tile_width, overlap, num_requests=0):
+    """
+    Run the model compiled for tile_height x tile_width over overlapping tiles of the image, with
+    num_requests tiles in flight (0: the optimal number for the device). The tile outputs are blended
+    with linear ramps over the overlap, into a buffer allocated once for the whole output.
 
-def run(image, model_path, device, model_name):
+    :param compiled_model: the superresolution model, compiled with add_pre_post_processing and f32 output
+    :param image: input u8 image as np.ndarray, H x W x C
+    :return: model output for the whole image, in N,H,W,C shape (H,W,N,C for edsr)
+    """
+    h, w = image.shape[:2]
+    out_shape = list(compiled_model.output(0).shape)
+    spatial = 0 if "edsr" in model_name else 1
+    scale = int(out_shape[spatial] / tile_height)
+    out_shape[spatial:spatial + 2] = [h * scale, w * scale]
+    output = np.zeros(out_shape, dtype=np.float32)
+    weight_sum = np.zeros((h * scale, w * scale), dtype=np.float32)
+    weights = np.outer(blend_ramp(tile_height * scale, overlap * scale), blend_ramp(tile_width * scale, overlap * scale))
+    # to broadcast over the dimensions after H and W
+    trailing = (1,) * (len(out_shape) - spatial - 2)
+    channel_weights = weights.reshape(weights.shape + trailing)
+    # the callbacks can run on several threads at once
+    lock = threading.Lock()
+
+    def accumulate(request, position):
+        y, x = position
+        rows = slice(y * scale, (y + tile_height) * scale)
+        cols = slice(x * scale, (x + tile_width) * scale)
+        result = request.get_output_tensor(0).data * channel_weights
+        with lock:
+            if spatial == 0:
+                output[rows, cols] += result
+            else:
+                output[:, rows, cols] += result
+            weight_sum[rows, cols] += weights
+
+    infer_queue = ov.AsyncInferQueue(compiled_model, num_requests)
+    infer_queue.set_callback(accumulate)
+    for y in tile_starts(h, tile_height, overlap):
+        for x in tile_starts(w, tile_width, overlap):
+            tile = np.ascontiguousarray(image[y:y + tile_height, x:x + tile_width])
+            infer_queue.start_async(sr_inputs(tile, compiled_model, model_name), (y, x))
+    infer_queue.wait_all()
+
+    output /= weight_sum.reshape(weight_sum.shape + trailing)
+    return output
+
+def run(image, model_path, device, model_name, core=None, compiled_models=None, tile_size=None, tile_overlap=16,
+        num_requests=0):
     """
     Run the superresolution model on the input image.
 
@@ -50,65 +190,50 @@ def run(image, model_path, device, model_name):
     :param model_path: path to the model file
     :param device: device to run the inference on
     :param model_name: name of the model to determine processing steps
+    :param core: OpenVINO core to compile the model with, a new one by default
+    :param compiled_models: CompiledModelCache to compile the model through, so runs on the same
+        model, image size and device reuse the compiled model
+    :param tile_size: images larger than tile_size pixels are run over overlapping tiles of that size,
+        through one model compiled for the tile shape, which bounds the memory for large images
+    :param tile_overlap: overlap between tiles in input pixels
+    :param num_requests: tiles in flight, 0 for the optimal number of the device
     :return: super resolution image as np.ndarray
     """
     try:
-        if model_name == "edsr":
-            h, w = image.shape
-        else:
-            h, w, _ = image.shape
+        if image.ndim == 2:
+            image = np.expand_dims(image, axis=-1)
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        h, w, channels = image.shape
+        batch = channels if "edsr" in model_name else 1
 
-        core = ov.Core()
+        if core is None:
+            core = ov.Core()
         if "esrgan" in model_name and "gpu" not in device.lower():
-            core.set_property({'CACHE_DIR': os.path.join(model_path, '..', 'cache')})
-        
-        model = core.read_model(model=model_path)
+            core.set_property(device, {'CACHE_DIR': os.path.join(model_path, '..', 'cache')})
+
+        tile_height, tile_width = h, w
+        if tile_size:
+            tile_height, tile_width = min(tile_size, h), min(tile_size, w)
+        # tiles are blended in float, a single run is converted to u8 in the graph
+        output_type = ov.Type.f32 if (tile_height, tile_width) != (h, w) else ov.Type.u8
 
-        if "esrgan" in model_name or "edsr" in model_name:
-            original_image_key = model.inputs.pop()
+        def prepare(model):
+            return add_pre_post_processing(model, model_name, output_type)
+
+        if compiled_models is not None:
+            shapes = sr_input_shapes(compiled_models.read(core, model_path), model_name, tile_height, tile_width, batch)
+            compiled_model = compiled_models.compile(core, model_path, device, shapes,
+                                                     prepare=prepare, variant=("u8 NHWC", output_type.get_type_name()))
         else:
-            original_image_key, bicubic_image_key = model.inputs
-            input_height, _ = list(original_image_key.shape)[2:]
-            target_height, _ = list(bicubic_image_key.shape)[2:]
-            upsample_factor = int(target_height / input_height)
-
-        shapes = {}
-        for input_layer in model.inputs:
-            layer_name = input_layer.names.pop()
-            if layer_name in ["0", "input.1", "x.1"]:
-                shapes[input_layer] = input_layer.partial_shape
-                shapes[input_layer][2] = h
-                shapes[input_layer][3] = w
-            elif layer_name == "1":
-                shapes[input_layer] = input_layer.partial_shape
-                shapes[input_layer][2] = upsample_factor * h
-                shapes[input_layer][3] = upsample_factor * w
-
-        model.reshape(shapes)
-        compiled_model = core.compile_model(model=model, device_name=device)
-        
-        if "esrgan" in model_name or "edsr" in model_name:
-            original_image_key = compiled_model.inputs.pop()
+            model = core.read_model(model=model_path)
+            model.reshape(sr_input_shapes(model, model_name, tile_height, tile_width, batch))
+            compiled_model = core.compile_model(model=prepare(model), device_name=device)
+
+        if (tile_height, tile_width) != (h, w):
+            log.info(f"Running {model_name} over {tile_width}x{tile_height} tiles")
+            result = run_tiles(compiled_model, image, model_name, tile_height, tile_width, tile_overlap, num_requests)
         else:
-            original_image_key, bicubic_image_key = compiled_model.inputs
-        
-        output_key = compiled_model.output(0)
-        
-        if "edsr" in model_name:
-            image = np.expand_dims(image, axis=-1)
-        
-        input_image_original = np.expand_dims(image.transpose(2, 0, 1), axis=0)
-        if "esrgan" in model_name:
-            input_image_original = input_image_original / 255.0
-        
-        inputs = {original_image_key.any_name: input_image_original}
-        
-        if not ("esrgan" in model_name or "edsr" in model_name):
-            bicubic_image = cv2.resize(src=image, dsize=(w * upsample_factor, h * upsample_factor), interpolation=cv2.INTER_CUBIC)
-            input_image_bicubic = np.expand_dims(bicubic_image.transpose(2, 0, 1), axis=0)
-            inputs[bicubic_image_key.any_name] = input_image_bicubic
-
-        result = compiled_model(inputs)[output_key]
+            result = compiled_model(sr_inputs(image, compiled_model, model_name))[compiled_model.output(0)]
         result_image = convert_result_to_image(result, model_name)
         return result_image
     
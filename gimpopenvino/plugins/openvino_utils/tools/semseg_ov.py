@@ -8,7 +8,7 @@ import sys
 
 sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "openvino_common")])
 sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "..","tools")])
-from tools_utils import get_weight_path
+from tools_utils import get_weight_path, get_config_value
 
 
 #from semseg_run import run
@@ -19,28 +19,41 @@ import os
 import traceback
 
 
-def get_seg(input_image, model_name="deeplabv3", device="CPU", weight_path=None):
+def get_seg(input_image, model_name="deeplabv3", device="CPU", weight_path=None, core=None, compiled_models=None):
     if weight_path is None:
         weight_path = get_weight_path()
+    # layers larger than the model input run over overlapping windows of it, at full resolution
+    windows = {"sliding_window": get_config_value("semseg_sliding_window", True),
+               "window_overlap": get_config_value("semseg_window_overlap", 64),
+               "num_requests": get_config_value("semseg_num_requests", 0)}
 
     if model_name == "deeplabv3": 
         out = run(
                 input_image, 
                 os.path.join(weight_path, "semseg-ov", "deeplabv3.xml"),  
                 device,
+                core,
+                compiled_models,
+                **windows,
             )
     else:
         out = run(
                 input_image, 
                 os.path.join(weight_path, "semseg-ov", "semantic-segmentation-adas-0001.xml"),
                 device,
+                core,
+                compiled_models,
+                **windows,
             )
 
     return out
 
 
-if __name__ == "__main__":
-    weight_path = get_weight_path()
+def run_saved_request(weight_path, core=None, compiled_models=None):
+    """
+    Run the request the plugin saved in gimp_openvino_run.json on cache.png, and write the result back there.
+    Also called by the inference server, with its core and compiled model cache.
+    """
     with open(os.path.join(weight_path, "..", "gimp_openvino_run.json"), "r") as file:
         data_output = json.load(file)
     device = data_output["device_name"] #sys.argv[1]
@@ -48,7 +61,8 @@ if __name__ == "__main__":
     
     image = cv2.imread(os.path.join(weight_path, "..", "cache.png"))[:, :, ::-1]
     try:
-        output = get_seg(image, model_name=model_name, device=device, weight_path=weight_path)
+        output = get_seg(image, model_name=model_name, device=device, weight_path=weight_path,
+                         core=core, compiled_models=compiled_models)
         cv2.imwrite(os.path.join(weight_path, "..", "cache.png"), output[:, :, ::-1])
         data_output["inference_status"] = "success"
         with open(os.path.join(weight_path, "..", "gimp_openvino_run.json"), "w") as file:
@@ -60,13 +74,19 @@ if __name__ == "__main__":
             if f_name.startswith("error_log"):
                 os.remove(os.path.join(my_dir, f_name))
         #sys.exit(0)
+        return "success"
 
     except Exception as error:
         with open(os.path.join(weight_path, "..", "gimp_openvino_run.json"), "w") as file:
             json.dump({"inference_status": "failed"}, file)
         with open(os.path.join(weight_path, "..", "error_log.txt"), "w") as file:
-            traceback.print_exception("DEBUG THE ERROR", file=file)
+            traceback.print_exc(file=file)
             # Uncoment below lines to debug
             #e_type, e_val, e_tb = sys.exc_info()
             #traceback.print_exception(e_type, e_val, e_tb, file=file)
-        #sys.exit(1)
\ No newline at end of file
+        #sys.exit(1)
+        return "failed"
+
+
+if __name__ == "__main__":
+    run_saved_request(get_weight_path())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Copyright(C) 2022-2023 Intel Corporation
+# SPDX - License - Identifier: Apache - 2.0
+"""
+Framed message protocol shared by the inference servers and the GIMP plugins.
+
+Every message on the socket is laid out as:
+
+    | magic (4 bytes) | body length (uint32) | payload length (uint64) | JSON body | payload |
+
+The JSON body always carries a "type" key (e.g. "ping", "run", "progress", "result").
+The payload is optional raw binary data, for example the RGB pixels of a generated image,
+whose shape is described in the JSON body.
+
+This module only depends on the standard library, so it can be imported from GIMP's python.
+"""
+
+import json
+import struct
+
+MAGIC = b"GOVM"
+HEADER = struct.Struct("!4sIQ")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_exact(sock, size):
+    """
+    Read exactly `size` bytes from the socket.
+
+    Returns None if the peer closed the connection before the first byte was read.
+    Raises ProtocolError if the connection is closed in the middle of the read.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            if received == 0:
+                return None
+            raise ProtocolError(f"Connection closed after {received} of {size} bytes")
+        received += n
+    return buffer
+
+
+def send_message(sock, message, payload=b""):
+    """
+    Send a JSON-serializable dict, followed by an optional binary payload.
+    """
+    body = json.dumps(message).encode("utf-8")
+    payload = memoryview(payload).cast("B")
+    sock.sendall(HEADER.pack(MAGIC, len(body), payload.nbytes) + body)
+    if payload.nbytes:
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    """
+    Receive one message.
+
+    Returns a (message, payload) tuple, or (None, b"") if the peer closed the connection.
+    """
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None, b""
+
+    magic, body_length, payload_length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Unexpected message header {bytes(header)!r}")
+
+    body = recv_exact(sock, body_length) if body_length else b"{}"
+    if body is None:
+        raise ProtocolError("Connection closed before message body")
+    message = json.loads(bytes(body).decode("utf-8"))
+
+    payload = b""
+    if payload_length:
+        payload = recv_exact(sock, payload_length)
+        if payload is None:
+            raise ProtocolError("Connection closed before message payload")
+
+    return message, payload
+
+
+def request(sock, message, payload=b""):
+    """
+    Send a message and wait for the reply.
+    """
+    send_message(sock, message, payload)
+    return recv_message(sock)
@@ -6,26 +6,33 @@ import os
 import json
 import sys
 import socket
-import cv2
 import ast
 import traceback
 import logging as log
 from pathlib import Path
 import time 
 import random
-import torch
         
 from PIL import Image
 import numpy as np
 import psutil
 import threading
+import itertools
+import queue
+import uuid
+import gc
+from collections import OrderedDict
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "openvino_common")])
 sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "..","tools")])
-from tools_utils import get_weight_path
+from tools_utils import get_weight_path, get_config_value
+from socket_utils import send_message, recv_message, ProtocolError
 
 
 
-from diffusers.schedulers import DDIMScheduler, LMSDiscreteScheduler, LCMScheduler, EulerDiscreteScheduler
 from models_ov.stable_diffusion_engine import StableDiffusionEngineAdvanced, StableDiffusionEngine, LatentConsistencyEngine, StableDiffusionEngineReferenceOnly
 from models_ov.stable_diffusion_engine_inpainting import StableDiffusionEngineInpainting
 from models_ov.stable_diffusion_engine_inpainting_advanced import StableDiffusionEngineInpaintingAdvanced
@@ -34,6 +41,9 @@ from models_ov.controlnet_canny_edge import ControlNetCannyEdge
 from models_ov.controlnet_scribble import ControlNetScribble, ControlNetScribbleAdvanced
 from models_ov.controlnet_openpose_advanced import ControlNetOpenPoseAdvanced
 from models_ov.controlnet_cannyedge_advanced import ControlNetCannyEdgeAdvanced
+from models_ov.inference_cache import prompt_embedding_cache, compiled_model_cache
+from models_ov.schedulers_np import EulerDiscreteSchedulerNP, LCMSchedulerNP, create_scheduler
+from models_ov.tiled_vae import TiledVAE
 
 from models_ov import (
     stable_diffusion_engine,
@@ -53,43 +63,382 @@ PORT = 65432  # Port to listen on (non-privileged ports are > 1023)
 
 log.basicConfig(format='[ %(levelname)s ] %(message)s', level=log.DEBUG, stream=sys.stdout)
 
-def progress_callback(i, conn):
-    tosend = bytes(str(i), 'utf-8')
-    conn.sendall(tosend)
+MAX_FINISHED_JOBS = 16  # finished jobs kept around so clients can still query their results
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class SDJob:
+    """
+    A generation request queued on the server.
+
+    status is one of "queued", "running", "success", "failed" or "cancelled".
+    images holds (info, rgb) tuples once the job succeeded.
+    """
+    def __init__(self, job_id, params, priority, seq):
+        self.job_id = job_id
+        self.params = params
+        self.priority = priority
+        self.sort_key = (-priority, seq)
+        self.status = "queued"
+        self.step = 0
+        self.total_steps = params.get("num_infer_steps", 0)
+        self.images = []
+        self.error = None
+        self.submit_time = time.time()
+        self.finish_time = None
+        self.changed = threading.Condition()
+        self.cancel_event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("success", "failed", "cancelled")
+
+    def update(self, **kwargs):
+        with self.changed:
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+            if self.finished and self.finish_time is None:
+                self.finish_time = time.time()
+            self.changed.notify_all()
+
+    def wait_for_change(self, last_step, last_status, timeout=None):
+        """
+        Block until the job made progress past last_step, changed status or finished.
+        Returns the current (step, status).
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.finished or self.step != last_step or self.status != last_status, timeout)
+            return self.step, self.status
+
+    def wait_finished(self, timeout=None):
+        with self.changed:
+            return self.changed.wait_for(lambda: self.finished, timeout)
+
+
+class JobQueue:
+    """
+    Priority queue of SDJob. Higher priority runs first, equal priorities run in submission order.
+    """
+    def __init__(self):
+        self.pending = queue.PriorityQueue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def submit(self, params, priority=0):
+        with self.lock:
+            job = SDJob(uuid.uuid4().hex[:12], params, int(priority), next(self.counter))
+            self.jobs[job.job_id] = job
+        self.pending.put((job.sort_key, job.job_id))
+        log.info('Queued job %s (priority %s)', job.job_id, job.priority)
+        return job
+
+    def next_job(self):
+        while True:
+            _, job_id = self.pending.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+            if job is not None and job.status == "queued":
+                return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job):
+        """
+        Queued jobs are dropped right away. A running job is stopped by the worker
+        at the next denoising step, the engine stays loaded.
+        """
+        with job.changed:
+            job.cancel_event.set()
+            if job.status == "queued":
+                job.status = "cancelled"
+                job.finish_time = time.time()
+                job.changed.notify_all()
+        log.info('Cancel requested for job %s (%s)', job.job_id, job.status)
+
+    def position(self, job):
+        if job.status != "queued":
+            return 0
+        with self.lock:
+            return sum(1 for j in self.jobs.values() if j.status == "queued" and j.sort_key < job.sort_key)
+
+    def status(self, job):
+        return {
+            "job_id": job.job_id,
+            "status": job.status,
+            "priority": job.priority,
+            "step": job.step,
+            "total_steps": job.total_steps,
+            "queue_position": self.position(job),
+            "error": job.error,
+        }
+
+    def prune(self):
+        with self.lock:
+            finished = sorted((j for j in self.jobs.values() if j.finished), key=lambda j: j.finish_time)
+            for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[job.job_id]
+
+
+def progress_callback(i, job):
+    """
+    Called by the engines at the start of every denoising step, which makes it the place to abort a cancelled job.
+    """
+    if job.cancel_event.is_set():
+        raise JobCancelled(job.job_id)
+    job.update(step=i)
+
+def to_rgb_array(output):
+    """
+    Convert an engine output to a contiguous RGB uint8 array.
+
+    Parameters:
+        output (PIL.Image.Image or np.ndarray): PIL images are RGB, numpy outputs of the engines are BGR.
+    Returns:
+        np.ndarray of shape (height, width, 3)
+    """
+    if isinstance(output, Image.Image):
+        return np.ascontiguousarray(np.asarray(output.convert("RGB"), dtype=np.uint8))
+    return np.ascontiguousarray(output[:, :, ::-1], dtype=np.uint8)
+
+def send_result(conn, job, transport, weight_path):
+    """
+    Deliver the images of a finished job to the client.
+
+    Parameters:
+        conn: client socket
+        job (SDJob): finished job
+        transport (str): "shm" to hand over named shared memory segments,
+            "png" to write sd_cache png files, anything else sends the pixels as the message payload.
+            If shared memory is not available the images are written as PNG instead.
+    """
+    if job.status != "success":
+        send_message(conn, {"type": "result", "job_id": job.job_id, "status": job.status, "error": job.error})
+        return
 
-def run(model_name, available_devices, power_mode):
+    result = {"type": "result", "job_id": job.job_id, "status": "success", "images": []}
+    segments = []
+    payloads = []
+    offset = 0
+    try:
+        for index, (info, rgb) in enumerate(job.images):
+            info = dict(info)
+            shm = None
+            if transport == "shm":
+                try:
+                    shm = shared_memory.SharedMemory(create=True, size=rgb.nbytes)
+                except Exception as error:
+                    log.warning("Shared memory not available (%s), falling back to PNG", error)
+                    transport = "png"
+
+            if shm is not None:
+                segments.append(shm)
+                np.ndarray(rgb.shape, dtype=np.uint8, buffer=shm.buf)[:] = rgb
+                info.update(transport="shm", shm_name=shm.name)
+            elif transport == "png":
+                image_path = os.path.join(weight_path, "..", "sd_cache_%s_%d.png" % (job.job_id, index))
+                Image.fromarray(rgb).save(image_path)
+                info.update(transport="png", path=image_path)
+            else:
+                info.update(transport="socket", offset=offset, nbytes=rgb.nbytes)
+                offset += rgb.nbytes
+                payloads.append(rgb)
+            result["images"].append(info)
+
+        if len(payloads) == 1:
+            payload = payloads[0].data
+        else:
+            payload = b"".join(rgb.tobytes() for rgb in payloads)
+        send_message(conn, result, payload)
+
+        if segments:
+            # Keep the segments alive until the client has copied the pixels
+            conn.settimeout(60)
+            try:
+                recv_message(conn)
+            finally:
+                conn.settimeout(None)
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+def stream_progress(conn, job):
+    """
+    Forward progress of a job to the client until it finishes.
+    """
+    step, status = None, None
+    while True:
+        step, status = job.wait_for_change(step, status)
+        if job.finished:
+            return
+        send_message(conn, {"type": "progress", "job_id": job.job_id, "status": status, "step": step,
+                            "total_steps": job.total_steps})
+
+def message_error(message):
+    """
+    What is wrong with the fields of a client message, None when they can be used as they are
+    """
+    if not isinstance(message, dict):
+        return "Invalid message: expected a JSON object"
+    msg_type = message.get("type")
+    if msg_type in ("load", "submit", "run"):
+        try:
+            int(message.get("priority", 0))
+        except (TypeError, ValueError):
+            return "Invalid priority: %r" % (message.get("priority"),)
+    if msg_type == "load" and not isinstance(message.get("model_name"), str):
+        return "load needs a model_name"
+    if msg_type in ("submit", "run") and not isinstance(message.get("params", {}), dict):
+        return "%s params must be an object" % msg_type
+    if msg_type in ("status", "result", "cancel") and not isinstance(message.get("job_id"), (str, type(None))):
+        return "Invalid job id: %r" % (message.get("job_id"),)
+    return None
+
+def run_connection_routine(job_queue, registry, conn):
+    with conn:
+        try:
+            while True:
+                message, _ = recv_message(conn)
+                if message is None:
+                    break
+
+                error = message_error(message)
+                if error is not None:
+                    send_message(conn, {"type": "error", "error": error})
+                    continue
+
+                msg_type = message.get("type")
+                if msg_type == "kill":
+                    os._exit(0)
+                elif msg_type == "ping":
+                    send_message(conn, {"type": "ping"})
+                elif msg_type == "model_name":
+                    send_message(conn, {"type": "model_name", "model_name": registry.active_model})
+                elif msg_type == "models":
+                    send_message(conn, {"type": "models", "resident": registry.describe(), "budget_mb": registry.budget_mb})
+                elif msg_type == "load":
+                    # Loading goes through the queue as well, since the worker owns the engines
+                    params = {"kind": "load", "model_name": message["model_name"], "power_mode": message.get("power_mode")}
+                    job = job_queue.submit(params, message.get("priority", 0))
+                    send_message(conn, {"type": "submitted", "job_id": job.job_id, "queue_position": job_queue.position(job)})
+                    job.wait_finished()
+                    send_message(conn, {"type": "loaded", "job_id": job.job_id, "status": job.status,
+                                        "model_name": message["model_name"], "error": job.error})
+                elif msg_type == "submit":
+                    # Non blocking, the client gets the job id back and can poll "status" / "result"
+                    job = job_queue.submit(message.get("params", {}), message.get("priority", 0))
+                    send_message(conn, {"type": "submitted", "job_id": job.job_id, "queue_position": job_queue.position(job)})
+                elif msg_type == "status":
+                    if message.get("job_id") is None:
+                        send_message(conn, {"type": "status", "jobs": [job_queue.status(j) for j in job_queue.list_jobs()]})
+                        continue
+                    job = job_queue.get(message["job_id"])
+                    if job is None:
+                        send_message(conn, {"type": "error", "error": "Unknown job id: %s" % message["job_id"]})
+                    else:
+                        send_message(conn, dict(job_queue.status(job), type="status"))
+                elif msg_type == "result":
+                    job = job_queue.get(message.get("job_id"))
+                    if job is None:
+                        send_message(conn, {"type": "error", "error": "Unknown job id: %s" % message.get("job_id")})
+                    elif not job.finished and not message.get("wait", True):
+                        send_message(conn, dict(job_queue.status(job), type="status"))
+                    else:
+                        job.wait_finished()
+                        send_result(conn, job, message.get("result_transport", "socket"), get_weight_path())
+                elif msg_type == "cancel":
+                    job = job_queue.get(message.get("job_id"))
+                    if job is None:
+                        send_message(conn, {"type": "error", "error": "Unknown job id: %s" % message.get("job_id")})
+                    else:
+                        job_queue.cancel(job)
+                        send_message(conn, {"type": "cancel", "job_id": job.job_id, "status": job.status})
+                elif msg_type == "run":
+                    # Submit and stream progress events on this connection until the result is sent
+                    params = message.get("params", {})
+                    job = job_queue.submit(params, message.get("priority", 0))
+                    send_message(conn, {"type": "submitted", "job_id": job.job_id, "queue_position": job_queue.position(job)})
+                    stream_progress(conn, job)
+                    send_result(conn, job, params.get("result_transport", "socket"), get_weight_path())
+                else:
+                    send_message(conn, {"type": "error", "error": "Unknown message type: %s" % msg_type})
+        except (OSError, ProtocolError) as error:
+            log.warning("Client connection closed: %s", error)
+
+def worker_loop(job_queue, registry, scheduler):
+    """
+    Runs queued jobs one after the other. This is the only thread that loads or runs engines.
+    """
+    while True:
+        job = job_queue.next_job()
+        with job.changed:
+            if job.status != "queued":
+                continue
+            job.status = "running"
+            job.changed.notify_all()
+
+        params = job.params
+        try:
+            entry = registry.acquire(params.get("model_name") or registry.active_model, params.get("power_mode"))
+        except Exception as error:
+            log.error('Could not load %s: %s', params.get("model_name"), error)
+            with open(os.path.join(get_weight_path(), "..", "error_log.txt"), "w") as file:
+                traceback.print_exc(file=file)
+            job.update(status="failed", error=str(error))
+            job_queue.prune()
+            continue
+
+        if params.get("kind") == "load":
+            job.update(status="success")
+        else:
+            run_job(job, entry.engine, entry.model_name, entry.model_path, scheduler)
+        job_queue.prune()
+
+MODEL_PATHS = {
+    "sd_1.4": ["stable-diffusion-ov", "stable-diffusion-1.4"],
+    "sd_1.5_square_lcm": ["stable-diffusion-ov", "stable-diffusion-1.5", "square_lcm"],
+    "sd_1.5_portrait": ["stable-diffusion-ov", "stable-diffusion-1.5", "portrait"],
+    "sd_1.5_square": ["stable-diffusion-ov", "stable-diffusion-1.5", "square"],
+    "sd_1.5_square_int8": ["stable-diffusion-ov", "stable-diffusion-1.5", "square_int8"],
+    "sd_1.5_square_int8a16": ["stable-diffusion-ov", "stable-diffusion-1.5", "square_int8"],
+    "sd_1.5_landscape": ["stable-diffusion-ov", "stable-diffusion-1.5", "landscape"],
+    "sd_1.5_portrait_512x768": ["stable-diffusion-ov", "stable-diffusion-1.5", "portrait_512x768"],
+    "sd_1.5_landscape_768x512": ["stable-diffusion-ov", "stable-diffusion-1.5", "landscape_768x512"],
+    "sd_1.5_inpainting": ["stable-diffusion-ov", "stable-diffusion-1.5", "inpainting"],
+    "sd_1.5_inpainting_int8": ["stable-diffusion-ov", "stable-diffusion-1.5", "inpainting_int8"],
+    "sd_2.1_square_base": ["stable-diffusion-ov", "stable-diffusion-2.1", "square_base"],
+    "sd_2.1_square": ["stable-diffusion-ov", "stable-diffusion-2.1", "square"],
+    "sd_3.0_square": ["stable-diffusion-ov", "stable-diffusion-3.0"],
+    "controlnet_referenceonly": ["stable-diffusion-ov", "controlnet-referenceonly"],
+    "controlnet_openpose": ["stable-diffusion-ov", "controlnet-openpose"],
+    "controlnet_canny": ["stable-diffusion-ov", "controlnet-canny"],
+    "controlnet_scribble": ["stable-diffusion-ov", "controlnet-scribble"],
+    "controlnet_openpose_int8": ["stable-diffusion-ov", "controlnet-openpose-int8"],
+    "controlnet_canny_int8": ["stable-diffusion-ov", "controlnet-canny-int8"],
+    "controlnet_scribble_int8": ["stable-diffusion-ov", "controlnet-scribble-int8"],
+}
+
+DEFAULT_ENGINE_MEMORY_BUDGET_MB = 16384  # override with "sd_engine_memory_budget_mb" in gimp_openvino_config.json
+
+
+def resolve_model(model_name, available_devices, power_mode):
+    """
+    Find the model folder and the device list to use for a model / power mode.
+
+    Returns:
+        (model_path, device_list)
+    """
     weight_path = get_weight_path()
-    scheduler = EulerDiscreteScheduler(
-        beta_start=0.00085,
-        beta_end=0.012,
-        beta_schedule="scaled_linear"
-    )
-
-    log.info('Model Name: %s', model_name)
-
-    model_paths = {
-        "sd_1.4": ["stable-diffusion-ov", "stable-diffusion-1.4"],
-        "sd_1.5_square_lcm": ["stable-diffusion-ov", "stable-diffusion-1.5", "square_lcm"],
-        "sd_1.5_portrait": ["stable-diffusion-ov", "stable-diffusion-1.5", "portrait"],
-        "sd_1.5_square": ["stable-diffusion-ov", "stable-diffusion-1.5", "square"],
-        "sd_1.5_square_int8": ["stable-diffusion-ov", "stable-diffusion-1.5", "square_int8"],
-        "sd_1.5_square_int8a16": ["stable-diffusion-ov", "stable-diffusion-1.5", "square_int8"],
-        "sd_1.5_landscape": ["stable-diffusion-ov", "stable-diffusion-1.5", "landscape"],
-        "sd_1.5_portrait_512x768": ["stable-diffusion-ov", "stable-diffusion-1.5", "portrait_512x768"],
-        "sd_1.5_landscape_768x512": ["stable-diffusion-ov", "stable-diffusion-1.5", "landscape_768x512"],
-        "sd_1.5_inpainting": ["stable-diffusion-ov", "stable-diffusion-1.5", "inpainting"],
-        "sd_1.5_inpainting_int8": ["stable-diffusion-ov", "stable-diffusion-1.5", "inpainting_int8"],
-        "sd_2.1_square_base": ["stable-diffusion-ov", "stable-diffusion-2.1", "square_base"],
-        "sd_2.1_square": ["stable-diffusion-ov", "stable-diffusion-2.1", "square"],
-        "sd_3.0_square": ["stable-diffusion-ov", "stable-diffusion-3.0"],
-        "controlnet_referenceonly": ["stable-diffusion-ov", "controlnet-referenceonly"],
-        "controlnet_openpose": ["stable-diffusion-ov", "controlnet-openpose"],
-        "controlnet_canny": ["stable-diffusion-ov", "controlnet-canny"],
-        "controlnet_scribble": ["stable-diffusion-ov", "controlnet-scribble"],
-        "controlnet_openpose_int8": ["stable-diffusion-ov", "controlnet-openpose-int8"],
-        "controlnet_canny_int8": ["stable-diffusion-ov", "controlnet-canny-int8"],
-        "controlnet_scribble_int8": ["stable-diffusion-ov", "controlnet-scribble-int8"],
-    }
 
     # Default path if model_name is not in the dictionary
     default_path = ["stable-diffusion-ov", "stable-diffusion-1.4"]
@@ -97,9 +446,8 @@ def run(model_name, available_devices, power_mode):
         "power modes supported" : "no",
         "best performance" : ["GPU", "GPU","GPU", "GPU"]
     }
-    model_path = os.path.join(weight_path, *model_paths.get(model_name, default_path))
+    model_path = os.path.join(weight_path, *MODEL_PATHS.get(model_name, default_path))
 
-    log.info('Initializing Inference Engine...')
     log.info('Model Path: %s', model_path)
     device_list = ["CPU"] * 5
     model_config_file_name = os.path.join(model_path, "config.json")
@@ -127,35 +475,157 @@ def run(model_name, available_devices, power_mode):
     except (KeyError, FileNotFoundError, json.JSONDecodeError) as e:
         log.error(f"Error loading configuration: {e}. Only CPU will be used.")
 
-    engine = initialize_engine(model_name, model_path, device_list)
+    return model_path, device_list
+
+
+def process_memory_mb():
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+def model_files_mb(model_path):
+    size = 0
+    for root, _, files in os.walk(model_path):
+        for f_name in files:
+            if f_name.endswith((".bin", ".blob")):
+                size += os.path.getsize(os.path.join(root, f_name))
+    return size / (1024 * 1024)
+
+
+class EngineEntry:
+    def __init__(self, model_name, power_mode, model_path, device_list, engine, memory_mb):
+        self.model_name = model_name
+        self.power_mode = power_mode
+        self.model_path = model_path
+        self.device_list = device_list
+        self.engine = engine
+        self.memory_mb = memory_mb
+        self.last_used = time.time()
+
+    def describe(self):
+        return {
+            "model_name": self.model_name,
+            "power_mode": self.power_mode,
+            "device_list": [str(d) for d in self.device_list],
+            "memory_mb": round(self.memory_mb),
+            "idle_seconds": round(time.time() - self.last_used),
+        }
+
+
+class EngineRegistry:
+    """
+    Engines that stay loaded in the server, keyed by model name and device list.
+
+    Engines are loaded on demand. When the estimated memory of all resident engines goes
+    over budget_mb, the least recently used ones are released (never the one just requested).
+    Only the worker thread loads or evicts engines, other threads only read the descriptions.
+    """
+    def __init__(self, available_devices, default_power_mode, budget_mb):
+        self.available_devices = available_devices
+        self.default_power_mode = default_power_mode
+        self.budget_mb = budget_mb
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.active_model = None
+
+    def acquire(self, model_name, power_mode=None):
+        if power_mode is None:
+            # Reuse whatever is resident for this model before falling back to the default power mode
+            with self.lock:
+                for entry in reversed(self.entries.values()):
+                    if entry.model_name == model_name:
+                        power_mode = entry.power_mode
+                        break
+            if power_mode is None:
+                power_mode = self.default_power_mode
+
+        model_path, device_list = resolve_model(model_name, self.available_devices, power_mode)
+        key = (model_name, tuple(str(d) for d in device_list))
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None:
+            log.info('Initializing Inference Engine...')
+            log.info('Model Name: %s', model_name)
+            memory_before = process_memory_mb()
+            start_time = time.time()
+            engine = initialize_engine(model_name, model_path, device_list)
+            configure_vae_tiling(engine, model_path)
+            prepare_guidance_cutoff(engine)
+            memory_mb = process_memory_mb() - memory_before
+            if memory_mb <= 0:
+                memory_mb = model_files_mb(model_path)
+            log.info('Loaded %s in %.1f s, ~%d MB', model_name, time.time() - start_time, memory_mb)
+
+            entry = EngineEntry(model_name, power_mode, model_path, device_list, engine, memory_mb)
+            with self.lock:
+                self.entries[key] = entry
+            self.evict(keep=key)
+
+        entry.last_used = time.time()
+        self.active_model = model_name
+        return entry
+
+    def evict(self, keep):
+        evicted = False
+        with self.lock:
+            while len(self.entries) > 1 and self.total_memory_mb() > self.budget_mb:
+                key = next(k for k in self.entries if k != keep)
+                entry = self.entries.pop(key)
+                log.info('Evicting %s (%s), ~%d MB', entry.model_name, entry.device_list, entry.memory_mb)
+                entry.engine = None
+                evicted = True
+        if evicted:
+            gc.collect()
+
+    def total_memory_mb(self):
+        return sum(entry.memory_mb for entry in self.entries.values())
+
+    def describe(self):
+        with self.lock:
+            return [entry.describe() for entry in self.entries.values()]
+
+
+def run(model_name, available_devices, power_mode):
+    scheduler = EulerDiscreteSchedulerNP(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear"
+    )
+
+    budget_mb = get_config_value("sd_engine_memory_budget_mb", DEFAULT_ENGINE_MEMORY_BUDGET_MB)
+    registry = EngineRegistry(available_devices, power_mode, budget_mb)
+
+    prompt_cache_dir = get_config_value("sd_prompt_cache_dir")
+    if prompt_cache_dir:
+        prompt_embedding_cache.configure(disk_dir=prompt_cache_dir)
+
+    # number of variants (resolutions, batch 1) of each UNet / VAE / ControlNet kept loaded
+    compiled_cache_entries = get_config_value("sd_compiled_cache_entries")
+    if compiled_cache_entries is not None:
+        compiled_model_cache.configure(max_entries=int(compiled_cache_entries))
+
+    registry.acquire(model_name, power_mode)
+
+    job_queue = JobQueue()
+    worker_thread = threading.Thread(target=worker_loop, args=(job_queue, registry, scheduler), daemon=True)
+    worker_thread.start()
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind((HOST, PORT))
         s.listen()
-        s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s2.connect((HOST, 65433))
-        s2.sendall(b"Ready")
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s2:
+            s2.connect((HOST, 65433))
+            send_message(s2, {"type": "ready", "model_name": model_name})
         print("Ready")
         while True:
             conn, addr = s.accept()
-            with conn:
-                while True:
-                    print("Waiting")
-                    data = conn.recv(1024)
-
-                    if data.decode() == "kill":
-                        os._exit(0)
-                    if data.decode() == "ping":
-                        conn.sendall(data)
-                        continue
-                    if data.decode() == "model_name":
-                        tosend = bytes(model_name, 'utf-8')
-                        conn.sendall(tosend)
-                        continue
 
-                    if not data:
-                        break
-                    handle_client_data(data, conn, engine, model_name, model_path, scheduler)
+            # Each client gets its own thread, so pings and status queries are answered while a job runs.
+            conn_thread = threading.Thread(target=run_connection_routine, args=(job_queue, registry, conn), daemon=True)
+            conn_thread.start()
 
 def initialize_engine(model_name, model_path, device_list):
     if model_name == "sd_1.5_square_int8":
@@ -191,175 +661,232 @@ def initialize_engine(model_name, model_path, device_list):
         return stable_diffusion_engine.StableDiffusionEngineReferenceOnly(model=model_path, device=device_list)
     return stable_diffusion_engine.StableDiffusionEngine(model=model_path, device=device_list)
 
-def handle_client_data(data, conn, engine, model_name, model_path, scheduler):
-    if data.decode() == "kill":
-        os._exit(0)
-    if data.decode() == "ping":
-        conn.sendall(data)
+def configure_vae_tiling(engine, model_path):
+    """
+    Enable the tiled VAE of an engine when "sd_vae_tile_size" (latent pixels) or "sd_vae_memory_limit_mb"
+    is set in the config. The tiles are compiled from the xml models, so VAEs imported as NPU blobs are left as is.
+    """
+    tile_size = get_config_value("sd_vae_tile_size")
+    memory_limit_mb = get_config_value("sd_vae_memory_limit_mb")
+    if (tile_size is None and memory_limit_mb is None) or not hasattr(engine, "tiled_vae"):
         return
-    if data.decode() == "model_name":
-        tosend = bytes(model_name, 'utf-8')
-        conn.sendall(tosend)
+
+    try:
+        device = engine.vae_decoder.get_property("EXECUTION_DEVICES")[0]
+    except Exception:
+        device = "CPU"
+    if "NPU" in device or not os.path.isfile(os.path.join(model_path, "vae_decoder.xml")):
+        log.info('Tiled VAE not available on %s for %s', device, model_path)
         return
 
+    engine.tiled_vae = TiledVAE(engine.core, model_path, device, tile_size=tile_size,
+                                overlap=get_config_value("sd_vae_tile_overlap", 8),
+                                memory_limit_mb=memory_limit_mb)
+    log.info('Tiled VAE enabled: tile %s, memory limit %s MB', engine.tiled_vae.tile_size, memory_limit_mb)
+
+def prepare_guidance_cutoff(engine):
+    """
+    With "sd_guidance_cutoff" below 1 in the config, compile the batch 1 models the steps past the cutoff
+    run on when the engine is loaded, instead of at the first run using them.
+    """
+    if float(get_config_value("sd_guidance_cutoff", 1.0)) < 1.0 and hasattr(engine, "prepare_guidance_cutoff"):
+        start_time = time.time()
+        engine.prepare_guidance_cutoff()
+        log.info('Guidance cutoff models ready in %.1f s', time.time() - start_time)
+
+def request_scheduler(request, scheduler, **config):
+    """
+    Scheduler of a request: "scheduler" ("euler", "dpm++_2m_karras", "unipc"... sd_scheduler in the config).
+    Euler reuses the server scheduler, the others are created for the request, they keep state between steps.
+    """
+    name = request.get("scheduler") or get_config_value("sd_scheduler", "euler")
+    if name == "euler" and not config:
+        return scheduler
+    return create_scheduler(name, beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", **config)
+
+def generate_image(engine, model_name, model_path, scheduler, request, seed, job):
+    """
+    Run one generation on an engine that produces a single image per call.
+    """
+    weight_path = get_weight_path()
+    create_gif = False
+
+    if model_name == "sd_1.5_inpainting" or model_name == "sd_1.5_inpainting_int8":
+        return engine(
+            prompt=request["prompt"],
+            negative_prompt=request["negative_prompt"],
+            image=Image.open(os.path.join(weight_path, "..", "cache1.png")),
+            mask_image=Image.open(os.path.join(weight_path, "..", "cache0.png")),
+            scheduler=scheduler,
+            strength=request["strength"],
+            num_inference_steps=request["num_infer_steps"],
+            guidance_scale=request["guidance_scale"],
+            eta=0.0,
+            create_gif=bool(create_gif),
+            model=model_path,
+            callback=progress_callback,
+            callback_userdata=job,
+            crop_to_mask=bool(request.get("crop_to_mask", get_config_value("sd_inpaint_crop_to_mask", False))),
+            crop_margin=int(request.get("crop_margin", get_config_value("sd_inpaint_crop_margin", 64))),
+            crop_feather=int(request.get("crop_feather", get_config_value("sd_inpaint_crop_feather", 8))),
+            guidance_cutoff=float(request.get("guidance_cutoff", get_config_value("sd_guidance_cutoff", 1.0)))
+        )
+    if model_name == "controlnet_referenceonly":
+        return engine(
+            prompt=request["prompt"],
+            negative_prompt=request["negative_prompt"],
+            init_image=Image.open(request["initial_image"]),
+            scheduler=scheduler,
+            num_inference_steps=request["num_infer_steps"],
+            guidance_scale=request["guidance_scale"],
+            eta=0.0,
+            create_gif=bool(create_gif),
+            model=model_path,
+            callback=progress_callback,
+            callback_userdata=job
+        )
+    if "controlnet" in model_name: 
+        return engine(
+            prompt=request["prompt"],
+            negative_prompt=request["negative_prompt"],
+            image=Image.open(request["initial_image"]),
+            scheduler=scheduler,
+            num_inference_steps=request["num_infer_steps"],
+            guidance_scale=request["guidance_scale"],
+            eta=0.0,
+            create_gif=bool(create_gif),
+            model=model_path,
+            callback=progress_callback,
+            callback_userdata=job,
+            controlnet_cond_only=bool(request.get("controlnet_cond_only", get_config_value("sd_controlnet_cond_only", False))),
+            control_guidance_start=float(request.get("control_guidance_start", get_config_value("sd_control_guidance_start", 0.0))),
+            control_guidance_end=float(request.get("control_guidance_end", get_config_value("sd_control_guidance_end", 1.0))),
+            guidance_cutoff=float(request.get("guidance_cutoff", get_config_value("sd_guidance_cutoff", 1.0)))
+        )
+    if model_name == "sd_1.5_square_lcm":
+        scheduler = LCMSchedulerNP(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear"
+        )
+        return engine(
+            prompt=request["prompt"],
+            num_inference_steps=request["num_infer_steps"],
+            guidance_scale=request["guidance_scale"],
+            scheduler=scheduler,
+            lcm_origin_steps=50,
+            model=model_path,
+            callback=progress_callback,
+            callback_userdata=job,
+            seed=seed
+        )
+    if "sd_3.0" in model_name:
+        # only SD3 still samples with torch
+        import torch
+        return engine(
+                prompt = request["prompt"],
+                negative_prompt = request["negative_prompt"],
+                num_inference_steps = request["num_infer_steps"],
+                guidance_scale = 0,
+                generator=torch.Generator().manual_seed(int(seed)),
+                callback=progress_callback,
+                callback_userdata=job
+                #callback_on_step_end_tensor_inputs = conn,
+                
+        ).images[0] 
+    raise ValueError("No single image path for model %s" % model_name)
+
+def generate_images(engine, model_name, model_path, scheduler, request, seeds, job):
+    """
+    Returns one engine output per seed.
+
+    StableDiffusionEngine and StableDiffusionEngineAdvanced denoise all the images in one pass,
+    the other engines are called once per seed.
+    They also take an optional "height" / "width": the UNet and the VAE are reshaped to it, sizes well
+    above the model resolution are generated over tiles.
+    "guidance_cutoff" (fraction of the steps, sd_guidance_cutoff in the config) stops classifier free
+    guidance for the later steps of the SD, inpainting and ControlNet engines.
+    """
+    if isinstance(engine, (StableDiffusionEngine, StableDiffusionEngineAdvanced)):
+        if model_name == "sd_2.1_square":
+            scheduler = request_scheduler(request, scheduler, prediction_type="v_prediction")
+        model = model_path
+        if "sd_2.1" in model_name:
+            model = model_name
+
+        init_image = request["initial_image"]
+        output = engine(
+            prompt=request["prompt"],
+            negative_prompt=request["negative_prompt"],
+            init_image=None if init_image is None else Image.open(init_image),
+            scheduler=scheduler,
+            strength=request["strength"],
+            num_inference_steps=request["num_infer_steps"],
+            guidance_scale=request["guidance_scale"],
+            eta=0.0,
+            create_gif=False,
+            model=model,
+            callback=progress_callback,
+            callback_userdata=job,
+            num_images=len(seeds),
+            seeds=seeds,
+            height=request.get("height"),
+            width=request.get("width"),
+            guidance_cutoff=float(request.get("guidance_cutoff", get_config_value("sd_guidance_cutoff", 1.0)))
+        )
+        return [output] if len(seeds) == 1 else output
+
+    outputs = []
+    for seed in seeds:
+        np.random.seed(int(seed))
+        outputs.append(generate_image(engine, model_name, model_path, scheduler, request, seed, job))
+    return outputs
+
+def run_job(job, engine, model_name, model_path, scheduler):
+    request = dict(job.params)
+    weight_path = get_weight_path()
     try:
-        weight_path = get_weight_path()
-        with open(os.path.join(weight_path, "..", "gimp_openvino_run_sd.json"), "r") as file:
-            data_output = json.load(file)
-
-        prompt = data_output["prompt"]
-        negative_prompt = data_output["negative_prompt"]
-        init_image = data_output["initial_image"]
-        num_images = data_output["num_images"]
-        num_infer_steps = data_output["num_infer_steps"]
-        guidance_scale = data_output["guidance_scale"]
-        strength = data_output["strength"]
-        seed = data_output["seed"]
-        create_gif = False
-
-        strength = 1.0 if init_image is None else strength
+        init_image = request["initial_image"]
+        num_images = max(1, int(request.get("num_images", 1)))
+        seed = request["seed"]
+
+        request["strength"] = 1.0 if init_image is None else request["strength"]
         log.info('Starting inference...')
-        log.info('Prompt: %s', prompt)
+        log.info('Prompt: %s', request["prompt"])
 
         if model_name != "sd_1.5_square_lcm":
-            log.info('Negative Prompt: %s', negative_prompt)
-        log.info('Inference Steps: %s', num_infer_steps)
+            log.info('Negative Prompt: %s', request["negative_prompt"])
+        log.info('Inference Steps: %s', request["num_infer_steps"])
         log.info('Number of Images: %s', num_images)
-        log.info('Guidance Scale: %s', guidance_scale)
-        log.info('Strength: %s', strength)
+        log.info('Guidance Scale: %s', request["guidance_scale"])
+        log.info('Strength: %s', request["strength"])
+        if model_name != "sd_1.5_square_lcm":
+            log.info('Scheduler: %s', request.get("scheduler") or get_config_value("sd_scheduler", "euler"))
         log.info('Init Image: %s', init_image)
+        if request.get("height") or request.get("width"):
+            log.info('Canvas: %sx%s', request.get("width"), request.get("height"))
 
         if seed is not None:
-            np.random.seed(int(seed))
             log.info('Seed: %s', seed)
         else:
             seed = random.randrange(4294967294)
-            np.random.seed(int(seed))
             log.info('Random Seed: %s', seed)
 
-        start_time = time.time()
-
-        if model_name == "sd_1.5_inpainting" or model_name == "sd_1.5_inpainting_int8":
-            output = engine(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=Image.open(os.path.join(weight_path, "..", "cache1.png")),
-                mask_image=Image.open(os.path.join(weight_path, "..", "cache0.png")),
-                scheduler=scheduler,
-                strength=strength,
-                num_inference_steps=num_infer_steps,
-                guidance_scale=guidance_scale,
-                eta=0.0,
-                create_gif=bool(create_gif),
-                model=model_path,
-                callback=progress_callback,
-                callback_userdata=conn
-            )
-        elif model_name == "controlnet_referenceonly":
-            output = engine(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                init_image=Image.open(init_image),
-                scheduler=scheduler,
-                num_inference_steps=num_infer_steps,
-                guidance_scale=guidance_scale,
-                eta=0.0,
-                create_gif=bool(create_gif),
-                model=model_path,
-                callback=progress_callback,
-                callback_userdata=conn
-            )
-        elif "controlnet" in model_name: 
-            output = engine(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=Image.open(init_image),
-                scheduler=scheduler,
-                num_inference_steps=num_infer_steps,
-                guidance_scale=guidance_scale,
-                eta=0.0,
-                create_gif=bool(create_gif),
-                model=model_path,
-                callback=progress_callback,
-                callback_userdata=conn
-            )
-        
-        elif model_name == "sd_1.5_square_lcm":
-            scheduler = LCMScheduler(
-                beta_start=0.00085,
-                beta_end=0.012,
-                beta_schedule="scaled_linear"
-            )
-            output = engine(
-                prompt=prompt,
-                num_inference_steps=num_infer_steps,
-                guidance_scale=guidance_scale,
-                scheduler=scheduler,
-                lcm_origin_steps=50,
-                model=model_path,
-                callback=progress_callback,
-                callback_userdata=conn,
-                seed=seed
-            )
-        elif "sd_3.0" in model_name:
-            output = engine(
-                    prompt = prompt,
-                    negative_prompt = negative_prompt,
-                    num_inference_steps = num_infer_steps,
-                    guidance_scale = 0,
-                    generator=torch.Generator().manual_seed(int(seed)),
-                    callback=progress_callback,
-                    callback_userdata=conn
-                    #callback_on_step_end_tensor_inputs = conn,
-                    
-            ).images[0] 
-                
-        else:
-            if model_name == "sd_2.1_square":
-                scheduler = EulerDiscreteScheduler(
-                    beta_start=0.00085,
-                    beta_end=0.012,
-                    beta_schedule="scaled_linear",
-                    prediction_type="v_prediction"
-                )
-            model = model_path
-            if "sd_2.1" in model_name:
-                model = model_name
-
-            output = engine(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                init_image=None if init_image is None else Image.open(init_image),
-                scheduler=scheduler,
-                strength=strength,
-                num_inference_steps=num_infer_steps,
-                guidance_scale=guidance_scale,
-                eta=0.0,
-                create_gif=bool(create_gif),
-                model=model,
-                callback=progress_callback,
-                callback_userdata=conn
-            )
+        # The first image uses the requested seed, the others get random seeds
+        seeds = [int(seed)] + [random.randrange(4294967294) for _ in range(num_images - 1)]
 
+        start_time = time.time()
+        outputs = generate_images(engine, model_name, model_path, request_scheduler(request, scheduler),
+                                  request, seeds, job)
         end_time = time.time()
-        print("Image generated from Stable-Diffusion in ", end_time - start_time, " seconds.")
+        print("%d image(s) generated from Stable-Diffusion in " % num_images, end_time - start_time, " seconds.")
 
-        image = "sd_cache.png"
-
-        if "controlnet" in model_name or model_name == "sd_1.5_square_lcm" or "sd_3.0" in model_name:
-            output.save(os.path.join(weight_path, "..", image))
-            src_width, src_height = output.size
-        else:
-            cv2.imwrite(os.path.join(weight_path, "..", image), output)
-            src_height, src_width, _ = output.shape
-
-        data_output["seed_num"] = seed
-        data_output["src_height"] = src_height
-        data_output["src_width"] = src_width
-        data_output["inference_status"] = "success"
-
-        with open(os.path.join(weight_path, "..", "gimp_openvino_run_sd.json"), "w") as file:
-            json.dump(data_output, file)
+        images = []
+        for image_seed, output in zip(seeds, outputs):
+            rgb = to_rgb_array(output)
+            src_height, src_width, channels = rgb.shape
+            info = {"seed": image_seed, "height": src_height, "width": src_width, "channels": channels, "dtype": "uint8"}
+            images.append((info, rgb))
 
         # Remove old temporary error files that were saved
         my_dir = os.path.join(weight_path, "..")
@@ -367,14 +894,16 @@ def handle_client_data(data, conn, engine, model_name, model_path, scheduler):
             if f_name.startswith("error_log"):
                 os.remove(os.path.join(my_dir, f_name))
 
+        job.update(status="success", images=images)
+
+    except JobCancelled:
+        log.info('Job %s cancelled at step %s', job.job_id, job.step)
+        job.update(status="cancelled")
+
     except Exception as error:
-        with open(os.path.join(weight_path, "..", "gimp_openvino_run_sd.json"), "w") as file:
-            data_output["inference_status"] = "failed"
-            json.dump(data_output, file)
         with open(os.path.join(weight_path, "..", "error_log.txt"), "w") as file:
             traceback.print_exception("DEBUG THE ERROR", file=file)
-
-    conn.sendall(b"done")
+        job.update(status="failed", error=str(error))
 
 def start():
     model_name = sys.argv[1].lower()
@@ -12,36 +12,36 @@ sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
 
 import cv2
 from superes_run_ov import run
-import torch
-from tools_utils import get_weight_path
+from tools_utils import get_weight_path, get_config_value
 import traceback
 import numpy as np
 
-def get_sr(img,s, model_name="sr_1033", weight_path=None,device="CPU"):
+def get_sr(img,s, model_name="sr_1033", weight_path=None,device="CPU", core=None, compiled_models=None):
     if weight_path is None:
         weight_path = get_weight_path()
+    # with sr_tile_size set, larger layers run over tiles of one compiled shape. 0 (the default) runs the whole layer at once
+    tiling = {"tile_size": get_config_value("sr_tile_size", 0), "tile_overlap": get_config_value("sr_tile_overlap", 16),
+              "num_requests": get_config_value("sr_num_requests", 0)}
     
     if model_name == "esrgan":
-        out = run(img, os.path.join(weight_path, "superresolution-ov", "realesrgan.xml"), device, model_name)
+        out = run(img, os.path.join(weight_path, "superresolution-ov", "realesrgan.xml"), device, model_name, core, compiled_models, **tiling)
         out = cv2.resize(out, (0, 0), fx=s / 4, fy=s / 4)
     elif model_name == "edsr":
-        b, g, r = cv2.split(np.array(img))
-        channel_list = [b, g, r]
-        output_list = []
-        for img_c in channel_list:
-            output = run(img_c, os.path.join(weight_path, "superresolution-ov", "edsr.xml"), device, model_name)
-            output_list.append(output)
-        out = cv2.merge([output_list[0], output_list[1], output_list[2]], 3)
+        # the three channels run as a batch of 3 single channel images
+        out = run(np.array(img), os.path.join(weight_path, "superresolution-ov", "edsr.xml"), device, model_name, core, compiled_models, **tiling)
         out = cv2.resize(out, (0, 0), fx=s / 2, fy=s / 2)
 
     else:
-        out = run(img, os.path.join(weight_path, "superresolution-ov", "single-image-super-resolution-1033.xml"), device, model_name)
+        out = run(img, os.path.join(weight_path, "superresolution-ov", "single-image-super-resolution-1033.xml"), device, model_name, core, compiled_models, **tiling)
         out = cv2.resize(out, (0, 0), fx=s / 3, fy=s / 3)
     return out
 
 
-if __name__ == "__main__":
-    weight_path = get_weight_path()
+def run_saved_request(weight_path, core=None, compiled_models=None):
+    """
+    Run the request the plugin saved in gimp_openvino_run.json on cache.png, and write the result back there.
+    Also called by the inference server, with its core and compiled model cache.
+    """
     with open(os.path.join(weight_path, "..", "gimp_openvino_run.json"), "r") as file:
         data_output = json.load(file)
 
@@ -52,7 +52,8 @@ if __name__ == "__main__":
 
     image = cv2.imread(os.path.join(weight_path, "..", "cache.png"))[:, :, ::-1]
     try:
-        output = get_sr(image, s, model_name=model_name, weight_path=weight_path, device=device)
+        output = get_sr(image, s, model_name=model_name, weight_path=weight_path, device=device,
+                        core=core, compiled_models=compiled_models)
         cv2.imwrite(os.path.join(weight_path, "..", "cache.png"), output[:, :, ::-1])
         data_output["inference_status"] = "success"
         with open(os.path.join(weight_path, "..", "gimp_openvino_run.json"), "w") as file:
@@ -62,13 +63,18 @@ if __name__ == "__main__":
         for f_name in os.listdir(my_dir):
             if f_name.startswith("error_log"):
                 os.remove(os.path.join(my_dir, f_name))
+        return "success"
   
     except Exception as error:
         with open(os.path.join(weight_path, "..", "gimp_openvino_run.json"), "w") as file:
             json.dump({"inference_status": "failed"}, file)
         with open(os.path.join(weight_path, "..", "error_log.txt"), "w") as file:
-            traceback.print_exception("DEBUG THE ERROR", file=file)
+            traceback.print_exc(file=file)
             # Uncoment below lines to debug
             #e_type, e_val, e_tb = sys.exc_info()
             #traceback.print_exception(e_type, e_val, e_tb, file=file)
+        return "failed"
+
 
+if __name__ == "__main__":
+    run_saved_request(get_weight_path())
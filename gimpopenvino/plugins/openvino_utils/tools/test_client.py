@@ -3,13 +3,14 @@
 # SPDX - License - Identifier: Apache - 2.0
 
 import socket
+from socket_utils import send_message, recv_message
 
 HOST = "127.0.0.1"  # The server's hostname or IP address
 PORT = 65432  # The port used by the server
 
 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
     s.connect((HOST, PORT))
-    s.sendall(b"Hello, GIMP")
-    data = s.recv(1024)
+    send_message(s, {"type": "ping"})
+    data, _ = recv_message(s)
 
-print(f"Received {data!r}")
\ No newline at end of file
+print(f"Received {data!r}")
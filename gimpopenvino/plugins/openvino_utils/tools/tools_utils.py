@@ -14,6 +14,13 @@ def get_weight_path():
 
     return weight_path
 
+def get_config_value(key, default=None):
+    config_path = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(config_path, "gimp_openvino_config.json"), "r") as file:
+        data = json.load(file)
+
+    return data.get(key, default)
+
 
 
 if __name__ == "__main__":
@@ -102,7 +102,9 @@ def semseg(procedure, image, drawable, device_name, model_name, progress_bar, co
     print("python_path",python_path)
     print("plugin_path",plugin_path)
     print("weight_path in main",weight_path)
-    subprocess.call([python_path, plugin_path])
+    # the inference server keeps the compiled models between runs, the script is the fallback
+    if not run_on_inference_server(python_path, config_path_output["server_path"], "semseg"):
+        subprocess.call([python_path, plugin_path])
     #data_output = subprocess.call([python_path, plugin_path, device_name, model_name])
     with open(os.path.join(weight_path, "..", "gimp_openvino_run.json"), "r") as file:
         data_output = json.load(file)
@@ -157,6 +159,7 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
         
         python_path = config_path_output["python_path"]
         config_path_output["plugin_path"] = os.path.join(config_path, "semseg_ov.py")
+        config_path_output["server_path"] = os.path.join(config_path, "inference_ov_server.py")
         
         device_name_enum = DeviceEnum(config_path_output["supported_devices"])
 
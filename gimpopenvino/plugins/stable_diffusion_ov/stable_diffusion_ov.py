@@ -21,6 +21,10 @@ import os
 import sys
 import socket
 from enum import IntEnum
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 import glob
 from pathlib import Path
@@ -29,7 +33,9 @@ HOST = "127.0.0.1"  # The server's hostname or IP address
 PORT = 65432  # The port used by the server
 
 sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "..","openvino_utils")])
+sys.path.extend([os.path.join(os.path.dirname(os.path.realpath(__file__)), "..","openvino_utils","tools")])
 from plugin_utils import *
+from socket_utils import send_message, recv_message
 from model_management_window import ModelManagementWindow
 
 _ = gettext.gettext
@@ -115,12 +121,80 @@ class SDDialogResponse(IntEnum):
     RunInferenceComplete = 778
     ProgressUpdate = 779
 
+def read_shared_pixels(shm_name, size):
+    """
+    Copy the pixels out of a shared memory segment owned by the stable-diffusion server.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        if os.name == "posix":
+            # The server owns the segment, stop our resource tracker from unlinking it on exit
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+def load_result_layer(image_new, info, payload):
+    """
+    Add a generated image to image_new, using the transport the server picked.
+    """
+    set_name = "Stable Diffusion -" + str(info["seed"])
+    width, height = info["width"], info["height"]
+    transport = info.get("transport", "socket")
+
+    if transport == "png":
+        result = Gimp.file_load(Gimp.RunMode.NONINTERACTIVE, Gio.file_new_for_path(info["path"]))
+        try:
+            # 2.99.10
+            result_layer = result.get_active_layer()
+        except:
+            # > 2.99.10
+            result_layer = result.list_layers()[0]
+
+        copy = Gimp.Layer.new_from_drawable(result_layer, image_new)
+        copy.set_name(set_name)
+        copy.set_mode(Gimp.LayerMode.NORMAL_LEGACY)
+        image_new.insert_layer(copy, None, -1)
+        result.delete()
+        os.remove(info["path"])
+        return
+
+    if transport == "shm":
+        pixels = read_shared_pixels(info["shm_name"], width * height * info["channels"])
+    else:
+        pixels = payload[info["offset"]:info["offset"] + info["nbytes"]]
+
+    new_layer_from_pixels(image_new, set_name, width, height, pixels)
+
+def load_result_images(result, payload, conn):
+    """
+    Open every generated image in its own GIMP image and display.
+    """
+    try:
+        for info in result["images"]:
+            image_new = Gimp.Image.new(info["width"], info["height"], 0)
+            try:
+                load_result_layer(image_new, info, payload)
+            except Exception:
+                image_new.delete()
+                raise
+            # only shown once it has its layer
+            Gimp.Display.new(image_new)
+    finally:
+        if any(info.get("transport") == "shm" for info in result["images"]):
+            # Let the server release the segments
+            send_message(conn, {"type": "release"})
+
 def check_files_exist(dir_path, files):
     return all(os.path.isfile(Path(dir_path) / file) for file in files)
 
 class SDRunner:
     def __init__ (self, procedure, image, drawable, prompt, negative_prompt, num_images,num_infer_steps, guidance_scale, initial_image,
-                  strength, seed, progress_bar, config_path_output):
+                  strength, seed, progress_bar, config_path_output, model_name=None, scheduler="euler"):
         self.procedure = procedure
         self.image = image
         self.drawable = drawable
@@ -134,7 +208,11 @@ class SDRunner:
         self.seed = seed
         self.progress_bar = progress_bar
         self.config_path_output = config_path_output
+        self.model_name = model_name
+        self.scheduler = scheduler
         self.result = None
+        self.job_id = None
+        self.cancelled = False
 
     def run(self, dialog):
         procedure = self.procedure
@@ -163,93 +241,66 @@ class SDRunner:
 
         #save_image(image, drawable, os.path.join(weight_path, "..", "cache.png"))
 
-        # Option Cache
+        # Option Cache, used to restore the dialog settings next time
         sd_option_cache = os.path.join(weight_path, "..", "gimp_openvino_run_sd.json")
+        params = {"prompt": prompt,
+                  "negative_prompt": negative_prompt,
+                  "num_images": num_images,
+                  "num_infer_steps": num_infer_steps,
+                  "guidance_scale": guidance_scale,
+                  "initial_image": initial_image,
+                  "strength": strength,
+                  "seed": seed,
+                  "scheduler": self.scheduler}
 
         with open(sd_option_cache, "w") as file:
-            json.dump({"prompt": prompt,
-                       "negative_prompt": negative_prompt,
-                       "num_images": num_images,
-                       "num_infer_steps": num_infer_steps,
-                       "guidance_scale": guidance_scale,
-                       "initial_image": initial_image,
-                       "strength": strength,
-                       "seed": seed,
-                       "inference_status": "started"}, file)
+            json.dump(params, file)
 
         # Run inference and load as layer
-        '''
-        subprocess.call([python_path, plugin_path])
-        '''
+        request_params = dict(params, model_name=self.model_name,
+                              result_transport="shm" if shared_memory is not None else "png")
         self.current_step = 0
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(b"go")
-            while True:
-                data = s.recv(1024)
-                response = data.decode()
-                if response == "done":
-                    break
-                elif response.isdigit():
-                    iteration = int(response)
-                    self.current_step = iteration
-                    dialog.response(SDDialogResponse.ProgressUpdate)
-
-        data_output = {}
-
+        result = {"status": "failed"}
         try:
-            with open(sd_option_cache, "r") as file:
-                data_output = json.load(file)
-                # json.dumps(data_output)
-        except:
-            print(f"ERROR : {sd_option_cache} not found")
-
-        if image:
-            image.undo_group_end()
-        Gimp.context_pop()
-
-        if data_output["inference_status"] == "success":
-
-
-            image_new = Gimp.Image.new(
-            data_output["src_width"], data_output["src_height"], 0
-        )
-            display = Gimp.Display.new(image_new)
-            cache_image = "sd_cache.png"
-            result = Gimp.file_load(
-                Gimp.RunMode.NONINTERACTIVE,
-                Gio.file_new_for_path(os.path.join(weight_path, "..", cache_image)),
-            )
-            try:
-                # 2.99.10
-                result_layer = result.get_active_layer()
-            except:
-                # > 2.99.10
-                result_layers = result.list_layers()
-                result_layer = result_layers[0]
-
-            copy = Gimp.Layer.new_from_drawable(result_layer, image_new)
-            set_name = "Stable Diffusion -" + str(data_output["seed_num"])
-            copy.set_name(set_name)
-            copy.set_mode(Gimp.LayerMode.NORMAL_LEGACY)  # DIFFERENCE_LEGACY
-            image_new.insert_layer(copy, None, -1)
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.connect((HOST, PORT))
+                send_message(s, {"type": "run", "params": request_params})
+                while True:
+                    message, payload = recv_message(s)
+                    if message is None:
+                        break
+                    if message["type"] == "submitted":
+                        self.job_id = message["job_id"]
+                    elif message["type"] == "progress":
+                        self.current_step = message["step"]
+                        dialog.response(SDDialogResponse.ProgressUpdate)
+                    elif message["type"] == "result":
+                        result = message
+                        if result["status"] == "success":
+                            load_result_images(result, payload, s)
+                        break
+        except Exception as error:
+            print("ERROR : stable-diffusion server connection failed:", error)
+            result = {"status": "failed"}
 
+        if result["status"] == "success":
             Gimp.displays_flush()
             if image:
                 image.undo_group_end()
             Gimp.context_pop()
 
-
-            # Remove temporary layers that were saved
-            my_dir = os.path.join(weight_path, "..")
-            for f_name in os.listdir(my_dir):
-                if f_name.startswith("sd_cache"):
-                    os.remove(os.path.join(my_dir, f_name))
-
             self.result = procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
             return self.result
 
         else:
+            if image:
+                image.undo_group_end()
+            Gimp.context_pop()
+
+            if result["status"] == "cancelled":
+                self.result = procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
+                return self.result
+
             show_dialog(
                 "Inference not successful. See error_log.txt in GIMP-OpenVINO folder.",
                 "Error !",
@@ -267,24 +318,64 @@ def is_server_running():
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.settimeout(0.1) # <- set connection timeout to 100 ms (default is a few seconds)
             s.connect((HOST, PORT))
-            s.sendall(b"ping")
-            data = s.recv(1024)
-            if data.decode() == "ping":
+            send_message(s, {"type": "ping"})
+            message, _ = recv_message(s)
+            if message is not None and message["type"] == "ping":
                 return True
     except:
         return False
 
     return False
 
-def async_load_models(python_path, server_path, model_name, supported_devices, device_power_mode,dialog):
+def cancel_sd_job(job_id):
+    """
+    Ask the server to stop a queued or running job. The loaded model stays in the server.
+    """
+    if job_id is None:
+        return
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(1.0)
+            s.connect((HOST, PORT))
+            send_message(s, {"type": "cancel", "job_id": job_id})
+            recv_message(s)
+    except:
+        print("Could not cancel stable-diffusion job", job_id)
+
+def load_model_on_server(model_name, device_power_mode):
+    """
+    Ask a running server to make model_name resident. Models used before are usually still loaded,
+    which makes switching back and forth almost instant.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect((HOST, PORT))
-        s.sendall(b"kill")
+        send_message(s, {"type": "load", "model_name": model_name, "power_mode": device_power_mode, "priority": 1})
+        while True:
+            message, _ = recv_message(s)
+            if message is None:
+                return False
+            if message["type"] == "loaded":
+                return message["status"] == "success"
 
-        print("stable-diffusion model server killed")
-    except:
-        print("No stable-diffusion model server found to kill")
+def async_load_models(python_path, server_path, model_name, supported_devices, device_power_mode,dialog):
+    if is_server_running():
+        try:
+            if load_model_on_server(model_name, device_power_mode):
+                print("stable-diffusion model server switched to", model_name)
+                dialog.response(SDDialogResponse.LoadModelComplete)
+                return
+        except:
+            pass
+
+        # The running server could not load the model, start from a fresh one
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.connect((HOST, PORT))
+            send_message(s, {"type": "kill"})
+
+            print("stable-diffusion model server killed")
+        except:
+            print("No stable-diffusion model server found to kill")
 
     process = subprocess.Popen([python_path, server_path, model_name, str(supported_devices), device_power_mode], close_fds=True)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -294,21 +385,16 @@ def async_load_models(python_path, server_path, model_name, supported_devices, d
         while True:
             conn, addr = s.accept()
             with conn:
-                while True:
-                    data = conn.recv(1024)
-                    if data.decode() == "Ready":
-                        break
-                break
+                message, _ = recv_message(conn)
+                if message is not None and message["type"] == "ready":
+                    break
 
     dialog.response(SDDialogResponse.LoadModelComplete)
 
 def async_sd_run_func(runner, dialog,num_images):
     print("Running SD async")
-    for i in range(num_images):
-        if i != 0:
-            runner.seed = None
-        runner.run(dialog)
-        i += 1
+    # All num_images images are generated by the server in one job
+    runner.run(dialog)
     print("async SD done")
     dialog.response(SDDialogResponse.RunInferenceComplete)
 
@@ -450,6 +536,13 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
         seed_label = Gtk.Label(label=seed_text)
 
 
+        # scheduler: the multistep solvers reach the Euler quality in about half the steps
+        scheduler_enum = StringEnum("euler", _("Euler"), "dpm++_2m_karras", _("DPM++ 2M Karras"), "unipc", _("UniPC"))
+        scheduler_label = Gtk.Label.new_with_mnemonic(_("_Scheduler"))
+        scheduler_combo = GimpUi.prop_string_combo_box_new(
+            config, "scheduler", scheduler_enum.get_tree_model(), 0, 1
+        )
+
         adv_power_mode_label = Gtk.Label.new_with_mnemonic(_("_Power Mode"))
         adv_power_mode_combo = GimpUi.prop_string_combo_box_new(
             config, "power_mode", device_name_enum.get_tree_model(), 0, 1
@@ -485,6 +578,12 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
                 return True
             return False
 
+        def schedulers_supported(model_name):
+            # LCM and SD 3.0 come with their own scheduler
+            if model_name == "sd_1.5_square_lcm" or "sd_3.0" in model_name:
+                return False
+            return True
+
         def remove_all_advanced_widgets():
             grid.remove(gscale_label)
             gscale_label.hide()
@@ -513,6 +612,11 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
             grid.remove(adv_power_mode_combo)
             adv_power_mode_combo.hide()
 
+            grid.remove(scheduler_label)
+            scheduler_label.hide()
+            grid.remove(scheduler_combo)
+            scheduler_combo.hide()
+
             invisible_label4.show()
             invisible_label5.show()
             invisible_label6.show()
@@ -538,6 +642,11 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
                 adv_power_mode_label.show()
                 adv_power_mode_combo.show()
 
+            if schedulers_supported(model_name):
+                grid.attach(scheduler_label, 0, 10, 1, 1)
+                grid.attach(scheduler_combo, 1, 10, 1, 1)
+                scheduler_label.show()
+                scheduler_combo.show()
 
 
             steps_label.show()
@@ -862,6 +971,7 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
                     num_infer_steps = config.get_property("num_infer_steps")
                     guidance_scale = config.get_property("guidance_scale")
                     strength = config.get_property("strength")
+                    scheduler = config.get_property("scheduler")
                     if len(seed.get_text()) != 0:
                         seed = seed.get_text()
                     else:
@@ -876,6 +986,7 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
                     guidance_scale = 7.5
                     seed = None
                     strength = 1.0
+                    scheduler = "euler"
 
                 if initialImage_checkbox.get_active() and n_layers == 1:
                     if len(file_entry.get_text()) != 0:
@@ -887,7 +998,8 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
 
 
                 runner = SDRunner(procedure, image, layer, prompt, negative_prompt,num_images, num_infer_steps, guidance_scale, initial_image,
-                strength, seed, progress_bar, config_path_output)
+                strength, seed, progress_bar, config_path_output, model_name=config.get_property("model_name"),
+                scheduler=scheduler)
 
                 sd_run_label.set_label("Running Stable Diffusion...")
                 sd_run_label.show()
@@ -975,6 +1087,11 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
 
 
             else:
+                # Stop the generation that is still running on the server
+                if run_inference_thread:
+                    runner.cancelled = True
+                    cancel_sd_job(runner.job_id)
+
                 model_management_window.stop_poll_thread()
 
 #                dialog.destroy()
@@ -1014,6 +1131,14 @@ class StableDiffusion(Gimp.PlugIn):
             GObject.ParamFlags.READWRITE,
         ),
 
+        "scheduler": (
+            str,
+            _("Scheduler"),
+            "Scheduler: 'euler', 'dpm++_2m_karras' or 'unipc' (DPM++ and UniPC need about half the Euler steps)",
+            "euler",
+            GObject.ParamFlags.READWRITE,
+        ),
+
         "power_mode": (
             str,
             _("Power Mode"),
@@ -1077,6 +1202,7 @@ class StableDiffusion(Gimp.PlugIn):
 
             procedure.add_argument_from_property(self, "advanced_setting")
             procedure.add_argument_from_property(self, "power_mode")
+            procedure.add_argument_from_property(self, "scheduler")
 
             procedure.add_argument_from_property(self, "use_initial_image")
 
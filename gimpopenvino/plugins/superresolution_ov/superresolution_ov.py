@@ -105,7 +105,9 @@ def superresolution(procedure, image, drawable,scale, device_name, model_name, p
     save_inference_parameters(weight_path, device_name, scale, model_name)
 
     try:
-        subprocess.call([python_path, plugin_path])
+        # the inference server keeps the compiled models between runs, the script is the fallback
+        if not run_on_inference_server(python_path, config_path_output["server_path"], "superresolution"):
+            subprocess.call([python_path, plugin_path])
         data_output = load_inference_results(weight_path)
     except Exception as e:
         Gimp.message(f"Error during inference: {e}")
@@ -179,6 +181,7 @@ def run(procedure, run_mode, image, n_drawables, layer, args, data):
         
         python_path = config_path_output["python_path"]
         config_path_output["plugin_path"] = os.path.join(config_path, "superresolution_ov.py")
+        config_path_output["server_path"] = os.path.join(config_path, "inference_ov_server.py")
         
         device_name_enum = DeviceEnum(config_path_output["supported_devices"])
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# Copyright(C) 2022-2023 Intel Corporation
+# SPDX - License - Identifier: Apache - 2.0
+"""
+Parity check of the NumPy schedulers (models_ov/schedulers_np.py) against the diffusers schedulers
+they reimplement. For every supported config, the timesteps, add_noise, scale_model_input and a full
+run of step() on the same model outputs are compared. Skipped when diffusers (or torch) is missing.
+
+    python testscases/Schedulers/schedulers_np_parity_tc.py
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", ".."))
+from gimpopenvino.plugins.openvino_utils.tools.openvino_common.models_ov.schedulers_np import (
+    EulerDiscreteSchedulerNP,
+    LMSDiscreteSchedulerNP,
+    DDIMSchedulerNP,
+    LCMSchedulerNP,
+    SCHEDULERS,
+)
+
+# beta schedule of the stable diffusion 1.5 models, as the server creates the schedulers
+MODEL_CONFIG = {"beta_start": 0.00085, "beta_end": 0.012, "beta_schedule": "scaled_linear"}
+LATENT_SHAPE = (1, 4, 64, 64)
+
+
+def parity_configs():
+    """
+    (name, NumPy scheduler class, diffusers scheduler class, config, number of steps) of every config to check
+    """
+    from diffusers.schedulers import (
+        DDIMScheduler,
+        DPMSolverMultistepScheduler,
+        EulerDiscreteScheduler,
+        LCMScheduler,
+        LMSDiscreteScheduler,
+        UniPCMultistepScheduler,
+    )
+    diffusers_classes = {
+        "euler": EulerDiscreteScheduler,
+        "lms": LMSDiscreteScheduler,
+        "dpm++_2m": DPMSolverMultistepScheduler,
+        "dpm++_2m_karras": DPMSolverMultistepScheduler,
+        "unipc": UniPCMultistepScheduler,
+    }
+    configs = [(name, np_class, diffusers_classes[name], dict(MODEL_CONFIG, **config), None)
+               for name, (np_class, config) in SCHEDULERS.items()]
+    configs += [
+        ("euler v_prediction", EulerDiscreteSchedulerNP, EulerDiscreteScheduler,
+         dict(MODEL_CONFIG, prediction_type="v_prediction"), None),
+        ("euler leading", EulerDiscreteSchedulerNP, EulerDiscreteScheduler,
+         dict(MODEL_CONFIG, timestep_spacing="leading", steps_offset=1), None),
+        ("lms leading", LMSDiscreteSchedulerNP, LMSDiscreteScheduler,
+         dict(MODEL_CONFIG, timestep_spacing="leading", steps_offset=1), None),
+        ("ddim", DDIMSchedulerNP, DDIMScheduler,
+         dict(MODEL_CONFIG, clip_sample=False, set_alpha_to_one=False, steps_offset=1), None),
+        ("ddim v_prediction", DDIMSchedulerNP, DDIMScheduler,
+         dict(MODEL_CONFIG, clip_sample=False, set_alpha_to_one=False, steps_offset=1,
+              prediction_type="v_prediction"), None),
+        ("lcm", LCMSchedulerNP, LCMScheduler, dict(MODEL_CONFIG), 4),
+    ]
+    return configs
+
+
+def close(expected, actual, rtol):
+    """
+    Largest difference relative to the magnitude of expected, and whether it is below rtol
+    """
+    expected = np.asarray(expected, dtype=np.float64)
+    actual = np.asarray(actual, dtype=np.float64)
+    if expected.shape != actual.shape:
+        return float("inf"), False
+    error = np.abs(expected - actual).max() / max(np.abs(expected).max(), 1e-6)
+    return error, error <= rtol
+
+
+def check(name, np_class, diffusers_class, config, num_steps, rtol, seed):
+    """
+    Returns:
+        failures (List[str]): what differs, empty when the NumPy scheduler matches
+    """
+    import torch
+
+    failures = []
+    np_scheduler = np_class(**config)
+    diffusers_scheduler = diffusers_class(**config)
+    np_scheduler.set_timesteps(num_steps)
+    diffusers_scheduler.set_timesteps(num_steps)
+    diffusers_timesteps = diffusers_scheduler.timesteps.numpy()
+
+    def compare(what, expected, actual):
+        error, ok = close(expected, actual, rtol)
+        if not ok:
+            failures.append("%s: relative error %.2e" % (what, error))
+
+    compare("timesteps", diffusers_timesteps, np_scheduler.timesteps)
+    if failures:
+        return failures
+
+    rng = np.random.default_rng(seed)
+    original = rng.standard_normal(LATENT_SHAPE).astype(np.float32)
+    noise = rng.standard_normal(LATENT_SHAPE).astype(np.float32)
+    for index in (0, len(diffusers_timesteps) // 2, len(diffusers_timesteps) - 1):
+        timesteps = diffusers_timesteps[index:index + 1]
+        expected = diffusers_scheduler.add_noise(torch.from_numpy(original), torch.from_numpy(noise),
+                                                 torch.from_numpy(timesteps)).numpy()
+        compare("add_noise at step %d" % index, expected, np_scheduler.add_noise(original, noise, timesteps))
+
+    # the same model outputs for both, each scheduler follows its own trajectory
+    init_noise_sigma = float(diffusers_scheduler.init_noise_sigma)
+    compare("init_noise_sigma", init_noise_sigma, np_scheduler.init_noise_sigma)
+    np_sample = (rng.standard_normal(LATENT_SHAPE) * init_noise_sigma).astype(np.float32)
+    diffusers_sample = torch.from_numpy(np_sample.copy())
+    for i, t in enumerate(diffusers_timesteps):
+        np_t = np_scheduler.timesteps[i]
+        model_output = rng.standard_normal(LATENT_SHAPE).astype(np.float32)
+
+        compare("scale_model_input at step %d" % i,
+                diffusers_scheduler.scale_model_input(diffusers_sample, torch.tensor(t)).numpy(),
+                np_scheduler.scale_model_input(np_sample, np_t))
+
+        if np_class is LCMSchedulerNP:
+            # the noise injected between the LCM steps is drawn from different generators: both run from
+            # the same sample, the denoised outputs are compared, and the last step that adds no noise
+            diffusers_output = diffusers_scheduler.step(torch.from_numpy(model_output), torch.tensor(t),
+                                                        torch.from_numpy(np_sample))
+            np_output = np_scheduler.step(model_output, np_t, np_sample)
+            compare("denoised at step %d" % i, diffusers_output.denoised.numpy(), np_output["denoised"])
+            if i == len(diffusers_timesteps) - 1:
+                compare("prev_sample at the last step", diffusers_output.prev_sample.numpy(), np_output["prev_sample"])
+            np_sample = np.asarray(np_output["prev_sample"], dtype=np.float32)
+        else:
+            diffusers_sample = diffusers_scheduler.step(torch.from_numpy(model_output), torch.tensor(t),
+                                                        diffusers_sample).prev_sample
+            np_sample = np.asarray(np_scheduler.step(model_output, np_t, np_sample)["prev_sample"], dtype=np.float32)
+            compare("prev_sample at step %d" % i, diffusers_sample.numpy(), np_sample)
+        if failures:
+            # later steps only repeat the first difference
+            break
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the NumPy schedulers with the diffusers ones")
+    parser.add_argument("-n", "--num_steps", type=int, default=20, help="number of inference steps")
+    parser.add_argument("-t", "--rtol", type=float, default=1e-4,
+                        help="largest difference allowed, relative to the magnitude of the diffusers output")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="seed of the samples and model outputs")
+    args = parser.parse_args()
+
+    try:
+        import torch  # noqa: F401
+        import diffusers  # noqa: F401
+    except ImportError as error:
+        print("SKIP: diffusers and torch are needed for the parity check (%s)" % error)
+        return 0
+
+    failed = 0
+    for name, np_class, diffusers_class, config, num_steps in parity_configs():
+        failures = check(name, np_class, diffusers_class, config, num_steps or args.num_steps, args.rtol, args.seed)
+        if failures:
+            failed += 1
+            print("FAIL %s" % name)
+            for failure in failures:
+                print("    %s" % failure)
+        else:
+            print("PASS %s" % name)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())